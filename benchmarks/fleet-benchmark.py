@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+
+#Simple AWS Manager (SAM) Toolbox is a set of lightweight scripts and modules for sysadmins in AWS
+#Copyright (C) 2024 Newton Advisory, LLC
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import sys
+import json
+import time
+import argparse
+import tracemalloc
+from contextlib import redirect_stdout
+
+# Runs the toolbox's stages against the simulated backend in benchmarks/simulator.py and reports wall time, API
+# calls, throttled calls and peak memory for each fleet size. Nothing leaves the machine, so regressions and
+# improvements can be measured on a laptop:
+#   inventory   the scripts' create_instance_map with --select all (describe_instances and describe_instance_status)
+#   spade       the SSM readiness check, execute_command and the monitor, until every invocation's output is fetched
+#   init        execute_command stopping every instance and the monitor waiting for them to stop
+#   list        iter_report collecting every value for every instance
+#
+# Example: ./benchmarks/fleet-benchmark.py --sizes 10,100,1000 --latency-ms 30 --throttle-rate 20 --json bench.json
+# The stages are called through the sam_toolbox package, so they print nothing; the listing from --select is
+# discarded. Peak memory is traced with tracemalloc, which slows Python down, so pass --no-memory when comparing wall
+# times alone. The peak includes the simulator's own responses
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'simulated')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'simulated')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.pop('AWS_PROFILE', None)
+
+from sam_toolbox.cache import settings as cache_settings
+from sam_toolbox.clients import new_session, get_client
+from sam_toolbox import actions, cli, commands, report
+import simulator
+
+SCENARIOS = ('inventory', 'spade', 'init', 'list')
+LIST_VALUES = [
+    "InstanceId", "ImageId", "InstanceType", "KeyName", "LaunchTime", "Placement.AvailabilityZone", "PrivateIpAddress",
+    "State.Name", "SubnetId", "VpcId", "SecurityGroups", "Tags", "BlockDeviceMappings", "CpuOptions", "PlatformDetails",
+]
+
+def parse_range(text):
+    low, _, high = text.partition('-')
+    return float(low), float(high or low)
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Benchmark the toolbox against a simulated EC2/SSM backend")
+    parser.add_argument('--sizes', default='10,100,1000,10000', help="comma separated fleet sizes (default 10,100,1000,10000)")
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help=f"comma separated scenarios (default {','.join(SCENARIOS)})")
+    parser.add_argument('--latency-ms', type=float, default=20, help="simulated latency of every API call (default 20)")
+    parser.add_argument('--throttle-rate', type=float, default=0, help="API calls per second per operation before throttling (default 0, none)")
+    parser.add_argument('--command-seconds', type=parse_range, default=(1, 3), metavar='MIN-MAX', help="how long SSM commands run (default 1-3)")
+    parser.add_argument('--transition-seconds', type=float, default=2, help="how long instances take to stop (default 2)")
+    parser.add_argument('--failure-rate', type=float, default=0.0, help="fraction of command invocations that fail (default 0)")
+    parser.add_argument('--offline-rate', type=float, default=0.0, help="fraction of instances whose SSM agent is offline (default 0)")
+    parser.add_argument('--spade-min-delay', type=float, help="spade monitor's first poll interval (default: the monitor's own)")
+    parser.add_argument('--init-poll-interval', type=float, help="init monitor's poll interval (default: the monitor's own)")
+    parser.add_argument('--max-workers', type=int, default=8, help="worker threads for dispatch and monitoring (default 8)")
+    parser.add_argument('--no-memory', action='store_true', help="skip tracing peak memory, for undisturbed wall times")
+    parser.add_argument('--json', metavar='FILE', help="also write the results to FILE as JSON")
+    parser.add_argument('--seed', type=int, default=1)
+    return parser.parse_args()
+
+# Each scenario returns how many instances it processed
+
+def run_inventory(target, backend, args):
+    instance_map, instance_targets = cli.create_instance_map([target], selection='all')
+    return len(instance_map)
+
+def run_spade(target, backend, args):
+    session = target['session']
+    instance_id_name_map = {instance['id']: instance['name'] for instance in backend['instances'].values()}
+    ready_map = commands.filter_ssm_ready_instances(instance_id_name_map, session, max_workers=args.max_workers)
+    successful_instances, command_ids = commands.execute_command(ready_map, 'uname -r', session, max_workers=args.max_workers)
+    monitor_options = {'min_delay': args.spade_min_delay} if args.spade_min_delay is not None else {}
+    results = commands.monitor_command_status_and_fetch_output(get_client('ssm', session), command_ids, successful_instances,
+                                                                args.max_workers, **monitor_options)
+    return sum(1 for result in results)
+
+def run_init(target, backend, args):
+    session = target['session']
+    action = 'aws ec2 stop-instances'
+    instance_id_name_map = {instance['id']: (instance['name'], instance['state']) for instance in backend['instances'].values()}
+    successful_instances = actions.execute_command(instance_id_name_map, action, session)
+    monitor_options = {'poll_interval': args.init_poll_interval} if args.init_poll_interval is not None else {}
+    statuses = actions.monitor_command_status_and_fetch_output(get_client('ec2', session), list(successful_instances), action, **monitor_options)
+    return sum(1 for status in statuses.values() if status == 'stopped')
+
+def run_list(target, backend, args):
+    instance_id_name_map = {instance['id']: instance['name'] for instance in backend['instances'].values()}
+    return sum(1 for record in report.iter_report(instance_id_name_map, LIST_VALUES, session=target['session']))
+
+SCENARIO_RUNNERS = {'inventory': run_inventory, 'spade': run_spade, 'init': run_init, 'list': run_list}
+
+# Runs one scenario on a fresh fleet and session, so clients, retry quotas and instance states start clean
+
+def run_scenario(scenario, size, args):
+    backend = simulator.new_backend(size, args.latency_ms / 1000, args.throttle_rate, args.command_seconds, args.transition_seconds,
+                                    args.failure_rate, args.offline_rate, seed=args.seed)
+    session = new_session(region_name=backend['region'])
+    simulator.attach(backend, session)
+    target = {'session': session, 'account_id': simulator.ACCOUNT_ID, 'region': backend['region']}
+    for service in ('ec2', 'ssm', 'sts'):
+        get_client(service, session)  # Loading the service models is left out of the measurement
+
+    if not args.no_memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        processed = SCENARIO_RUNNERS[scenario](target, backend, args)
+    wall = time.perf_counter() - started
+    peak = None
+    if not args.no_memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    return {
+        'scenario': scenario,
+        'instances': size,
+        'processed': processed,
+        'wall_seconds': round(wall, 3),
+        'api_calls': simulator.total_calls(backend),
+        'throttled_calls': simulator.total_throttles(backend),
+        'calls_by_operation': dict(sorted(backend['calls'].items())),
+        'peak_memory_mb': round(peak / 1024 / 1024, 2) if peak is not None else None,
+    }
+
+def print_result(result):
+    memory = f"{result['peak_memory_mb']:>10.2f}" if result['peak_memory_mb'] is not None else f"{'-':>10}"
+    print(f"{result['scenario']:<11}{result['instances']:>9}{result['processed']:>11}{result['wall_seconds']:>10.2f}s"
+          f"{result['api_calls']:>11}{result['throttled_calls']:>11}{memory}")
+
+def main():
+    args = parse_arguments()
+    sizes = [int(size) for size in args.sizes.split(',') if size.strip()]
+    scenarios = [scenario.strip() for scenario in args.scenarios.split(',') if scenario.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        print(f"\033[91mUnknown scenarios: {', '.join(sorted(unknown))}. Choose from {', '.join(SCENARIOS)}\033[0m")
+        sys.exit(1)
+
+    cache_settings['enabled'] = False  # Every run must reach the backend
+
+    print(f"Simulated latency {args.latency_ms:g} ms, throttle rate {args.throttle_rate:g}/s per operation, "
+          f"commands {args.command_seconds[0]:g}-{args.command_seconds[1]:g}s, transitions {args.transition_seconds:g}s\n")
+    print(f"{'Scenario':<11}{'Instances':>9}{'Processed':>11}{'Wall':>11}{'API calls':>11}{'Throttled':>11}{'Peak MB':>10}")
+    results = []
+    for scenario in scenarios:
+        for size in sizes:
+            result = run_scenario(scenario, size, args)
+            print_result(result)
+            results.append(result)
+
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump({'settings': {key: value for key, value in vars(args).items() if key != 'json'}, 'results': results}, file, indent=2)
+        print(f"\nResults saved to {args.json}")
+
+if __name__ == "__main__":
+    main()
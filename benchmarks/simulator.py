@@ -0,0 +1,399 @@
+#Simple AWS Manager (SAM) Toolbox is a set of lightweight scripts and modules for sysadmins in AWS
+#Copyright (C) 2024 Newton Advisory, LLC
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import io
+import json
+import time
+import random
+import threading
+from urllib.parse import parse_qsl
+from xml.sax.saxutils import escape
+from botocore.awsrequest import AWSResponse
+
+# A simulated EC2, SSM and STS backend for benchmarking the toolbox without an AWS account or a network
+# The simulator answers botocore's before-send event, the last step before a request would go on the wire, so every
+# call still goes through botocore's serializers, parsers, paginators and retry handling just as against AWS
+#
+# The fleet and the backend's behaviour are set when it is created:
+#   fleet_size        instances, all running and managed by SSM except offline_rate of them
+#   latency           seconds added to every request, varied by +-50% so concurrent workers do not move in lockstep
+#   throttle_rate     requests per second allowed per operation before it answers with throttling errors (0 = none)
+#   command_seconds   (min, max) seconds an SSM command runs on an instance
+#   transition_seconds  seconds an instance takes to start, stop or come back from a reboot
+#   failure_rate      fraction of command invocations that fail
+#   output_bytes      size of each invocation's standard output
+# Every request is counted per operation in calls, and each throttled request in throttles
+
+ACCOUNT_ID = '123456789012'
+EC2_NAMESPACE = 'http://ec2.amazonaws.com/doc/2016-11-15/'
+STATE_CODES = {'pending': 0, 'running': 16, 'shutting-down': 32, 'terminated': 48, 'stopping': 64, 'stopped': 80}
+TRANSITIONS = {'pending': 'running', 'stopping': 'stopped'}
+ENVIRONMENTS = ('prod', 'stage', 'dev')
+
+class RawResponse(io.BytesIO):
+    def stream(self, **kwargs):
+        contents = self.read()
+        while contents:
+            yield contents
+            contents = self.read()
+
+def new_backend(fleet_size, latency=0.02, throttle_rate=0, command_seconds=(1, 3), transition_seconds=2,
+                failure_rate=0.0, offline_rate=0.0, output_bytes=200, region='us-east-1', seed=1):
+    rng = random.Random(seed)
+    instances = {}
+    for n in range(fleet_size):
+        instance_id = f"i-{n:017x}"
+        instances[instance_id] = {
+            'id': instance_id,
+            'name': f"{('web', 'db', 'worker', 'cache')[n % 4]}-{n:05d}",
+            'env': ENVIRONMENTS[n % len(ENVIRONMENTS)],
+            'state': 'running',
+            'settles_at': 0,
+            'checks_ok_at': 0,
+            'online': rng.random() >= offline_rate,
+            'subnet': f"subnet-{n % 16:08x}",
+            'xml': None,  # Rendered once per state
+        }
+    return {
+        'region': region,
+        'instances': instances,
+        'order': list(instances),
+        'commands': {},
+        'latency': latency,
+        'throttle_rate': throttle_rate,
+        'buckets': {},
+        'command_seconds': command_seconds,
+        'transition_seconds': transition_seconds,
+        'failure_rate': failure_rate,
+        'output_bytes': output_bytes,
+        'rng': rng,
+        'lock': threading.Lock(),
+        'calls': {},
+        'throttles': {},
+    }
+
+# Routes every request of a boto3 session's clients to the backend. Register it before the session makes its clients
+
+def attach(backend, session):
+    session.events.register('before-send', lambda request, **kwargs: handle(backend, request))
+
+def reset_counters(backend):
+    with backend['lock']:
+        backend['calls'] = {}
+        backend['throttles'] = {}
+
+def total_calls(backend):
+    return sum(backend['calls'].values())
+
+def total_throttles(backend):
+    return sum(backend['throttles'].values())
+
+def handle(backend, request):
+    target = request.headers.get('X-Amz-Target')
+    if target:
+        target = target.decode() if isinstance(target, bytes) else target
+        service, operation = 'ssm', target.split('.')[-1]
+        params = json.loads(request.body or b'{}')
+    else:
+        body = request.body.decode() if isinstance(request.body, bytes) else (request.body or '')
+        params = dict(parse_qsl(body))
+        operation = params.pop('Action')
+        service = 'sts' if '//sts.' in request.url else 'ec2'
+
+    key = f"{service}.{operation}"
+    with backend['lock']:
+        backend['calls'][key] = backend['calls'].get(key, 0) + 1
+        throttled = not take_token(backend, key)
+        if throttled:
+            backend['throttles'][key] = backend['throttles'].get(key, 0) + 1
+    if backend['latency']:
+        time.sleep(backend['latency'] * random.uniform(0.5, 1.5))
+    if throttled:
+        if service == 'ssm':
+            return json_error(400, 'ThrottlingException', 'Rate exceeded')
+        return xml_error(503, 'RequestLimitExceeded', 'Request limit exceeded.')
+
+    handler = HANDLERS.get(key)
+    if handler is None:
+        raise NotImplementedError(f"The simulator does not implement {key}")
+    with backend['lock']:
+        return handler(backend, params)
+
+# A token bucket per operation holding up to one second of requests
+
+def take_token(backend, key):
+    rate = backend['throttle_rate']
+    if not rate:
+        return True
+    now = time.monotonic()
+    tokens, updated = backend['buckets'].get(key, (rate, now))
+    tokens = min(rate, tokens + (now - updated) * rate)
+    if tokens < 1:
+        backend['buckets'][key] = (tokens, now)
+        return False
+    backend['buckets'][key] = (tokens - 1, now)
+    return True
+
+def response(status, body, content_type):
+    return AWSResponse('https://simulator', status, {'Content-Type': content_type}, RawResponse(body.encode()))
+
+def json_response(data):
+    return response(200, json.dumps(data), 'application/x-amz-json-1.1')
+
+def json_error(status, code, message):
+    return response(status, json.dumps({'__type': code, 'message': message}), 'application/x-amz-json-1.1')
+
+def xml_response(action, body):
+    return response(200, f'<{action}Response xmlns="{EC2_NAMESPACE}"><requestId>sim</requestId>{body}</{action}Response>', 'text/xml')
+
+def xml_error(status, code, message):
+    return response(status, f'<Response><Errors><Error><Code>{code}</Code><Message>{escape(message)}</Message></Error></Errors>'
+                            f'<RequestID>sim</RequestID></Response>', 'text/xml')
+
+# Query protocol lists arrive as Name.1, Name.2...
+
+def query_list(params, prefix):
+    values = []
+    n = 1
+    while f"{prefix}.{n}" in params:
+        values.append(params[f"{prefix}.{n}"])
+        n += 1
+    return values
+
+def query_filters(params):
+    filters = {}
+    n = 1
+    while f"Filter.{n}.Name" in params:
+        filters[params[f"Filter.{n}.Name"]] = set(query_list(params, f"Filter.{n}.Value"))
+        n += 1
+    return filters
+
+# Moves an instance on to the state its last action leads to once the transition time has passed
+
+def settle(backend, instance):
+    if instance['state'] in TRANSITIONS and time.monotonic() >= instance['settles_at']:
+        instance['state'] = TRANSITIONS[instance['state']]
+        instance['xml'] = None
+    return instance
+
+def set_state(backend, instance, state):
+    instance['state'] = state
+    instance['settles_at'] = time.monotonic() + backend['transition_seconds']
+    instance['xml'] = None
+
+def page(items, params, default_size):
+    start = int(params.get('NextToken') or 0)
+    size = int(params.get('MaxResults') or default_size)
+    next_token = str(start + size) if start + size < len(items) else None
+    return items[start:start + size], next_token
+
+def select_instances(backend, params):
+    instance_ids = query_list(params, 'InstanceId')
+    filters = query_filters(params)
+    if instance_ids:
+        missing = [instance_id for instance_id in instance_ids if instance_id not in backend['instances']]
+        if missing:
+            return None, xml_error(400, 'InvalidInstanceID.NotFound', f"The instance IDs '{', '.join(missing)}' do not exist")
+        candidates = instance_ids
+    elif 'instance-id' in filters:
+        candidates = [instance_id for instance_id in filters.pop('instance-id') if instance_id in backend['instances']]
+    else:
+        candidates = backend['order']
+
+    selected = []
+    for instance_id in candidates:
+        instance = settle(backend, backend['instances'][instance_id])
+        if 'instance-state-name' in filters and instance['state'] not in filters['instance-state-name']:
+            continue
+        if 'tag:Name' in filters and instance['name'] not in filters['tag:Name']:
+            continue
+        if 'tag:Env' in filters and instance['env'] not in filters['tag:Env']:
+            continue
+        selected.append(instance)
+    return selected, None
+
+def instance_xml(backend, instance):
+    if instance['xml'] is None:
+        state = instance['state']
+        instance['xml'] = (
+            f"<item><instanceId>{instance['id']}</instanceId><imageId>ami-0123456789abcdef0</imageId>"
+            f"<instanceState><code>{STATE_CODES[state]}</code><name>{state}</name></instanceState>"
+            f"<privateDnsName>ip-10-0-0-1.ec2.internal</privateDnsName><dnsName></dnsName><keyName>ops</keyName>"
+            f"<instanceType>t3.micro</instanceType><launchTime>2024-01-01T00:00:00.000Z</launchTime>"
+            f"<placement><availabilityZone>{backend['region']}a</availabilityZone><tenancy>default</tenancy></placement>"
+            f"<subnetId>{instance['subnet']}</subnetId><vpcId>vpc-00000001</vpcId><privateIpAddress>10.0.0.1</privateIpAddress>"
+            f"<groupSet><item><groupId>sg-00000001</groupId><groupName>default</groupName></item></groupSet>"
+            f"<architecture>x86_64</architecture><rootDeviceType>ebs</rootDeviceType><rootDeviceName>/dev/xvda</rootDeviceName>"
+            f"<blockDeviceMapping><item><deviceName>/dev/xvda</deviceName><ebs><volumeId>vol-{instance['id'][2:]}</volumeId>"
+            f"<status>attached</status><deleteOnTermination>true</deleteOnTermination></ebs></item></blockDeviceMapping>"
+            f"<virtualizationType>hvm</virtualizationType>"
+            f"<tagSet><item><key>Name</key><value>{escape(instance['name'])}</value></item>"
+            f"<item><key>Env</key><value>{instance['env']}</value></item></tagSet>"
+            f"<cpuOptions><coreCount>1</coreCount><threadsPerCore>2</threadsPerCore></cpuOptions>"
+            f"<platformDetails>Linux/UNIX</platformDetails></item>"
+        )
+    return instance['xml']
+
+def describe_instances(backend, params):
+    selected, error = select_instances(backend, params)
+    if error:
+        return error
+    if query_list(params, 'InstanceId'):
+        items, next_token = selected, None
+    else:
+        items, next_token = page(selected, params, 1000)
+    body = ''.join(instance_xml(backend, instance) for instance in items)
+    reservation = (f"<item><reservationId>r-sim</reservationId><ownerId>{ACCOUNT_ID}</ownerId><groupSet/>"
+                   f"<instancesSet>{body}</instancesSet></item>") if items else ''
+    token = f"<nextToken>{next_token}</nextToken>" if next_token else ''
+    return xml_response('DescribeInstances', f"<reservationSet>{reservation}</reservationSet>{token}")
+
+def describe_instance_status(backend, params):
+    selected, error = select_instances(backend, params)
+    if error:
+        return error
+    items, next_token = page(selected, params, 1000)
+    now = time.monotonic()
+    body = []
+    for instance in items:
+        state = instance['state']
+        checks = 'ok' if state == 'running' and now >= instance['checks_ok_at'] else 'initializing'
+        body.append(f"<item><instanceId>{instance['id']}</instanceId><availabilityZone>{backend['region']}a</availabilityZone>"
+                    f"<instanceState><code>{STATE_CODES[state]}</code><name>{state}</name></instanceState>"
+                    f"<systemStatus><status>{checks}</status></systemStatus><instanceStatus><status>{checks}</status></instanceStatus></item>")
+    token = f"<nextToken>{next_token}</nextToken>" if next_token else ''
+    return xml_response('DescribeInstanceStatus', f"<instanceStatusSet>{''.join(body)}</instanceStatusSet>{token}")
+
+def change_states(backend, params, action, new_state, set_name):
+    selected, error = select_instances(backend, params)
+    if error:
+        return error
+    body = []
+    for instance in selected:
+        previous = instance['state']
+        if previous != TRANSITIONS.get(new_state):
+            set_state(backend, instance, new_state)
+        body.append(f"<item><instanceId>{instance['id']}</instanceId>"
+                    f"<currentState><code>{STATE_CODES[instance['state']]}</code><name>{instance['state']}</name></currentState>"
+                    f"<previousState><code>{STATE_CODES[previous]}</code><name>{previous}</name></previousState></item>")
+    return xml_response(action, f"<{set_name}>{''.join(body)}</{set_name}>")
+
+def start_instances(backend, params):
+    return change_states(backend, params, 'StartInstances', 'pending', 'instancesSet')
+
+def stop_instances(backend, params):
+    return change_states(backend, params, 'StopInstances', 'stopping', 'instancesSet')
+
+def reboot_instances(backend, params):
+    selected, error = select_instances(backend, params)
+    if error:
+        return error
+    for instance in selected:
+        instance['checks_ok_at'] = time.monotonic() + backend['transition_seconds']
+    return xml_response('RebootInstances', '<return>true</return>')
+
+def get_caller_identity(backend, params):
+    return response(200, f'<GetCallerIdentityResponse xmlns="https://sts.amazonaws.com/doc/2011-06-15/"><GetCallerIdentityResult>'
+                         f'<Arn>arn:aws:iam::{ACCOUNT_ID}:user/bench</Arn><UserId>AIDASIMULATOR</UserId><Account>{ACCOUNT_ID}</Account>'
+                         f'</GetCallerIdentityResult><ResponseMetadata><RequestId>sim</RequestId></ResponseMetadata></GetCallerIdentityResponse>', 'text/xml')
+
+def describe_instance_information(backend, params):
+    wanted = None
+    for instance_filter in params.get('InstanceInformationFilterList', []):
+        if instance_filter['key'] == 'InstanceIds':
+            wanted = instance_filter['valueSet']
+    candidates = [instance_id for instance_id in (wanted or backend['order']) if instance_id in backend['instances']]
+    managed = [backend['instances'][instance_id] for instance_id in candidates if backend['instances'][instance_id]['online'] or wanted]
+    items, next_token = page(managed, params, 50)
+    data = {'InstanceInformationList': [
+        {'InstanceId': instance['id'], 'PingStatus': 'Online' if instance['online'] else 'ConnectionLost',
+         'PlatformType': 'Linux', 'PlatformName': 'Amazon Linux', 'AgentVersion': '3.3.0.0'}
+        for instance in items
+    ]}
+    if next_token:
+        data['NextToken'] = next_token
+    return json_response(data)
+
+def send_command(backend, params):
+    instance_ids = params['InstanceIds']
+    if any(instance_id not in backend['instances'] or not backend['instances'][instance_id]['online'] for instance_id in instance_ids):
+        return json_error(400, 'InvalidInstanceId', 'Instances not in a valid state for account')
+    command_id = f"{len(backend['commands']):08d}-0000-4000-8000-000000000000"
+    now = time.monotonic()
+    low, high = backend['command_seconds']
+    backend['commands'][command_id] = {
+        'id': command_id,
+        'comment': params.get('Comment', ''),
+        'sent_at': time.time(),
+        'invocations': {
+            instance_id: (now + backend['rng'].uniform(low, high), backend['rng'].random() < backend['failure_rate'])
+            for instance_id in instance_ids
+        },
+    }
+    return json_response({'Command': {'CommandId': command_id, 'InstanceIds': instance_ids, 'Status': 'Pending',
+                                      'DocumentName': params.get('DocumentName'), 'Comment': params.get('Comment', ''),
+                                      'TargetCount': len(instance_ids)}})
+
+def invocation_status(invocation):
+    finishes_at, failed = invocation
+    if time.monotonic() < finishes_at:
+        return 'InProgress'
+    return 'Failed' if failed else 'Success'
+
+def list_command_invocations(backend, params):
+    command = backend['commands'].get(params['CommandId'])
+    if command is None:
+        return json_error(400, 'InvalidCommandId', 'Invalid command id')
+    items, next_token = page(list(command['invocations'].items()), params, 50)
+    data = {'CommandInvocations': [
+        {'CommandId': command['id'], 'InstanceId': instance_id, 'InstanceName': backend['instances'][instance_id]['name'],
+         'Status': invocation_status(invocation), 'StatusDetails': invocation_status(invocation)}
+        for instance_id, invocation in items
+    ]}
+    if next_token:
+        data['NextToken'] = next_token
+    return json_response(data)
+
+def get_command_invocation(backend, params):
+    command = backend['commands'].get(params['CommandId'])
+    invocation = command and command['invocations'].get(params['InstanceId'])
+    if invocation is None:
+        return json_error(400, 'InvocationDoesNotExist', 'Invocation does not exist')
+    status = invocation_status(invocation)
+    output = ('x' * 63 + '\n') * (backend['output_bytes'] // 64) if status == 'Success' else ''
+    return json_response({'CommandId': command['id'], 'InstanceId': params['InstanceId'], 'Status': status, 'StatusDetails': status,
+                          'ResponseCode': 0 if status == 'Success' else 1, 'StandardOutputContent': output,
+                          'StandardErrorContent': 'failed\n' if status == 'Failed' else ''})
+
+def list_commands(backend, params):
+    return json_response({'Commands': [
+        {'CommandId': command['id'], 'Comment': command['comment'], 'InstanceIds': list(command['invocations'])}
+        for command in backend['commands'].values()
+    ]})
+
+HANDLERS = {
+    'ec2.DescribeInstances': describe_instances,
+    'ec2.DescribeInstanceStatus': describe_instance_status,
+    'ec2.StartInstances': start_instances,
+    'ec2.StopInstances': stop_instances,
+    'ec2.RebootInstances': reboot_instances,
+    'sts.GetCallerIdentity': get_caller_identity,
+    'ssm.DescribeInstanceInformation': describe_instance_information,
+    'ssm.SendCommand': send_command,
+    'ssm.ListCommandInvocations': list_command_invocations,
+    'ssm.GetCommandInvocation': get_command_invocation,
+    'ssm.ListCommands': list_commands,
+}
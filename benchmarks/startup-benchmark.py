@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+#Simple AWS Manager (SAM) Toolbox is a set of lightweight scripts and modules for sysadmins in AWS
+#Copyright (C) 2024 Newton Advisory, LLC
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+
+# Measures how long the scripts take to start, by running them in a fresh interpreter with python -X importtime:
+#   help      sam-<script>.py --help
+#   check     sam-<script>.py --job examples/jobs.example.json --check, validating a job file without contacting AWS
+#   sdk       importing sam_toolbox.clients and building an EC2 and STS client, the cost every AWS call pays once
+# For each it reports the median wall time, the time spent importing modules and whether boto3 was loaded. The help
+# and check scenarios should never load boto3; if they do, an import crept back to module level
+#
+# Example: ./benchmarks/startup-benchmark.py --runs 10 --json startup.json
+# Nothing contacts AWS; the sdk scenario only builds clients, which needs a region but no credentials
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPTS = ('sam-spade.py', 'sam-init.py', 'sam-list.py')
+JOB_FILE = os.path.join('examples', 'jobs.example.json')
+SDK_CODE = "from sam_toolbox.clients import get_client; get_client('ec2'); get_client('sts')"
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Benchmark the scripts' cold start with python -X importtime")
+    parser.add_argument('--runs', type=int, default=5, help="runs of every scenario, the median is reported (default 5)")
+    parser.add_argument('--json', metavar='FILE', help="also write the results to FILE as JSON")
+    return parser.parse_args()
+
+def scenarios():
+    for script in SCRIPTS:
+        yield f"{script} --help", [script, '--help']
+        yield f"{script} --check", [script, '--job', JOB_FILE, '--check']
+    yield "sdk clients", ['-c', SDK_CODE]
+
+# Runs one command in a fresh interpreter and returns (wall seconds, import seconds, modules imported)
+# -X importtime writes one line per module to stderr; the cumulative time of top level imports adds up to the total
+
+def run_once(arguments):
+    env = {**os.environ, 'AWS_DEFAULT_REGION': os.environ.get('AWS_DEFAULT_REGION', 'us-east-1')}
+    start = time.perf_counter()
+    process = subprocess.run([sys.executable, '-X', 'importtime', *arguments], cwd=REPO_DIR, env=env,
+                             stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    wall = time.perf_counter() - start
+
+    import_us = 0
+    modules = set()
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        modules.add(name.strip())
+        if not name.startswith('  '):  # Top level import, its cumulative time includes everything it imported
+            import_us += int(cumulative)
+    return wall, import_us / 1e6, modules
+
+def run_scenario(name, arguments, runs):
+    walls, imports = [], []
+    for _ in range(runs):
+        wall, import_seconds, modules = run_once(arguments)
+        walls.append(wall)
+        imports.append(import_seconds)
+    return {
+        'scenario': name,
+        'wall_ms': round(statistics.median(walls) * 1000, 1),
+        'import_ms': round(statistics.median(imports) * 1000, 1),
+        'modules': len(modules),
+        'boto3_loaded': 'boto3' in modules,
+    }
+
+def main():
+    args = parse_arguments()
+    print(f"{'Scenario':<24}{'Wall ms':>10}{'Import ms':>11}{'Modules':>9}  boto3")
+    results = []
+    for name, arguments in scenarios():
+        result = run_scenario(name, arguments, args.runs)
+        loaded = 'yes' if result['boto3_loaded'] else 'no'
+        print(f"{name:<24}{result['wall_ms']:>10.1f}{result['import_ms']:>11.1f}{result['modules']:>9}  {loaded}")
+        results.append(result)
+
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump({'python': sys.version.split()[0], 'runs': args.runs, 'results': results}, file, indent=2)
+        print(f"\nResults saved to {args.json}")
+
+if __name__ == "__main__":
+    main()
@@ -19,85 +19,19 @@
 #along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import sys
-import boto3
-from botocore.exceptions import NoCredentialsError, ClientError
-import time
-import csv
-import subprocess
-import json
-
-# Displays current AWS account and region information
-# You will need to upload the SAM toolkit in each region of Cloudshell
-
-def print_aws_account_info():
-    session = boto3.session.Session()
-    sts_client = session.client('sts')
-    try:
-        account_id = sts_client.get_caller_identity()["Account"]
-        region = session.region_name
-        print(f"AWS Account ID: {account_id}")
-        print(f"Region: {region}\n")
-    except NoCredentialsError:
-        print("No AWS credentials found. Please configure your AWS CLI.")
-        sys.exit(1)
-    except ClientError as e:
-        print(f"An error occurred: {e}")
-        sys.exit(1)
-
-# Uses AWS CLI commands to create a real-time list of EC2 instances
-# This function is scoped to the region and account and does not see global resources
-# Does not check if SSM is installed or configured on the instance
-        
-def create_instance_map():
-    ec2 = boto3.client('ec2')
-    instances = ec2.describe_instances(
-        Filters=[{'Name': 'instance-state-name', 'Values': ['pending', 'running', 'shutting-down', 'terminated', 'stopping', 'stopped']}]
-    )
-    statuses = ec2.describe_instance_status(IncludeAllInstances=True)
-
-    status_dict = {status['InstanceId']: status['InstanceState']['Code'] for status in statuses['InstanceStatuses']}
-    status_text = {0: 'pending', 16: 'running', 32: 'shutting-down', 48: 'terminated', 64: 'stopping', 80: 'stopped'}
-    status_color = {0: '\033[93m', 16: '\033[92m', 32: '\033[93m', 48: '\033[91m', 64: '\033[93m', 80: '\033[91m'}
-
-    instance_dict = {}
-    ref_number = 1
-    print("Available EC2 Instances:")
-
-    for reservation in instances['Reservations']:
-        for instance in reservation['Instances']:
-            instance_id = instance['InstanceId']
-            instance_name = next(
-                (tag['Value'] for tag in instance.get('Tags', []) if tag['Key'] == 'Name'),
-                'No Name Tag'
-            )
-            instance_status_code = status_dict.get(instance_id, None)
-            instance_status = status_text.get(instance_status_code, 'Unknown')
-            color = status_color.get(instance_status_code, '\033[0m')  # Default to no color if status unknown
-            print(f"{ref_number}. {color}{instance_status}\033[0m {instance_id} ({instance_name})")
-            instance_dict[instance_id] = (instance_name, instance_status)  # Store instance name and previous state
-            ref_number += 1
-
-    print(f"{ref_number}. Select All")
-    selected_refs = input("Enter the reference numbers of the instances to target, separated by commas, or select all: ")
-    
-    selected_instance_id_name_map = {}
-    if selected_refs.strip().lower() == str(ref_number):  # User selects all
-        return instance_dict
-    else:
-        selected_refs_list = selected_refs.split(',')
-        for i, (instance_id, instance_details) in enumerate(instance_dict.items(), start=1):
-            if str(i) in selected_refs_list:
-                selected_instance_id_name_map[instance_id] = instance_details
-     
-# To create custom scripts, comment out the entire section from here back to the beginning of this function, and uncomment the lines below
-# Add your specific instance ids to the map below, and the script will target them automatically each time without prompting
-# Instance name does not dynamically populate, but you can hard code the values here that you want to display on the screen or in the csv
-    # selected_instance_id_name_map = {
-    #     'i-05dfxxxxxxxxxxx44': ('Instance Name 1', 'Instance Previous State 1'),
-    #     'i-0d87ddxxxxxxxxxxx': ('Instance Name 2', 'Instance Previous State 2')
-    # }
-
-    return selected_instance_id_name_map
+import argparse
+from sam_toolbox.actions import iter_action_results
+from sam_toolbox.cache import add_cache_arguments, configure_cache
+from sam_toolbox.cli import exit_on_aws_errors, connect_targets, print_aws_account_info, create_instance_map
+from sam_toolbox.console import use_terminal
+from sam_toolbox.fanout import add_target_arguments
+from sam_toolbox.jobs import INIT_ACTIONS, add_job_arguments, load_jobs, job_rollout, job_targets, select_job_instances, forget_job_inventories
+from sam_toolbox.metrics import add_metrics_arguments, configure_metrics, phase, timer
+from sam_toolbox.rollout import add_rollout_arguments, rollout_settings
+from sam_toolbox.selection import add_selection_arguments
+from sam_toolbox.writers import add_format_arguments, format_path, open_writer, write_row, close_writer
+
+# Sending the action, monitoring the state changes and rolling out in waves are done by sam_toolbox.actions
 
 # Prompts to type which command to send
 #
@@ -139,115 +73,126 @@ def select_command():
         print("Invalid selection, please try again.")
         return None
 
-def execute_command(instance_id_name_map, action):
-    successful_instances = {}
-    action_map = {
-        'aws ec2 start-instances': 'starting',
-        'aws ec2 stop-instances': 'stopping',
-        'aws ec2 reboot-instances': 'rebooting'  # AWS CLI reboot command does not seem to work reliably
-    }
-    current_action = action_map.get(action, 'processing')
-
-    for instance_id, (instance_name, previous_state) in instance_id_name_map.items():
-        try:
-            # Construct the AWS CLI command
-            cli_command = f"{action} --instance-ids {instance_id}"
-            # Execute the AWS CLI command
-            process = subprocess.Popen(cli_command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            stdout, stderr = process.communicate()
-
-            if process.returncode == 0:
-                # Specific message for reboot action
-                if action == 'aws ec2 reboot-instances':
-                    print(f"Reboot command sent to {instance_name}. This script does not monitor for successful reboot completion.")
-                    new_state = 'Reboot command sent'  # Edit to change what is recorded as the current_state for reboots for CSV logging
-                else:
-                    # Command executed successfully for start and stop
-                    print(f"\033[92mCommand for {current_action} sent to {instance_name}.\033[0m")
-                    response = json.loads(stdout.decode('utf-8'))
-                    if 'StartingInstances' in response:
-                        new_state = response['StartingInstances'][0]['CurrentState']['Name']
-                    elif 'StoppingInstances' in response:
-                        new_state = response['StoppingInstances'][0]['CurrentState']['Name']
-                    else:
-                        new_state = 'unknown'
-                successful_instances[instance_id] = (instance_name, previous_state, new_state)
-            else:
-                # Command execution failed
-                print(f"\033[91mFailed to execute {current_action} command for {instance_id} ({instance_name}): {stderr.decode('utf-8')}\033[0m")
-        except Exception as e:
-            # Handle other exceptions
-            print(f"\033[91mAn unexpected error occurred while {current_action} {instance_id} ({instance_name}): {e}\033[0m")
-
-    return successful_instances
-
-def monitor_command_status_and_fetch_output(ec2_client, instance_ids, action):
-    # Define desired state mapping based on action
-    desired_state_map = {
-        'aws ec2 start-instances': 'running',
-        'aws ec2 stop-instances': 'stopped'
-    }
-
-    # No monitoring for reboot instances
-    if action == 'aws ec2 reboot-instances':
-        print("\nSkipping monitoring for reboot action as per script configuration.")
-        # Directly return the status without checking
-        return {instance_id: 'Reboot command sent' for instance_id in instance_ids}
-
-    desired_state = desired_state_map.get(action)
-    if desired_state:
-        print(f"\nMonitoring instances for reaching '{desired_state}' state...")
-        final_statuses = {}
-        for instance_id in instance_ids:
-            print(f"Checking status for instance ID: {instance_id}...")
-            while True:
-                response = ec2_client.describe_instances(InstanceIds=[instance_id])
-                current_state = response['Reservations'][0]['Instances'][0]['State']['Name']
-                print(f" - Instance ID {instance_id} is currently {current_state}")
-                if current_state == desired_state:
-                    print(f"\033[92m - Instance ID {instance_id} reached the '{desired_state}' state.\033[0m")
-                    final_statuses[instance_id] = desired_state
-                    break
-                else:
-                    time.sleep(10)  # Wait for ten seconds before checking again
-        return final_statuses
-    else:
-        # Return empty statuses if action does not require state monitoring
-        return {}
-
 # Init is designed to save the output with the same file name every time and overwrite any previous versions
 # Once you find the right command and scope for what you are trying to do, move the resulting init.csv file to 
 # preventing overwriting
+# Account and region columns are added when several targets were used
 
-def output_csv(instances_details):
-    # Define the CSV file name. Edit below to change the output file name
-    csv_file = "init.csv"
+def output_csv(action_results, include_targets=False, csv_file="init.csv", output_format='csv'):
+    # The CSV file name defaults to init.csv, edit the default above or set output in a job file to change it
+    # Other --format choices swap the extension, so init.csv becomes init.jsonl.gz
+    csv_file = format_path(csv_file, output_format)
 
     # Define the field names/order for the CSV file
     fieldnames = ['instance_id', 'instance_name', 'previous_state', 'current_state']
+    if include_targets:
+        fieldnames = ['account_id', 'region'] + fieldnames
 
-    # Open the CSV file for writing
-    with open(csv_file, mode='w', newline='') as file:
-        writer = csv.DictWriter(file, fieldnames=fieldnames)
-        
-        # Write the header row
-        writer.writeheader()
-        
-        # Iterate over the instances details and write each as a row in the CSV
-        for instance_id, details in instances_details.items():
-            instance_name, previous_state, current_state = details
-            writer.writerow({
-                'instance_id': instance_id, 
-                'instance_name': instance_name, 
-                'previous_state': previous_state, 
-                'current_state': current_state
-            })
+    # Open the report for writing, the header row is written with it
+    with timer('report writing'):
+        writer = open_writer(csv_file, fieldnames, output_format)
+        try:
+            # Write each instance's ActionResult as a row in the report
+            for result in action_results:
+                write_row(writer, result._asdict())
+        finally:
+            close_writer(writer)
     
     print(f"Data saved to {csv_file}")
 
+# Executes the action on the selected instances and monitors the status changes, in every target at the same time
+# Returns the ActionResults written to csv_file in selection order, or an empty list if no instance accepted the action
+
+def run_action_across_targets(targets, instance_id_name_map, instance_targets, action, csv_file="init.csv", target_workers=8,
+                              timeout=900, monitor_reboot=False, max_workers=4, batch_size=100, rollout=None, output_format='csv'):
+    results = {result.instance_id: result for result in iter_action_results(
+        targets, instance_id_name_map, instance_targets, action, target_workers, timeout, monitor_reboot, max_workers, batch_size, rollout)}
+    results = [results[instance_id] for instance_id in instance_id_name_map if instance_id in results]
+
+    if results:
+        # To disable the automatic saving of a csv file, comment out the line below
+        output_csv(results, len(targets) > 1, csv_file, output_format)  # Output the final statuses to a CSV file
+    return results
+
+# Runs every init job in a job file without prompting (see sam_toolbox.jobs for the format)
+# With check the file is only validated, so it can be tested without credentials or the AWS SDK being loaded
+# Exits with status 1 if the file is invalid or any job found no instances or processed none of them
+
+def run_jobs(path, cli_defaults, check=False):
+    try:
+        jobs, skipped = load_jobs(path, 'init', cli_defaults)
+    except ValueError as e:
+        print(f"\033[91m{e}\033[0m")
+        sys.exit(1)
+    for name in skipped:
+        print(f"Skipping job '{name}', it is not an init job")
+    if check:
+        print(f"\033[92m{path} is valid: {len(jobs)} init job(s)\033[0m")
+        return
+
+    memo = {}  # Targets and inventory shared between jobs
+    failed_jobs = []
+    for job in jobs:
+        print(f"\n=== Job '{job['name']}' ===")
+        concurrency = job['concurrency']
+        with phase('accounts'), exit_on_aws_errors():
+            targets = job_targets(job, memo)
+        print_aws_account_info(targets)
+        with phase('inventory'), exit_on_aws_errors():
+            instance_id_name_map, instance_targets = select_job_instances(job, targets, memo)
+        if not instance_id_name_map:
+            print("No instances matched the job's targets.")
+            failed_jobs.append(job['name'])
+            continue
+
+        with phase('action'):
+            results = run_action_across_targets(
+                targets, instance_id_name_map, instance_targets, INIT_ACTIONS[job['action']], job.get('output', 'init.csv'),
+                concurrency.get('target_workers', 8), job.get('timeout', 900), job.get('monitor_reboot', False),
+                concurrency.get('max_workers', 4), concurrency.get('batch_size', 100), job_rollout(job), job.get('format', 'csv'),
+            )
+        forget_job_inventories(memo)  # Later jobs must see the new states
+        if not results:
+            print("No instances were successfully processed.")
+            failed_jobs.append(job['name'])
+
+    if failed_jobs:
+        print(f"\033[91m{len(failed_jobs)} of {len(jobs)} job(s) did not complete: {', '.join(failed_jobs)}\033[0m")
+        sys.exit(1)
+
 def main():
-    print_aws_account_info()  # Print AWS account info at the start
-    instance_id_name_map = create_instance_map()  # Create a map of instance IDs to names and previous states
+    parser = argparse.ArgumentParser(description="Start, stop or reboot selected EC2 instances and log the actions taken to init.csv")
+    parser.add_argument('--timeout', type=int, default=900, metavar='SECONDS',
+                        help="stop waiting for instances to reach their new state after this many seconds (default 900)")
+    parser.add_argument('--monitor-reboot', action='store_true',
+                        help="wait for rebooted instances to go through their status checks and pass them again")
+    add_job_arguments(parser)
+    add_rollout_arguments(parser)
+    add_selection_arguments(parser)
+    add_format_arguments(parser)
+    add_target_arguments(parser)
+    add_cache_arguments(parser)
+    add_metrics_arguments(parser)
+    args = parser.parse_args()
+    use_terminal()
+    configure_cache(args)
+    configure_metrics(args, 'sam-init')
+
+    if args.job:
+        run_jobs(args.job, {'regions': args.regions, 'role_arns': args.role_arns, 'account_id': args.account_id, 'format': args.format}, args.check)
+        return
+
+    targets = connect_targets(args.regions, args.role_arns, args.account_id)  # Print AWS account info at the start
+    instance_id_name_map, instance_targets = create_instance_map(targets, args.target_workers, args.select)  # Create a map of instance IDs to names and previous states
+
+# To create custom scripts, comment out the line above and uncomment the lines below
+# Add your specific instance ids to the map below, and the script will target them automatically each time without prompting
+# Instance name does not dynamically populate, but you can hard code the values here that you want to display on the screen or in the csv
+    # instance_id_name_map = {
+    #     'i-05dfxxxxxxxxxxx44': ('Instance Name 1', 'Instance Previous State 1'),
+    #     'i-0d87ddxxxxxxxxxxx': ('Instance Name 2', 'Instance Previous State 2')
+    # }
+    # instance_targets = {}
 
     if not instance_id_name_map:
         print("No instances specified. Exiting...")
@@ -263,24 +208,13 @@ def main():
         # action = 'aws ec2 start-instances'
 
         if action != 'exit':
-            successful_instances = execute_command(instance_id_name_map, action)  # Execute the specified action on the selected instances
-
-            if successful_instances:
-                ec2_client = boto3.client('ec2')
-                # Pass only the instance IDs to monitor_command_status_and_fetch_output
-                instance_ids = list(successful_instances.keys())
-                final_statuses = monitor_command_status_and_fetch_output(ec2_client, instance_ids, action)  # Monitor the status changes of the instances
-
-                # Reformat instance details for CSV output (include previous and current states)
-                instances_details_for_csv = {
-                    inst_id: (
-                        instance_id_name_map[inst_id][0],  # Name
-                        instance_id_name_map[inst_id][1],  # Previous state
-                        final_statuses[inst_id]  # Current state from final_statuses
-                    ) for inst_id in final_statuses
-                }
-                # To disable the automatic saving of a csv file, comment out the line below
-                output_csv(instances_details_for_csv)  # Output the final statuses to a CSV file
+            # Execute the specified action on the selected instances and monitor the status changes, in every target at the same time
+            with phase('action'):
+                results = run_action_across_targets(targets, instance_id_name_map, instance_targets, action,
+                                                           target_workers=args.target_workers, timeout=args.timeout, monitor_reboot=args.monitor_reboot,
+                                                           rollout=rollout_settings(args.canary, args.max_concurrency, args.max_errors),
+                                                           output_format=args.format)
+            if results:
                 break
             else:
                 print("No instances were successfully processed.")
@@ -18,81 +18,30 @@
 #You should have received a copy of the GNU General Public License
 #along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import os
 import sys
-import boto3
-from botocore.exceptions import NoCredentialsError, ClientError
-import time
-import csv
-
-# Displays current AWS account and region information
-# You will need to upload the SAM toolkit in each region of Cloudshell you intend to use
-
-def print_aws_account_info():
-    session = boto3.session.Session()
-    sts_client = session.client('sts')
-    try:
-        account_id = sts_client.get_caller_identity()["Account"]
-        region = session.region_name
-        print(f"AWS Account ID: {account_id}")
-        print(f"Region: {region}\n")
-    except NoCredentialsError:
-        print("No AWS credentials found. Please configure your AWS CLI.")
-        sys.exit(1)
-    except ClientError as e:
-        print(f"An error occurred: {e}")
-        sys.exit(1)
-
-# Uses AWS CLI commands to create a real-time list of EC2 instances
-# This function is scoped to the region and account and does not see global resources
-        
-def create_instance_map():
-    ec2 = boto3.client('ec2')
-    instances = ec2.describe_instances(
-        Filters=[{'Name': 'instance-state-name', 'Values': ['running']}]
-    )
-
-    instance_dict = {}
-    ref_number = 1
-    print("Available EC2 Instances:")
-
-    for reservation in instances['Reservations']:
-        for instance in reservation['Instances']:
-            instance_id = instance['InstanceId']
-            instance_name = next(
-                (tag['Value'] for tag in instance.get('Tags', []) if tag['Key'] == 'Name'), # To use a different tag value, change the 'Name' to the key of the desired tag's key/value pair
-                'No Name Tag'
-            )
-            print(f"{ref_number}. {instance_id} ({instance_name})")
-            instance_dict[instance_id] = instance_name
-            ref_number += 1
-
-    print(f"{ref_number}. Select All")
-    selected_refs = input("Enter the reference numbers of the instances to target, separated by commas, or select all: ")
-    
-    selected_instance_id_name_map = {}
-    if selected_refs.strip().lower() == str(ref_number):  # User selects all
-        return instance_dict
-    else:
-        selected_refs_list = selected_refs.split(',')
-        for i, (instance_id, instance_name) in enumerate(instance_dict.items(), start=1):
-            if str(i) in selected_refs_list:
-                selected_instance_id_name_map[instance_id] = instance_name
-
-    return selected_instance_id_name_map
+import argparse
+from sam_toolbox.cache import add_cache_arguments, configure_cache
+from sam_toolbox.cli import STATE_COLOR, exit_on_aws_errors, connect_targets, print_aws_account_info, create_instance_map
+from sam_toolbox.console import use_terminal
+from sam_toolbox.filters import add_filter_arguments, parse_filters
+from sam_toolbox.fanout import add_target_arguments
+from sam_toolbox.index import add_index_arguments, open_index, index_targets, list_snapshots, query_index, index_changes, format_time
+from sam_toolbox.jobs import add_job_arguments, load_jobs, job_targets, select_job_instances
+from sam_toolbox.metrics import add_metrics_arguments, configure_metrics, phase, timer
+from sam_toolbox.report import VALUE_OPTIONS, VALUE_TYPES, MISSING_VALUE, collect_reports
+from sam_toolbox.selection import add_selection_arguments
+from sam_toolbox.watch import add_watch_arguments, watch_inventory
+from sam_toolbox.writers import add_format_arguments, format_path, open_writer, write_row, close_writer
+
+# Collecting the values is done by sam_toolbox.report, which also holds the list of values offered below, how list
+# values are flattened into one cell and which values the typed formats keep as timestamps or JSON
 
 # Prompts to select which parameters to collect
 
 def select_values():
-    options = [
-        "InstanceId", "ImageId", "InstanceType", "KeyName", "LaunchTime",
-        "Placement.AvailabilityZone", "Placement.Tenancy", "PrivateDnsName",
-        "PrivateIpAddress", "PublicDnsName", "PublicIpAddress", "State.Name",
-        "SubnetId", "VpcId", "SecurityGroups", "Tags", "Architecture",
-        "RootDeviceType", "RootDeviceName", "BlockDeviceMappings", 
-        "IamInstanceProfile.Arn", "VirtualizationType", "CpuOptions", 
-        "PlatformDetails"
-    ]
-    
+    options = VALUE_OPTIONS
+
     print("\nSelect the values to collect from the instances:")
     for i, option in enumerate(options, 1):
         print(f"{i}. {option}")
@@ -114,64 +63,174 @@ def select_values():
                 
     return value_map
 
-import boto3
+# Writes the collected ReportRecords, one row per instance
+# Account and region columns are added when several targets were used
 
-def create_report(value_map):
-    # Initialize a boto3 client
-    ec2 = boto3.client('ec2')
+def output_csv(reports, value_map, include_targets=False, csv_file="list.csv", output_format='csv'):
+    # The CSV file name defaults to list.csv, job files can choose their own
+    csv_file = format_path(csv_file, output_format)
+    fieldnames = ['account_id', 'region'] + value_map if include_targets else value_map
 
-    # Construct the query parameters to select only the required instance attributes
-    query = {'Filters': [{'Name': 'instance-state-name', 'Values': ['running']}]}
-    
-    # Call describe_instances with the query
-    response = ec2.describe_instances(**query)
-    
-    # Initialize a list to hold the instance data
-    instances_data = []
-
-    for reservation in response['Reservations']:
-        for instance in reservation['Instances']:
-            instance_data = {}
-            for value in value_map:
-                # For complex values like SecurityGroups, Tags, etc., aggregate their values
-                if value == "SecurityGroups":
-                    instance_data[value] = ','.join([sg['GroupName'] for sg in instance.get(value, [])])
-                elif value == "Tags":
-                    instance_data[value] = ','.join([f"{tag['Key']}={tag['Value']}" for tag in instance.get(value, [])])
-                elif value == "BlockDeviceMappings":
-                    instance_data[value] = ','.join([bdm['Ebs']['VolumeId'] for bdm in instance.get(value, []) if 'Ebs' in bdm])
-                elif value == "NetworkInterfaces":
-                    instance_data[value] = ','.join([ni['NetworkInterfaceId'] for ni in instance.get(value, [])])
-                else:
-                    # Directly copy the value for simple attributes
-                    instance_data[value] = instance.get(value, 'N/A')
-            instances_data.append(instance_data)
-    
-    return instances_data
+    # Open the report with dynamic fieldnames based on value_map
+    with timer('report writing'):
+        writer = open_writer(csv_file, fieldnames, output_format, VALUE_TYPES, null_marker=MISSING_VALUE)
+        try:
+            # Iterate over the collected reports and write each as a row in the report
+            for report in reports:
+                write_row(writer, {'account_id': report.account_id, 'region': report.region, **report.values})
+        finally:
+            close_writer(writer)
 
-def output_csv(instances_data, value_map):
-    # Define the CSV file name
-    csv_file = "list.csv"
-    
-    # Open the CSV file for writing
-    with open(csv_file, mode='w', newline='') as file:
-        # Initialize the CSV writer with dynamic fieldnames based on value_map
-        writer = csv.DictWriter(file, fieldnames=value_map)
-        
-        # Write the header row
-        writer.writeheader()
-        
-        # Iterate over the instances data and write each as a row in the CSV
-        for instance_data in instances_data:
-            writer.writerow(instance_data)
-    
     print(f"\033[92mData saved to {csv_file}\033[0m")
 
-def main():
-    print_aws_account_info()  # Display AWS account and region information
-    instance_id_name_map = create_instance_map()  # Let user select instances
+# Runs every list job in a job file without prompting (see sam_toolbox.jobs for the format)
+# With check the file is only validated, so it can be tested without credentials or the AWS SDK being loaded
+# Exits with status 1 if the file is invalid or any job collected no data
+
+def run_jobs(path, cli_defaults, check=False):
+    try:
+        jobs, skipped = load_jobs(path, 'list', cli_defaults)
+    except ValueError as e:
+        print(f"\033[91m{e}\033[0m")
+        sys.exit(1)
+    for name in skipped:
+        print(f"Skipping job '{name}', it is not a list job")
+    if check:
+        print(f"\033[92m{path} is valid: {len(jobs)} list job(s)\033[0m")
+        return
+
+    memo = {}  # Targets and inventory shared between jobs
+    failed_jobs = []
+    for job in jobs:
+        print(f"\n=== Job '{job['name']}' ===")
+        with phase('accounts'), exit_on_aws_errors():
+            targets = job_targets(job, memo)
+        print_aws_account_info(targets)
+        with phase('inventory'), exit_on_aws_errors():
+            inventory, instance_targets = select_job_instances(job, targets, memo, default_states=['running'])
+        with phase('report'):
+            reports = collect_reports(targets, inventory, instance_targets, job['values'],
+                                      target_workers=job['concurrency'].get('target_workers', 8))
+        if not reports:
+            print("No data collected from instances.")
+            failed_jobs.append(job['name'])
+            continue
+        output_csv(reports, job['values'], len(targets) > 1, job.get('output', 'list.csv'), job.get('format', 'csv'))
+
+    if failed_jobs:
+        print(f"\033[91m{len(failed_jobs)} of {len(jobs)} job(s) did not complete: {', '.join(failed_jobs)}\033[0m")
+        sys.exit(1)
+
+# Keeps watching every instance matching the filters and reports only what changes (see sam_toolbox.watch)
+# Instances are not selected, so new launches are picked up as they appear; only the values to watch are prompted for
+
+def watch_fleet(targets, args, filters, predicate):
+    value_map = select_values()
+    if not value_map:
+        print("No values selected. Exiting...")
+        sys.exit(1)
+    watch_inventory(targets, value_map, filters, predicate, args.watch, args.watch_full_every, args.watch_log, args.target_workers)
 
-    if not instance_id_name_map:
+# Saves a snapshot of every instance matching the filters, in every target, to the local index (see sam_toolbox.index)
+# Filtered snapshots hold only part of the inventory, so --query and --changes-since leave them out
+
+def index_fleet(targets, args, filters, predicate):
+    db = open_index(args.index_db)
+    try:
+        with phase('index'), exit_on_aws_errors():
+            counts = index_targets(db, targets, filters, predicate, args.target_workers, args.filters)
+    finally:
+        db.close()
+    for (account_id, region), count in counts.items():
+        print(f"Indexed {count} instance(s) in {account_id}/{region}")
+    if len(counts) < len(targets):
+        print(f"\033[91m{len(targets) - len(counts)} of {len(targets)} target(s) could not be indexed\033[0m")
+        sys.exit(1)
+    print(f"\033[92mSnapshot saved to {args.index_db}\033[0m")
+    if args.filters:
+        print("\033[93mThe snapshot is filtered: --snapshots lists it, but --query and --changes-since only use unfiltered snapshots\033[0m")
+
+# Answers --query, --snapshots and --changes-since from the local index
+
+def answer_from_index(args, parser):
+    if not os.path.exists(args.index_db):
+        print(f"\033[91mNo index found at {args.index_db}, create one with --index\033[0m")
+        sys.exit(1)
+    db = open_index(args.index_db)
+    try:
+        if args.snapshots:
+            for snapshot_id, taken_at, account_id, region, count, filters in list_snapshots(db):
+                filtered = f"  filtered: {' '.join(filters)}" if filters is not None else ''
+                print(f"{snapshot_id:>6}  {format_time(taken_at)}  {account_id}/{region}  {count} instance(s){filtered}")
+        elif args.changes_since:
+            print_index_changes(index_changes(db, args.changes_since))
+        else:
+            try:
+                rows = query_index(db, args.filters, args.as_of)
+            except ValueError as e:
+                parser.error(str(e))
+            print_index_rows(rows)
+    finally:
+        db.close()
+
+def print_index_rows(rows):
+    for row in rows:
+        color = STATE_COLOR.get(row['state'], '')
+        print(f"{row['account_id']}/{row['region']}  {row['instance_id']}  {row['name']:<30} {color}{row['state']:<10}\033[0m "
+              f"{row['instance_type'] or '':<12} {row['image_id'] or '':<22} {row['subnet_id'] or '':<25} {row['private_ip'] or ''}")
+    taken = {format_time(row['taken_at']) for row in rows}
+    print(f"{len(rows)} instance(s)" + (f", indexed {', '.join(sorted(taken))}" if taken else ''))
+
+def print_index_changes(changes):
+    for row in changes['added']:
+        print(f"\033[92m+ {row['instance_id']} ({row['name']}) in {row['account_id']}/{row['region']}: {row['state']}\033[0m")
+    for row in changes['removed']:
+        print(f"\033[91m- {row['instance_id']} ({row['name']}) in {row['account_id']}/{row['region']}\033[0m")
+    for row in changes['changed']:
+        details = ', '.join(f"{column} {old} -> {new}" for column, (old, new) in row['changes'].items())
+        print(f"\033[93m~ {row['instance_id']} ({row['name']}) in {row['account_id']}/{row['region']}: {details}\033[0m")
+    print(f"{len(changes['added'])} added, {len(changes['removed'])} removed, {len(changes['changed'])} changed")
+
+def main():
+    parser = argparse.ArgumentParser(description="Save a CSV report (list.csv) of selected metadata for selected EC2 instances")
+    add_job_arguments(parser)
+    add_filter_arguments(parser)
+    add_selection_arguments(parser)
+    add_watch_arguments(parser)
+    add_index_arguments(parser)
+    add_format_arguments(parser)
+    add_target_arguments(parser)
+    add_cache_arguments(parser)
+    add_metrics_arguments(parser)
+    args = parser.parse_args()
+    use_terminal()
+    configure_cache(args)
+    configure_metrics(args, 'sam-list')
+    if args.query or args.snapshots or args.changes_since:
+        answer_from_index(args, parser)  # The local index only, nothing is fetched from AWS
+        return
+    try:
+        filters, predicate = parse_filters(args.filters)
+    except ValueError as e:
+        parser.error(str(e))
+
+    if args.job:
+        run_jobs(args.job, {'regions': args.regions, 'role_arns': args.role_arns, 'account_id': args.account_id, 'format': args.format}, args.check)
+        return
+
+    targets = connect_targets(args.regions, args.role_arns, args.account_id)  # Display AWS account and region information
+    if args.watch:
+        watch_fleet(targets, args, filters, predicate)
+        return
+    if args.index:
+        index_fleet(targets, args, filters, predicate)
+        return
+
+    # Let user select among the running instances; with --filter expressions only the matching instances are downloaded and listed
+    instance_map, instance_targets = create_instance_map(targets, args.target_workers, args.select, show_state=False,
+                                                         states=['running'], tag_key='Name', filters=filters, predicate=predicate)
+
+    if not instance_map:
         print("No instances selected. Exiting...")
         sys.exit(1)
 
@@ -181,14 +240,15 @@ def main():
         print("No values selected. Exiting...")
         sys.exit(1)
 
-    # Collect data based on selected instances and values
-    instances_data = create_report(value_map)
-    if not instances_data:
+    # Collect data based on selected instances and values, from every target at the same time
+    with phase('report'):
+        reports = collect_reports(targets, instance_map, instance_targets, value_map, filters, predicate, args.target_workers)
+    if not reports:
         print("No data collected from instances. Exiting...")
         sys.exit(1)
 
-    # Output the collected data to a CSV file
-    output_csv(instances_data, value_map)
+    # Output the collected data to a CSV file, or the chosen --format
+    output_csv(reports, value_map, len(targets) > 1, output_format=args.format)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -19,75 +19,29 @@
 #along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import sys
-import boto3
-from botocore.exceptions import NoCredentialsError, ClientError
 import time
-import csv
-
-# Displays current AWS account and region information
-# You will need to upload the SAM toolkit in each region of Cloudshell you intend to use
-
-def print_aws_account_info():
-    session = boto3.session.Session()
-    sts_client = session.client('sts')
-    try:
-        account_id = sts_client.get_caller_identity()["Account"]
-        region = session.region_name
-        print(f"AWS Account ID: {account_id}")
-        print(f"Region: {region}\n")
-    except NoCredentialsError:
-        print("No AWS credentials found. Please configure your AWS CLI.")
-        sys.exit(1)
-    except ClientError as e:
-        print(f"An error occurred: {e}")
-        sys.exit(1)
-
-# Uses AWS CLI commands to create a real-time list of EC2 instances
-# This function is scoped to the region and account and does not see global resources
-# Does not check if SSM is installed or configured on the instance
-        
-def create_instance_map():
-    ec2 = boto3.client('ec2')
-    instances = ec2.describe_instances(
-        Filters=[{'Name': 'instance-state-name', 'Values': ['pending', 'running', 'shutting-down', 'terminated', 'stopping', 'stopped']}]
-    )
-    statuses = ec2.describe_instance_status(IncludeAllInstances=True)
-
-    status_dict = {status['InstanceId']: status['InstanceState']['Code'] for status in statuses['InstanceStatuses']}
-    status_text = {0: 'pending', 16: 'running', 32: 'shutting-down', 48: 'terminated', 64: 'stopping', 80: 'stopped'}
-    status_color = {0: '\033[93m', 16: '\033[92m', 32: '\033[93m', 48: '\033[91m', 64: '\033[93m', 80: '\033[91m'}
-
-    instance_dict = {}
-    ref_number = 1
-    print("Available EC2 Instances:")
-
-    for reservation in instances['Reservations']:
-        for instance in reservation['Instances']:
-            instance_id = instance['InstanceId']
-            instance_name = next(
-                (tag['Value'] for tag in instance.get('Tags', []) if tag['Key'] == 'Name'),
-                'No Name Tag'
-            )
-            instance_status_code = status_dict.get(instance_id, None)
-            instance_status = status_text.get(instance_status_code, 'Unknown')
-            color = status_color.get(instance_status_code, '\033[0m')  # Default to no color if status unknown
-            print(f"{ref_number}. {color}{instance_status}\033[0m {instance_id} ({instance_name})")
-            instance_dict[instance_id] = instance_name
-            ref_number += 1
-
-    print(f"{ref_number}. Select All")
-    selected_refs = input("Enter the reference numbers of the instances to target, separated by commas, or select all: ")
-    
-    selected_instance_id_name_map = {}
-    if selected_refs.strip().lower() == str(ref_number):  # User selects all
-        return instance_dict
-    else:
-        selected_refs_list = selected_refs.split(',')
-        for i, (instance_id, instance_name) in enumerate(instance_dict.items(), start=1):
-            if str(i) in selected_refs_list:
-                selected_instance_id_name_map[instance_id] = instance_name
-
-    return selected_instance_id_name_map
+import argparse
+import threading
+from sam_toolbox.cache import add_cache_arguments, configure_cache
+from sam_toolbox.cli import exit_on_aws_errors, connect_targets, print_aws_account_info, create_instance_map
+from sam_toolbox.clients import get_client
+from sam_toolbox.commands import filter_ready_targets, iter_command_results, monitor_command_status_and_fetch_output, recover_unjournaled_commands
+from sam_toolbox.console import use_terminal, say
+from sam_toolbox.fanout import add_target_arguments, build_targets, target_label, iter_across_targets
+from sam_toolbox.grouping import (add_grouping_arguments, groups_path, group_log_path, diff_path, group_results, append_group_log, finish_groups,
+                                  load_groups, load_run_groups, print_group_summary, diff_groups, report_diff)
+from sam_toolbox.jobs import add_job_arguments, load_jobs, job_regions, job_rollout, job_targets, select_job_instances
+from sam_toolbox.metrics import add_metrics_arguments, configure_metrics, phase, timer
+from sam_toolbox.journal import add_journal_arguments, start_journal, open_journal, close_journal, record, last_run_id, load_journal
+from sam_toolbox.output_store import add_output_store_arguments, default_output_dir, open_output_store
+from sam_toolbox.records import with_target
+from sam_toolbox.rollout import add_rollout_arguments, rollout_settings
+from sam_toolbox.selection import add_selection_arguments
+from sam_toolbox.writers import add_format_arguments, format_path, open_writer, write_row, sync_writer, close_writer, can_append, read_column
+
+# Checking SSM readiness, sending the command in batches or through a rollout and monitoring the invocations are done
+# by sam_toolbox.commands, which yields a CommandResult as each instance finishes. This script prompts for the
+# command, writes the results and keeps the run journal
 
 # Prompts to type which command to send
 #
@@ -102,169 +56,322 @@ def select_command():
         print("Action canceled by user")
         return None
 
-# Checks if the instance is available for commands before sending
-# Instances may not be available if they do not have SSM installed, are in a hung state
-# or if the Cloudshell user does not have the appropriate permissions to access the SSM functions
-
-def filter_ssm_ready_instances(instance_id_name_map):
-    ssm = boto3.client('ssm')
-    ssm_ready_instance_ids = set()
-
-    paginator = ssm.get_paginator('describe_instance_information')
-    page_iterator = paginator.paginate()
-    
-    for page in page_iterator:
-        for instance_info in page['InstanceInformationList']:
-            if instance_info['InstanceId'] in instance_id_name_map:
-                ssm_ready_instance_ids.add(instance_info['InstanceId'])
-
-    valid_instance_id_name_map = {id: name for id, name in instance_id_name_map.items() if id in ssm_ready_instance_ids}
-    
-    if not valid_instance_id_name_map:
-        print("No valid SSM-ready instances found. Exiting...")
-        sys.exit(1)
-    
-    return valid_instance_id_name_map
-
-# Takes the command selected in the select_command() function and sends it to the instances selected
-# 
-# To create custom modules, replace the select_command() function with your desired command structure
-# or workflow, and have the new function return the [command] parameter. The function below will execute the
-# command on your desired endpoint
-#
-# WARNING: Only use execute_command() for modules designed to interact with the instances' OS, not for
-# modules which interact with the AWS API
-
-def execute_command(instance_id_name_map, command):
-    ssm = boto3.client('ssm')
-    successful_instances = {}
-    command_ids = {}
-    for instance_id, instance_name in instance_id_name_map.items():
-        try:
-            response = ssm.send_command(
-                InstanceIds=[instance_id],
-                DocumentName="AWS-RunShellScript",
-                Parameters={'commands': [command]},  # Here we use the command passed to the function
-            )
-            command_id = response['Command']['CommandId']
-            print(f"Command sent to {instance_id} ({instance_name})")
-            successful_instances[instance_id] = instance_name
-            command_ids[instance_id] = command_id
-        except ClientError as e:
-            error_code = e.response['Error']['Code']
-            if error_code == 'InvalidInstanceId':
-                print(f"\033[91m{instance_id} ({instance_name}) is not eligible for commands.\033[0m")
-            else:
-                print(f"\033[91mAn error occurred while executing the command on {instance_id} ({instance_name}): {e}\033[0m")
-    return successful_instances, command_ids
-
-# Handles the sessions and data flow from the target instances
-# The ideal retry and sleep values will depend on your environment, but if you receive 'InvocationDoesNotExist' errors
-# you should consider increasing the delays
-
-def monitor_command_status_and_fetch_output(ssm_client, command_id, instance_id, instance_name):
-    waiting_statuses = ['Pending', 'InProgress', 'Delayed']
-    completed_statuses = ['Success', 'Cancelled', 'Failed', 'TimedOut', 'Cancelling']
-    
-    print(f"\nMonitoring command execution status for {instance_id} ({instance_name})...")
-    retries = 0
-    max_retries = 5  # Maximum number of retries
-    retry_delay = 5  # Delay between retries in seconds
-    command_results = []  # Initialize an empty list to hold the command results for CSV output
-
-    while True:
-        try:
-            invocation_response = ssm_client.get_command_invocation(
-                CommandId=command_id,
-                InstanceId=instance_id,
-            )
-            status = invocation_response['Status']
-            if status in completed_statuses:
-                print(f"{instance_id} ({instance_name}) command status: {status}")
-                if status == 'Success':
-                    print(f"\033[92mOutput for {instance_id} ({instance_name}):\033[0m\n{invocation_response['StandardOutputContent']}\n")
-                
-# To create custom modules, modify which portions of the invocation_response are filtered. Here, we only return the StandardOutputContent
-# The full invocation_response value can be see by swapping the commented lines within this function
-                command_results.append({
-                    "instance_id": instance_id,
-                    "instance_name": instance_name,
-                    "invocation_response": invocation_response['StandardOutputContent']  # Save only the StandardOutputContent
-                    #"invocation_response": invocation_response,  # Save full invocation_response output
-                })
-                break  # Exit the loop once status is in completed_statuses
-            else:
-                print(f"{instance_id} ({instance_name}) {status}...")
-        except ssm_client.exceptions.InvocationDoesNotExist as e:
-            if retries < max_retries:
-                print(f"Waiting for command invocation to be registered for {instance_id} ({instance_name})...")
-                time.sleep(retry_delay)
-                retries += 1
-                continue
-            else:
-                print(f"Error getting command invocation for {instance_id} ({instance_name}) after retries: {e}")
-                break  # Exit the loop after exceeding retry attempts
-        except ClientError as e:
-            print(f"Error getting command invocation for {instance_id} ({instance_name}): {e}")
-            break  # Exit the loop on error
-        time.sleep(10)
-    
-    return command_results  # Return the list containing command results for further processing
-
 # Spade is designed to save the output with the same file name every time and overwrite any previous versions
 # Once you find the right command and scope for what you are trying to do, move the resulting spade.csv file to 
 # preventing overwriting
-
-def output_csv(command_results):
-    # Define the CSV file name
-    csv_file = "spade.csv"
-    
+#
+# command_results are CommandResults (see sam_toolbox.records). Results are written row by row as each instance
+# completes, so only one instance's output is held in memory at a time. The file is flushed to disk every flush_every rows or flush_interval seconds, whichever comes first, so an
+# interrupted run keeps every row collected up to that point
+# With several account/region targets the rows from all of them go into the same file with account and region columns
+# With a run journal the instances are recorded as written each time the file is synced. Resumed runs append to the
+# file the interrupted run was writing
+# output_format picks another report format such as jsonl.gz or parquet (see sam_toolbox.writers); Parquet files are
+# only complete once closed, so their rows are journaled as written at the end
+# With groups (see sam_toolbox.grouping) each row holds the output's hash instead of the output. The unique outputs are
+# saved to groups_file when the report is closed, and logged next to it each time the report is synced
+
+# Column types kept by the typed formats. To save the full invocation_response dict, also set it to 'json' here
+SPADE_COLUMN_TYPES = {'response_code': 'int'}
+
+def output_csv(command_results, include_targets=False, csv_file="spade.csv", flush_every=25, flush_interval=5, journal=None, append=False,
+               include_files=False, output_format='csv', groups=None, groups_file=None):
+    # The CSV file name defaults to spade.csv, job files can choose their own
     # Define the field names/order for the CSV file
-    fieldnames = ['instance_id', 'instance_name', 'invocation_response']
-
-    # Open the CSV file for writing
-    with open(csv_file, mode='w', newline='') as file:
-        writer = csv.DictWriter(file, fieldnames=fieldnames)
-        
-        # Write the header row
-        writer.writeheader()
-        
-        # Iterate over the command results and write each as a row in the CSV
+    fieldnames = ['instance_id', 'instance_name', 'invocation_response', 'status', 'response_code', 'standard_error']
+    pending_groups = []  # Grouped since the last sync, appended to the group log at the next one
+    if groups is not None:
+        fieldnames = ['instance_id', 'instance_name', 'status', 'response_code', 'output_hash']  # Outputs go to the groups file
+        command_results = group_results(command_results, groups, pending_groups)
+    if include_files:
+        fieldnames += ['output_file', 'error_file']  # Full outputs saved from the output store
+    if include_targets:
+        fieldnames = ['account_id', 'region'] + fieldnames
+    row_count = 0
+    unsynced_ids = []  # Written since the last sync, recorded in the journal once they are on disk
+
+    # Open the report for writing
+    writer = open_writer(csv_file, fieldnames, output_format, SPADE_COLUMN_TYPES, append=append and can_append(output_format))
+    last_flush = time.monotonic()
+
+    # Write each command result as a row as soon as it arrives
+    try:
         for result in command_results:
-            result['invocation_response'] = str(result['invocation_response'])
-            writer.writerow(result)
-    
-    print(f"Data saved to {csv_file}")
+            with timer('report writing'):
+                write_row(writer, result._asdict())
+                unsynced_ids.append(result.instance_id)
+                row_count += 1
+                if row_count % flush_every == 0 or time.monotonic() - last_flush >= flush_interval:
+                    if groups is not None:
+                        append_group_log(pending_groups, group_log_path(groups_file))  # Before the rows, so every journaled row has its output saved
+                    sync_report(writer, journal, unsynced_ids)
+                    last_flush = time.monotonic()
+    finally:
+        with timer('report writing'):
+            if groups is not None:
+                finish_groups(groups, groups_file)
+            close_writer(writer)  # Also keeps the rows written before an interruption
+            record_written(journal, unsynced_ids)
+
+    if row_count:
+        print(f"Data saved to {csv_file}")
+    return row_count
+
+def sync_report(writer, journal, unsynced_ids):
+    if sync_writer(writer):
+        record_written(journal, unsynced_ids)
+
+def record_written(journal, unsynced_ids):
+    if unsynced_ids:
+        record(journal, 'written', sync=True, instance_ids=list(unsynced_ids))
+        unsynced_ids.clear()
+
+# Executes the command on the ready instances and monitors them, in every target at the same time, streaming the
+# results into csv_file. Returns the number of rows written
+# The run is journaled so it can be resumed with --resume; regions and role_arns are recorded to rebuild the targets
+# With rollout settings (see sam_toolbox.rollout) each target rolls the command out through its own window
+# With an output store URL the full outputs are saved under output_dir (see sam_toolbox.output_store)
+# output_format writes another report format, swapping the extension of csv_file for it
+# With group the outputs are grouped (see sam_toolbox.grouping), and with previous_groups, (file, groups) loaded from an
+# earlier grouped run, the instances whose output changed since are reported
+
+def run_command_across_targets(targets, ready_maps, command, csv_file="spade.csv", target_workers=8, max_workers=8, batch_size=50, regions=None, role_arns=None,
+                               rollout=None, output_store=None, output_dir=None, output_format='csv', group=False, previous_groups=None):
+    csv_file = format_path(csv_file, output_format)
+    output_dir = output_dir or default_output_dir(csv_file)
+    groups = {} if group or previous_groups else None
+
+    include_targets = len(targets) > 1
+    journal = start_journal(command, csv_file, include_targets, regions, role_arns, output_store, output_dir, output_format, groups is not None)
+    for label, ready_map in ready_maps.items():
+        record(journal, 'selected', sync=True, target=label, instances=ready_map)
+    command_results = iter_command_results(targets, ready_maps, command, target_workers, max_workers, batch_size, rollout,
+                                           output_store, output_dir, journal)
+    try:
+        row_count = output_csv(command_results, include_targets, csv_file, journal=journal, include_files=bool(output_store),
+                               output_format=output_format, groups=groups, groups_file=groups_path(csv_file))  # Stream results to the report as each instance completes
+        record(journal, 'finished', sync=True)
+    finally:
+        close_journal(journal)
+    report_groups(groups, csv_file, previous_groups)
+    return row_count
+
+# Prints the unique outputs of a grouped run and, given a previous run's (file, groups), what changed since
+
+def report_groups(groups, csv_file, previous_groups=None):
+    if not groups:
+        return
+    print_group_summary(groups)
+    say(f"Unique outputs saved to {groups_path(csv_file)}")
+    if previous_groups:
+        previous_file, previous = previous_groups
+        report_diff(diff_groups(previous, groups), diff_path(csv_file), previous_file)
+
+# Loads the groups of the run named by --diff or a job's diff, exiting if it was not grouped
+
+def load_previous_groups(path):
+    if not path:
+        return None
+    try:
+        return path, load_groups(path)
+    except ValueError as e:
+        print(f"\033[91m{e}\033[0m")
+        sys.exit(1)
+
+# Picks up an interrupted run from its journal without sending the command again
+# Instances whose output was already written are skipped. The others are re-attached to the invocations they were
+# sent, and their results are appended to the run's output file. Commands sent just before a disconnect, which the
+# journal may not have recorded, are recovered from the SSM command history by the run id in their comment
+# Instances the command never reached are reported but not sent to, since that needs a new run
+# Parquet files cannot be appended to, so a resumed Parquet run writes its rows to a new file next to the first one
+# Returns the number of rows written
+
+def resume_run(run_id, target_workers=8, max_workers=8, account_id=None):
+    state = load_journal(run_id)
+    run = state['run']
+    output_format = run.get('output_format', 'csv')
+    say(f"Resuming run {run_id}: {run['command']}")
+    state['written'].update(written_instance_ids(run['csv_file'], output_format))  # Rows that reached the file after the last sync
+    report_file = run['csv_file'] if can_append(output_format) else resumed_report_file(run['csv_file'], output_format)
+    groups = None
+    if run.get('grouped'):  # Carry on with the outputs the interrupted run grouped
+        groups = load_run_groups(groups_path(run['csv_file']))
+    with exit_on_aws_errors():
+        targets = build_targets(run['regions'], run['role_arns'], account_id)
+    run_targets = [target for target in targets if target_label(target) in set(state['targets'].values())]
+    stop = threading.Event()  # Ends every target's monitoring if the run stops early
+
+    def run_target(target):
+        label = target_label(target)
+        ssm_client = get_client('ssm', target['session'])
+        instance_ids = [instance_id for instance_id, instance_label in state['targets'].items() if instance_label == label]
+        if any(instance_id not in state['sent'] for instance_id in instance_ids):
+            recovered = recover_unjournaled_commands(ssm_client, run_id, run['started_at'])
+            for instance_id, command_id in recovered.items():
+                if instance_id in instance_ids and instance_id not in state['sent']:
+                    state['sent'][instance_id] = command_id
+                    record(journal, 'sent', sync=True, target=label, command_id=command_id, instance_ids=[instance_id])
+
+        never_sent = [instance_id for instance_id in instance_ids if instance_id not in state['sent']]
+        if never_sent:
+            say(f"{len(never_sent)} instance(s) in {label} never received the command and are left out: {', '.join(never_sent)}", 'yellow')
+        command_ids = {instance_id: state['sent'][instance_id] for instance_id in instance_ids
+                       if instance_id in state['sent'] and instance_id not in state['written']}
+        if command_ids:
+            say(f"Collecting {len(command_ids)} missing result(s) in {label}")
+            names = {instance_id: state['names'][instance_id] for instance_id in command_ids}
+            store = open_output_store(run['output_store'], run['output_dir'], target['session']) if run.get('output_store') else None
+            yield from monitor_command_status_and_fetch_output(ssm_client, command_ids, names, max_workers, journal=journal, store=store, stop=stop)
+
+    missing_labels = set(state['targets'].values()) - {target_label(target) for target in run_targets}
+    for label in sorted(missing_labels):
+        say(f"Cannot reach {label} with the current credentials, its results are left out", 'red')
+
+    include_targets = run['include_targets']
+    journal = open_journal(run_id)
+    record(journal, 'resumed', sync=True)
+    command_results = (with_target(result, target) for target, result in iter_across_targets(run_targets, run_target, target_workers, stop))
+    try:
+        row_count = output_csv(command_results, include_targets, report_file, journal=journal, append=True, include_files=bool(run.get('output_store')),
+                               output_format=output_format, groups=groups, groups_file=groups_path(run['csv_file']))
+        record(journal, 'finished', sync=True)
+    finally:
+        close_journal(journal)
+    if row_count:
+        report_groups(groups, run['csv_file'])
+    return row_count
+
+# Returns the instance ids already in an output file, or none if it is missing
+
+def written_instance_ids(csv_file, output_format='csv'):
+    return {instance_id for instance_id in read_column(csv_file, output_format, 'instance_id') if instance_id}
+
+# Returns a file name for the rows of a resumed run that cannot go into the original file, such as
+# spade-resumed-20240611-093000.parquet
+
+def resumed_report_file(csv_file, output_format):
+    base = csv_file[:-len(f".{output_format}")] if csv_file.endswith(f".{output_format}") else csv_file
+    return f"{base}-resumed-{time.strftime('%Y%m%d-%H%M%S')}.{output_format}"
+
+# Runs every spade job in a job file without prompting (see sam_toolbox.jobs for the format)
+# With check the file is only validated, so it can be tested without credentials or the AWS SDK being loaded
+# Exits with status 1 if the file is invalid or any job found no instances or produced no output
+
+def run_jobs(path, cli_defaults, check=False):
+    try:
+        jobs, skipped = load_jobs(path, 'spade', cli_defaults)
+    except ValueError as e:
+        print(f"\033[91m{e}\033[0m")
+        sys.exit(1)
+    for name in skipped:
+        print(f"Skipping job '{name}', it is not a spade job")
+    if check:
+        print(f"\033[92m{path} is valid: {len(jobs)} spade job(s)\033[0m")
+        return
+
+    memo = {}  # Targets and inventory shared between jobs
+    failed_jobs = []
+    for job in jobs:
+        print(f"\n=== Job '{job['name']}' ===")
+        concurrency = job['concurrency']
+        with phase('accounts'), exit_on_aws_errors():
+            targets = job_targets(job, memo)
+        print_aws_account_info(targets)
+        with phase('inventory'), exit_on_aws_errors():
+            inventory, instance_targets = select_job_instances(job, targets, memo)
+        instance_id_name_map = {instance_id: name for instance_id, (name, state) in inventory.items()}
+        if not instance_id_name_map:
+            print("No instances matched the job's targets.")
+            failed_jobs.append(job['name'])
+            continue
+
+        with phase('ssm readiness'):
+            ready_maps = filter_ready_targets(targets, instance_id_name_map, instance_targets, concurrency.get('target_workers', 8))
+        if not ready_maps:
+            print("No valid SSM-ready instances found.")
+            failed_jobs.append(job['name'])
+            continue
+
+        with phase('run'):
+            row_count = run_command_across_targets(
+                targets, ready_maps, job['command'], job.get('output', 'spade.csv'),
+                concurrency.get('target_workers', 8), concurrency.get('max_workers', 8), concurrency.get('batch_size', 50),
+                job_regions(job), job.get('role_arns'), job_rollout(job), job.get('output_store'), output_format=job.get('format', 'csv'),
+                group=job.get('group', False), previous_groups=load_previous_groups(job.get('diff')),
+            )
+        if not row_count:
+            print("No commands were successfully sent to instances or no output to save.")
+            failed_jobs.append(job['name'])
+
+    if failed_jobs:
+        print(f"\033[91m{len(failed_jobs)} of {len(jobs)} job(s) did not complete: {', '.join(failed_jobs)}\033[0m")
+        sys.exit(1)
 
 def main():
-    print_aws_account_info()
-    instance_id_name_map = create_instance_map()
+    parser = argparse.ArgumentParser(description="Send a shell command to selected EC2 instances through SSM and save the output to spade.csv")
+    add_job_arguments(parser)
+    add_journal_arguments(parser)
+    add_output_store_arguments(parser)
+    add_grouping_arguments(parser)
+    add_format_arguments(parser)
+    add_rollout_arguments(parser)
+    add_selection_arguments(parser)
+    add_target_arguments(parser)
+    add_cache_arguments(parser)
+    add_metrics_arguments(parser)
+    args = parser.parse_args()
+    use_terminal()
+    configure_cache(args)
+    configure_metrics(args, 'sam-spade')
+
+    if args.job:
+        run_jobs(args.job, {'regions': args.regions, 'role_arns': args.role_arns, 'account_id': args.account_id, 'format': args.format}, args.check)
+        return
+
+    if args.resume:
+        run_id = last_run_id() if args.resume == 'last' else args.resume
+        if run_id is None:
+            print("\033[91mNo runs have been journaled yet\033[0m")
+            sys.exit(1)
+        try:
+            with phase('resume'):
+                row_count = resume_run(run_id, args.target_workers, account_id=args.account_id)
+        except ValueError as e:
+            print(f"\033[91m{e}\033[0m")
+            sys.exit(1)
+        print(f"Collected {row_count} missing result(s)")
+        return
+
+    # Does not check if SSM is installed or configured on the instances, which the readiness check below does
+    targets = connect_targets(args.regions, args.role_arns, args.account_id)
+    instance_map, instance_targets = create_instance_map(targets, args.target_workers, args.select)
+    instance_id_name_map = {instance_id: name for instance_id, (name, state) in instance_map.items()}
 
     if not instance_id_name_map:
         print("No instances specified. Exiting...")
         sys.exit(1)
+    previous_groups = load_previous_groups(args.diff)  # Before anything is sent, in case the previous run cannot be read
+
+    # Leave out instances that cannot receive SSM commands, checking every target concurrently
+    with phase('ssm readiness'):
+        ready_maps = filter_ready_targets(targets, instance_id_name_map, instance_targets, args.target_workers)
+    if not ready_maps:
+        print("No valid SSM-ready instances found. Exiting...")
+        sys.exit(1)
 
     # Prompt the user for the command to send
     command = select_command()
     if command is None:  # Check if the user canceled the action
         sys.exit(1)  # Exit if the user decided not to send a command
 
-    # Execute the command on specified instances
-    successful_instances, command_ids = execute_command(instance_id_name_map, command)
-    
-    all_command_results = []  # List to aggregate results from all instances
-    
-    if successful_instances:
-        print("\nSending command to selected instances...")
-        ssm_client = boto3.client('ssm')
-        for instance_id, command_id in command_ids.items():
-            instance_name = successful_instances[instance_id]
-            command_results = monitor_command_status_and_fetch_output(ssm_client, command_id, instance_id, instance_name)
-            all_command_results.extend(command_results)  # Aggregate results
-
-    if all_command_results:
-        output_csv(all_command_results)  # Write results to CSV
-    else:
+    # Execute the command on specified instances and monitor them, in every target at the same time
+    with phase('run'):
+        row_count = run_command_across_targets(targets, ready_maps, command, target_workers=args.target_workers, regions=args.regions,
+                                              role_arns=args.role_arns, rollout=rollout_settings(args.canary, args.max_concurrency, args.max_errors),
+                                              output_store=args.output_store, output_dir=args.output_dir, output_format=args.format,
+                                              group=args.group, previous_groups=previous_groups)
+
+    if not row_count:
         print("No commands were successfully sent to instances or no output to save.")
 
 if __name__ == "__main__":
@@ -0,0 +1,19 @@
+#Simple AWS Manager (SAM) Toolbox is a set of lightweight scripts and modules for sysadmins in AWS
+#Copyright (C) 2024 Newton Advisory, LLC
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Shared building blocks for the SAM scripts. Upload this folder next to the sam-*.py scripts so they can import it
+# The stages of the scripts can also be imported by other programs: see sam_toolbox.commands (sam-spade),
+# sam_toolbox.actions (sam-init), sam_toolbox.report (sam-list) and the records they return in sam_toolbox.records
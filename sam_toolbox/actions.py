@@ -0,0 +1,308 @@
+#Simple AWS Manager (SAM) Toolbox is a set of lightweight scripts and modules for sysadmins in AWS
+#Copyright (C) 2024 Newton Advisory, LLC
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from sam_toolbox.clients import get_client
+from sam_toolbox.console import say
+from sam_toolbox.fanout import target_label, iter_across_targets, split_by_target
+from sam_toolbox.inventory import iter_instances_by_id, forget_inventory
+from sam_toolbox.metrics import timer
+from sam_toolbox.records import ActionResult, with_target
+from sam_toolbox.rollout import new_rollout, release, finish, has_work, skipped_ids
+from sam_toolbox.throttle import new_throttle, is_throttling_error, record_throttle, wait_for_throttle
+
+# Instance state changes through the EC2 API, the stages behind sam-init:
+#   iter_action_results         start, stop or reboot the selected instances and yield an ActionResult per instance
+# and the single-target stages it is built from. Actions are named by their CLI command, such as
+# 'aws ec2 stop-instances' (see INIT_ACTIONS in sam_toolbox.jobs). Nothing here prompts or exits; progress goes
+# through say()
+
+# Sends the selected action to the instances through the EC2 API
+# Instances are sent in batches of up to batch_size per API call and the batches run concurrently. EC2 rejects a whole
+# batch if any one instance cannot make the transition, so a batch rejected for one of its instances is split in half
+# until the failing instances are isolated and every other instance still receives the action. Any other error (access
+# denied, an expired session) would fail every half the same way, so it fails the whole batch at once
+# monitor_reboot only changes the message printed for reboots
+
+PER_INSTANCE_ERROR_CODES = ('IncorrectInstanceState', 'UnsupportedOperation')
+
+def execute_command(instance_id_name_map, action, session=None, batch_size=100, max_workers=4, monitor_reboot=False):
+    ec2 = get_client('ec2', session)
+    successful_instances = {}
+    throttle = new_throttle()
+
+    instance_ids = list(instance_id_name_map)
+    batches = [instance_ids[i:i + batch_size] for i in range(0, len(instance_ids), batch_size)]
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(execute_batch, ec2, batch, action, instance_id_name_map, throttle, monitor_reboot=monitor_reboot)
+                   for batch in batches]
+        for future in as_completed(futures):
+            successful_instances.update(future.result())
+
+    # Keep the map in the order the instances were selected
+    return {id: successful_instances[id] for id in instance_ids if id in successful_instances}
+
+# Sends one batch the action and returns {instance_id: (name, previous_state, new_state)} for the instances that accepted it
+
+def execute_batch(ec2, batch, action, instance_id_name_map, throttle, max_attempts=8, monitor_reboot=False):
+    from botocore.exceptions import ClientError
+    action_calls = {
+        'aws ec2 start-instances': (ec2.start_instances, 'StartingInstances'),
+        'aws ec2 stop-instances': (ec2.stop_instances, 'StoppingInstances'),
+        'aws ec2 reboot-instances': (ec2.reboot_instances, None)  # Reboots return no per-instance state
+    }
+    action_map = {
+        'aws ec2 start-instances': 'starting',
+        'aws ec2 stop-instances': 'stopping',
+        'aws ec2 reboot-instances': 'rebooting'
+    }
+    current_action = action_map.get(action, 'processing')
+    api_call, response_key = action_calls[action]
+
+    attempts = 0
+    while True:
+        wait_for_throttle(throttle)
+        try:
+            response = api_call(InstanceIds=batch)
+            record_throttle(throttle, throttled=False)
+            break
+        except ClientError as e:
+            if is_throttling_error(e) and attempts < max_attempts:
+                record_throttle(throttle, throttled=True)
+                attempts += 1
+                continue
+            if not is_per_instance_error(e):
+                say(f"Failed to execute {current_action} command for {len(batch)} instance(s): {e}", 'red')
+                return {}
+            if len(batch) > 1:
+                middle = len(batch) // 2
+                processed = execute_batch(ec2, batch[:middle], action, instance_id_name_map, throttle, max_attempts, monitor_reboot)
+                processed.update(execute_batch(ec2, batch[middle:], action, instance_id_name_map, throttle, max_attempts, monitor_reboot))
+                return processed
+            instance_id = batch[0]
+            say(f"Failed to execute {current_action} command for {instance_id} ({instance_id_name_map[instance_id][0]}): {e}", 'red')
+            return {}
+
+    new_states = {}
+    if response_key:
+        new_states = {change['InstanceId']: change['CurrentState']['Name'] for change in response.get(response_key, [])}
+
+    processed = {}
+    for instance_id in batch:
+        instance_name, previous_state = instance_id_name_map[instance_id]
+        # Specific message for reboot action
+        if action == 'aws ec2 reboot-instances':
+            if monitor_reboot:
+                say(f"Reboot command sent to {instance_name}.", 'green')
+            else:
+                say(f"Reboot command sent to {instance_name}. This script does not monitor for successful reboot completion.")
+            new_state = 'Reboot command sent'  # Edit to change what is recorded as the current_state for reboots for CSV logging
+        else:
+            say(f"Command for {current_action} sent to {instance_name}.", 'green')
+            new_state = new_states.get(instance_id, 'unknown')
+        processed[instance_id] = (instance_name, previous_state, new_state)
+    return processed
+
+# True for the errors EC2 raises when one of the instances cannot take the action, such as InvalidInstanceID.NotFound
+
+def is_per_instance_error(e):
+    code = e.response.get('Error', {}).get('Code', '')
+    return code in PER_INSTANCE_ERROR_CODES or code.startswith('InvalidInstanceID.')
+
+# Monitors every instance at once until it reaches the state the action leads to
+# Each tick makes one batched describe_instances call (or describe_instance_status for reboots) for all pending
+# instances, and instances drop out of the pending set as they arrive. Instances that have not arrived when timeout
+# seconds have passed are recorded as timed out in init.csv instead of holding up the run
+#
+# Reboots are only monitored when monitor_reboot is set. A rebooted instance counts as back once its system and
+# instance status checks have been seen to leave ok and then report ok again. Checks that never leave ok within
+# reboot_grace seconds cannot tell a finished reboot from one that has not started, so the instance is recorded as
+# REBOOT_NOT_VERIFIED instead
+#
+# If EC2 refuses the checks with anything but throttling, the error is recorded as the status of every instance still
+# pending and the statuses collected so far are returned. Setting stop (a threading.Event, see iter_across_targets)
+# ends the monitoring at the next poll, also returning only the statuses collected so far
+
+REBOOT_NOT_VERIFIED = 'status checks ok (reboot not verified)'
+
+# The state each action leads to, as recorded once an instance has reached it
+DESIRED_STATES = {
+    'aws ec2 start-instances': 'running',
+    'aws ec2 stop-instances': 'stopped',
+    'aws ec2 reboot-instances': 'status checks ok'
+}
+
+def monitor_command_status_and_fetch_output(ec2_client, instance_ids, action, timeout=900, poll_interval=10, monitor_reboot=False, reboot_grace=120, stop=None):
+    from botocore.exceptions import ClientError
+    stop = stop or threading.Event()
+    # No monitoring for reboot instances unless requested
+    if action == 'aws ec2 reboot-instances' and not monitor_reboot:
+        say("\nSkipping monitoring for reboot action as per script configuration.")
+        # Directly return the status without checking
+        return {instance_id: 'Reboot command sent' for instance_id in instance_ids}
+
+    desired_state = DESIRED_STATES.get(action)
+    if not desired_state:
+        # Return empty statuses if action does not require state monitoring
+        return {}
+
+    say(f"\nMonitoring {len(instance_ids)} instances for reaching '{desired_state}' state...")
+    final_statuses = {}
+    pending = set(instance_ids)
+    last_state = {}
+    went_down = set()  # Instances seen away from the desired state, which a reboot must show
+    deadline = time.monotonic() + timeout
+    unverified_after = time.monotonic() + reboot_grace
+    delay = poll_interval
+
+    while pending:
+        try:
+            if action == 'aws ec2 reboot-instances':
+                current_states = fetch_status_checks(ec2_client, pending)
+            else:
+                current_states = fetch_states(ec2_client, pending)
+            delay = poll_interval
+        except ClientError as e:
+            if not is_throttling_error(e):
+                for instance_id in sorted(pending):
+                    say(f" - Could not check instance ID {instance_id}: {e}", 'red')
+                    final_statuses[instance_id] = f"monitoring failed ({e.response['Error']['Code']})"
+                break
+            current_states = {}
+            delay = min(delay * 2, 60)  # Back off while throttled
+
+        for instance_id in sorted(pending):
+            current_state = current_states.get(instance_id)
+            if current_state is None:
+                continue
+            if current_state != last_state.get(instance_id):
+                say(f" - Instance ID {instance_id} is currently {current_state}")
+                last_state[instance_id] = current_state
+            if current_state != desired_state:
+                went_down.add(instance_id)
+            elif action == 'aws ec2 reboot-instances' and instance_id not in went_down:
+                # Still ok from before the reboot, or back before a poll saw it go down
+                if time.monotonic() >= unverified_after or time.monotonic() + delay > deadline:
+                    say(f" - Instance ID {instance_id} passed its status checks, but they never showed the reboot.", 'yellow')
+                    final_statuses[instance_id] = REBOOT_NOT_VERIFIED
+                    pending.discard(instance_id)
+            else:
+                say(f" - Instance ID {instance_id} reached the '{desired_state}' state.", 'green')
+                final_statuses[instance_id] = desired_state
+                pending.discard(instance_id)
+
+        if not pending:
+            break
+        if time.monotonic() + delay > deadline:
+            for instance_id in sorted(pending):
+                final_state = f"timed out ({last_state.get(instance_id, 'unknown')})"
+                say(f" - Instance ID {instance_id} did not reach the '{desired_state}' state within {timeout} seconds.", 'red')
+                final_statuses[instance_id] = final_state
+            break
+        with timer('poll sleep'):
+            if stop.wait(delay):
+                break
+
+    # Keep the statuses in the order the instances were passed in
+    return {instance_id: final_statuses[instance_id] for instance_id in instance_ids if instance_id in final_statuses}
+
+# Returns {instance_id: state name} for the instances, in one paginated call per 200 instances
+
+def fetch_states(ec2_client, instance_ids):
+    instance_ids = sorted(instance_ids)
+    return {instance['InstanceId']: instance['State']['Name'] for instance in iter_instances_by_id(ec2_client, instance_ids)}
+
+# Returns {instance_id: 'status checks ok' or a summary of the failing checks}, in one call per 100 instances
+
+def fetch_status_checks(ec2_client, instance_ids):
+    instance_ids = sorted(instance_ids)
+    states = {}
+    for i in range(0, len(instance_ids), 100):  # describe_instance_status accepts up to 100 instance IDs
+        response = ec2_client.describe_instance_status(InstanceIds=instance_ids[i:i + 100], IncludeAllInstances=True)
+        for status in response['InstanceStatuses']:
+            system_status = status.get('SystemStatus', {}).get('Status', 'unknown')
+            instance_status = status.get('InstanceStatus', {}).get('Status', 'unknown')
+            if system_status == 'ok' and instance_status == 'ok':
+                states[status['InstanceId']] = 'status checks ok'
+            else:
+                states[status['InstanceId']] = f"{status['InstanceState']['Name']}, system {system_status}, instance {instance_status}"
+    return states
+
+# Applies the action through a rollout (see sam_toolbox.rollout) instead of to every instance at once
+# Instances are released in waves: the canary wave first, then up to the concurrency window at a time. Each wave is
+# sent in batches and monitored with the batched state checks above until it reaches the new state, then the next
+# wave starts. An instance counts as failed unless it is seen to reach the new state, so a rejected action, a timeout
+# or a reboot the status checks never showed (REBOOT_NOT_VERIFIED) all count against the error budget, and the
+# rollout halts once it is spent. Reboots are always monitored here, since a wave can only be judged by its status checks
+# Returns {instance_id: final status}, including the instances a halted rollout left untouched
+# Setting stop ends the rollout at the next poll
+
+def rolling_action(instance_id_name_map, action, settings, session=None, timeout=900, batch_size=100, max_workers=4, stop=None):
+    ec2_client = get_client('ec2', session)
+    stop = stop or threading.Event()
+    rollout = new_rollout(list(instance_id_name_map), settings)
+    final_statuses = {}
+    wave_number = 0
+    while has_work(rollout) and not stop.is_set():
+        wave = release(rollout)
+        if not wave:
+            break
+        wave_number += 1
+        say(f"\nWave {wave_number}: {len(wave)} instance(s), {len(rollout['queue'])} queued")
+        wave_map = {instance_id: instance_id_name_map[instance_id] for instance_id in wave}
+        successful_instances = execute_command(wave_map, action, session, batch_size, max_workers, monitor_reboot=True)
+        statuses = monitor_command_status_and_fetch_output(ec2_client, list(successful_instances), action, timeout=timeout, monitor_reboot=True, stop=stop) if successful_instances else {}
+        for instance_id in wave:
+            status = statuses.get(instance_id)
+            final_statuses[instance_id] = status or 'action rejected'
+            finish(rollout, instance_id, failed=status != DESIRED_STATES[action])
+
+    for instance_id in skipped_ids(rollout):
+        final_statuses[instance_id] = 'not attempted (rollout halted)'
+    return {instance_id: final_statuses[instance_id] for instance_id in instance_id_name_map if instance_id in final_statuses}
+
+# Executes the action on the selected instances and monitors the status changes, in every target at the same time,
+# yielding an ActionResult carrying its account and region for every instance that accepted the action (or, with
+# rollout settings, every instance the rollout covered) once its target has finished
+# With rollout settings each target works through its own waves (see rolling_action)
+# The cached inventory of every target is dropped, since the states it holds are out of date now
+
+def iter_action_results(targets, instance_id_name_map, instance_targets, action, target_workers=8, timeout=900, monitor_reboot=False,
+                        max_workers=4, batch_size=100, rollout=None):
+    target_maps = split_by_target(instance_id_name_map, instance_targets, targets)
+    stop = threading.Event()  # Set when the caller stops reading, to end every target's monitoring
+
+    def run_target(target):
+        target_map = target_maps[target_label(target)]
+        if rollout:
+            statuses = rolling_action(target_map, action, rollout, target['session'], timeout, batch_size, max_workers, stop)
+            forget_inventory(target['session'])
+        else:
+            successful_instances = execute_command(target_map, action, target['session'], batch_size, max_workers, monitor_reboot)
+            if not successful_instances:
+                return
+            forget_inventory(target['session'])
+            ec2_client = get_client('ec2', target['session'])
+            statuses = monitor_command_status_and_fetch_output(ec2_client, list(successful_instances), action, timeout=timeout, monitor_reboot=monitor_reboot, stop=stop)
+        for instance_id, status in statuses.items():
+            instance_name, previous_state = target_map[instance_id]
+            yield ActionResult(instance_id, instance_name, previous_state, status)
+
+    for target, result in iter_across_targets([target for target in targets if target_label(target) in target_maps], run_target, target_workers, stop):
+        yield with_target(result, target)
@@ -0,0 +1,88 @@
+#Simple AWS Manager (SAM) Toolbox is a set of lightweight scripts and modules for sysadmins in AWS
+#Copyright (C) 2024 Newton Advisory, LLC
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import json
+import time
+import hashlib
+from sam_toolbox.console import say
+
+# Local cache for data that is slow to download and changes rarely between runs (STS identity, EC2 inventory, the
+# SSM managed instance list). Entries live in ~/.cache/sam-toolbox as one JSON file per account and region
+# Set SAM_CACHE_DIR to keep the cache somewhere else, for example in a persistent Cloudshell home directory
+
+CACHE_DIR = os.environ.get('SAM_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'sam-toolbox'))
+DEFAULT_TTL = 300  # Seconds an entry is served before a full refresh is made
+
+settings = {'enabled': True, 'refresh': False, 'ttl': DEFAULT_TTL}
+
+def add_cache_arguments(parser):
+    parser.add_argument('--refresh', action='store_true', help="ignore cached inventory and download it again")
+    parser.add_argument('--no-cache', action='store_true', help="neither read nor write the local cache")
+    parser.add_argument('--cache-ttl', type=int, default=DEFAULT_TTL, metavar='SECONDS',
+                        help=f"seconds before cached inventory is fully refreshed (default {DEFAULT_TTL})")
+
+def configure_cache(args):
+    settings['enabled'] = not args.no_cache
+    settings['refresh'] = args.refresh
+    settings['ttl'] = args.cache_ttl
+
+def cache_key(*parts):
+    return '-'.join(str(part) for part in parts if part)
+
+def cache_path(name, key):
+    digest = hashlib.sha256(key.encode()).hexdigest()[:16]
+    return os.path.join(CACHE_DIR, f"{name}-{digest}.json")
+
+# Returns (data, age in seconds) for a cached entry, or (None, None) if there is no usable entry
+
+def load_cache(name, key, ttl=None):
+    if not settings['enabled'] or settings['refresh']:
+        return None, None
+    try:
+        with open(cache_path(name, key)) as file:
+            entry = json.load(file)
+    except (OSError, ValueError):
+        return None, None
+    age = time.time() - entry.get('saved_at', 0)
+    ttl = settings['ttl'] if ttl is None else ttl
+    if entry.get('key') != key or age > ttl:
+        return None, None
+    return entry['data'], age
+
+# saved_at keeps the time of the original download when an entry is only partly refreshed, so it still expires
+# ttl seconds after the last full download
+
+def store_cache(name, key, data, saved_at=None):
+    if not settings['enabled']:
+        return
+    path = cache_path(name, key)
+    try:
+        os.makedirs(CACHE_DIR, mode=0o700, exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, 'w') as file:
+            json.dump({'key': key, 'saved_at': saved_at or time.time(), 'data': data}, file)
+        os.replace(temp_path, path)  # Readers never see a half-written entry
+    except OSError as e:
+        say(f"Could not write the local cache: {e}", 'yellow')
+
+def clear_cache(name, key):
+    if key is None:
+        return
+    try:
+        os.remove(cache_path(name, key))
+    except OSError:
+        pass
@@ -0,0 +1,120 @@
+#Simple AWS Manager (SAM) Toolbox is a set of lightweight scripts and modules for sysadmins in AWS
+#Copyright (C) 2024 Newton Advisory, LLC
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import sys
+from contextlib import contextmanager
+from sam_toolbox.clients import get_session
+from sam_toolbox.fanout import build_targets, fetch_target_inventories
+from sam_toolbox.inventory import session_account_id
+from sam_toolbox.metrics import phase
+from sam_toolbox.selection import build_index, select
+
+# The parts of the sam-*.py scripts that talk to a person: the account banner, the instance listing and prompt, and
+# turning AWS errors into a message and exit status 1. The rest of the package never prompts or exits, so it can be
+# imported by other programs (see "Using the toolbox from Python" in the README)
+
+STATE_COLOR = {'pending': '\033[93m', 'running': '\033[92m', 'shutting-down': '\033[93m', 'terminated': '\033[91m', 'stopping': '\033[93m', 'stopped': '\033[91m'}
+
+# Exits with a message when the AWS calls in the block fail for missing credentials or an API error
+
+@contextmanager
+def exit_on_aws_errors():
+    from botocore.exceptions import NoCredentialsError, ClientError
+    try:
+        yield
+    except NoCredentialsError:
+        print("No AWS credentials found. Please configure your AWS CLI.")
+        sys.exit(1)
+    except ClientError as e:
+        print(f"An error occurred: {e}")
+        sys.exit(1)
+
+# Builds the account/region targets (see sam_toolbox.fanout) and displays them
+
+def connect_targets(regions=None, role_arns=None, account_id=None):
+    with phase('accounts'), exit_on_aws_errors():
+        targets = build_targets(regions, role_arns, account_id)
+    print_aws_account_info(targets)
+    return targets
+
+# Displays current AWS account and region information
+# You will need to upload the SAM toolkit in each region of Cloudshell you intend to use, or pass --regions to work
+# in several regions from one of them (see sam_toolbox.fanout)
+
+def print_aws_account_info(targets=None):
+    if targets:
+        for target in targets:
+            print(f"AWS Account ID: {target['account_id']}  Region: {target['region']}")
+        print()
+        return
+
+    session = get_session()
+    with exit_on_aws_errors():
+        account_id = session_account_id(session)
+    print(f"AWS Account ID: {account_id}")
+    print(f"Region: {session.region_name}\n")
+
+# Uses the shared inventory to create a real-time list of EC2 instances
+# This function is scoped to the account/region targets and does not see global resources
+# inventory_kwargs go to fetch_inventory, for example states=['running'] or the filters and predicate of --filter
+# With a selection expression (from --select) the instances are selected without listing them or prompting
+# Returns the selected {instance_id: (name, state)} map and the target each instance belongs to
+
+def create_instance_map(targets, target_workers=8, selection=None, show_state=True, **inventory_kwargs):
+    with phase('inventory'), exit_on_aws_errors():
+        inventory, instance_targets, labels = fetch_target_inventories(targets, target_workers, with_tags=True, **inventory_kwargs)
+    with phase('selection'):
+        selected_ids = select_instances(inventory, show_state=show_state, labels=labels, selection=selection)
+    return {instance_id: inventory[instance_id][:2] for instance_id in selected_ids}, instance_targets
+
+# Lists the inventory with reference numbers and prompts for the instances to target
+# Besides reference numbers, ranges, names, tags and states can be typed (see sam_toolbox.selection for the syntax)
+# The inventory may carry tags as (name, state, tags); labels optionally maps instance ids to the account/region
+# shown after them when several targets are listed
+# With a selection expression (from --select) nothing is listed or prompted, so the same selection can be repeated
+# Returns the selected instance ids in inventory order
+
+def select_instances(inventory, show_state=True, labels=None, selection=None):
+    index = build_index(inventory)
+    if selection is not None:
+        try:
+            selected_ids = select(index, selection)
+        except ValueError as e:
+            print(f"Invalid selection: {e}")
+            sys.exit(1)
+        print(f"Selected {len(selected_ids)} of {len(inventory)} instances matching '{selection}'")
+        return selected_ids
+
+    print("Available EC2 Instances:")
+    for ref_number, (instance_id, details) in enumerate(inventory.items(), start=1):
+        instance_name, state = details[0], details[1]
+        target = f" [{labels[instance_id]}]" if labels else ""
+        if show_state:
+            color = STATE_COLOR.get(state, '\033[0m')  # Default to no color if status unknown
+            print(f"{ref_number}. {color}{state}\033[0m {instance_id} ({instance_name}){target}")
+        else:
+            print(f"{ref_number}. {instance_id} ({instance_name}){target}")
+
+    all_ref = len(inventory) + 1
+    print(f"{all_ref}. Select All")
+    print("Type reference numbers or ranges separated by commas (1,4,10-20), or conditions such as "
+          "name=web-* tag:Env=prod state=running")
+    while True:
+        selected_refs = input("Enter the instances to target, or select all: ")
+        try:
+            return select(index, selected_refs, all_ref=all_ref)
+        except ValueError as e:
+            print(f"{e}, please try again")
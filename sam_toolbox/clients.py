@@ -0,0 +1,87 @@
+#Simple AWS Manager (SAM) Toolbox is a set of lightweight scripts and modules for sysadmins in AWS
+#Copyright (C) 2024 Newton Advisory, LLC
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import threading
+from sam_toolbox.metrics import instrument_client
+
+# Shared sessions and clients
+# Creating a client parses the service model and opens a new connection pool, so every script gets its clients from
+# get_client(), which builds each (session, service, region) client once and hands the same client to every worker
+# thread afterwards. botocore clients are thread-safe once created; creating them is not, which the lock takes care of
+#
+# The connection pool is sized for the dispatch and monitor thread pools, and the adaptive retry mode rate-limits
+# calls on the client side as soon as the service starts throttling
+#
+# boto3 and botocore take a noticeable part of a short run just to import, so they are only imported here, when the
+# first session is made. The rest of the package imports botocore.exceptions inside the functions that call AWS, so
+# --help, job file checks and other work that never reaches AWS run without loading the SDK at all
+
+CLIENT_OPTIONS = {
+    'max_pool_connections': 50,
+    'retries': {'mode': 'adaptive', 'max_attempts': 10},
+}
+
+_lock = threading.RLock()
+_default_session = None
+_data_loader = None
+_client_config = None
+_clients = {}
+
+def get_session():
+    global _default_session, _data_loader
+    with _lock:
+        if _default_session is None:
+            import boto3
+            import botocore.session
+            core_session = botocore.session.Session()
+            _data_loader = core_session.get_component('data_loader')
+            _default_session = boto3.session.Session(botocore_session=core_session)
+        return _default_session
+
+# Creates a session for another region or set of credentials that reuses the default session's loaded service
+# models, so fan-out targets do not parse the same JSON models again
+# credentials is a botocore credentials object, such as the refreshable ones of an assumed role, shared by every
+# session given it
+
+def new_session(region_name=None, credentials=None):
+    get_session()
+    import types
+    import boto3
+    import botocore.session
+    core_session = botocore.session.Session()
+    core_session.register_component('data_loader', _data_loader)
+    if credentials is not None:
+        core_session.register_component('credential_provider', types.SimpleNamespace(load_credentials=lambda: credentials))
+    return boto3.session.Session(region_name=region_name, botocore_session=core_session)
+
+def client_config():
+    global _client_config
+    with _lock:
+        if _client_config is None:
+            from botocore.config import Config
+            _client_config = Config(**CLIENT_OPTIONS)
+        return _client_config
+
+def get_client(service, session=None, region_name=None):
+    session = session or get_session()
+    key = (session, service, region_name or session.region_name)
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            client = session.client(service, region_name=region_name, config=client_config())
+            instrument_client(client)  # Counts its API calls when --metrics is on
+            _clients[key] = client
+        return client
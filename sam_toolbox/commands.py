@@ -0,0 +1,472 @@
+#Simple AWS Manager (SAM) Toolbox is a set of lightweight scripts and modules for sysadmins in AWS
+#Copyright (C) 2024 Newton Advisory, LLC
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import time
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from sam_toolbox.cache import load_cache, store_cache
+from sam_toolbox.clients import get_client
+from sam_toolbox.console import say
+from sam_toolbox.fanout import target_label, run_across_targets, iter_across_targets, split_by_target
+from sam_toolbox.inventory import account_cache_key
+from sam_toolbox.journal import record
+from sam_toolbox.metrics import timer
+from sam_toolbox.output_store import open_output_store, send_command_params, save_stream
+from sam_toolbox.records import CommandResult, with_target
+from sam_toolbox.rollout import new_rollout, release, finish, has_work, remaining_errors, skipped_ids
+from sam_toolbox.throttle import new_throttle, is_throttling_error, record_throttle, wait_for_throttle
+
+# Shell commands through SSM Run Command, the stages behind sam-spade:
+#   filter_ready_targets        which selected instances can receive commands
+#   iter_command_results        send the command to them and yield a CommandResult as each instance finishes
+# and the single-target stages those are built from. Nothing here prompts or exits; progress goes through say()
+
+COMPLETED_STATUSES = ['Success', 'Cancelled', 'Failed', 'TimedOut', 'Cancelling']
+
+# Checks if the instance is available for commands before sending
+# Instances may not be available if they do not have SSM installed, are in a hung state
+# or if the Cloudshell user does not have the appropriate permissions to access the SSM functions
+#
+# Selections of up to small_selection instances are looked up by instance ID, 50 per call and concurrently, so a
+# handful of instances costs one API call. Larger selections scan the region's whole managed instance list once and
+# the result is kept in the local cache. Excluded instances are reported with the reason they were left out
+
+def filter_ssm_ready_instances(instance_id_name_map, session=None, small_selection=200, max_workers=8):
+    ssm = get_client('ssm', session)
+    instance_ids = list(instance_id_name_map)
+
+    instance_infos = None
+    if len(instance_ids) <= small_selection:
+        instance_infos = describe_selected_instance_information(ssm, instance_ids, max_workers)
+    if instance_infos is None:
+        instance_infos = describe_all_instance_information(ssm, session)
+
+    valid_instance_id_name_map = {}
+    excluded = []
+    for instance_id, instance_name in instance_id_name_map.items():
+        instance_info = instance_infos.get(instance_id)
+        reason = ssm_exclusion_reason(instance_info)
+        if reason:
+            excluded.append((instance_id, instance_name, reason, instance_info or {}))
+        else:
+            valid_instance_id_name_map[instance_id] = instance_name
+
+    if excluded:
+        say(f"\n{len(excluded)} selected instance(s) are not ready for SSM commands:", 'yellow')
+        for instance_id, instance_name, reason, instance_info in excluded:
+            details = f" (platform: {instance_info.get('PlatformName', instance_info.get('PlatformType', 'unknown'))}, agent: {instance_info.get('AgentVersion', 'unknown')})" if instance_info else ""
+            say(f" - {instance_id} ({instance_name}): {reason}{details}")
+
+    return valid_instance_id_name_map
+
+# Returns why an instance cannot receive AWS-RunShellScript commands, or None if it can
+
+def ssm_exclusion_reason(instance_info):
+    if instance_info is None:
+        return "not registered with SSM (agent not installed, no instance profile, or no route to the SSM endpoints)"
+    if instance_info.get('PingStatus') != 'Online':
+        return f"SSM agent PingStatus is {instance_info.get('PingStatus', 'unknown')}"
+    if instance_info.get('PlatformType') == 'Windows':
+        return "Windows instances cannot run AWS-RunShellScript"
+    return None
+
+# Only the fields used for the readiness report are kept, which is also what gets cached
+
+def slim_instance_information(instance_info):
+    return {field: instance_info[field] for field in ('InstanceId', 'PingStatus', 'AgentVersion', 'PlatformType', 'PlatformName') if field in instance_info}
+
+# Looks up the selected instances by ID, in chunks of 50 sent concurrently
+# Returns {instance_id: information}, or None if SSM rejected the ID filter so the caller can fall back to a full scan
+
+def describe_selected_instance_information(ssm, instance_ids, max_workers=8):
+    from botocore.exceptions import ClientError
+    def describe_chunk(chunk):
+        infos = {}
+        paginator = ssm.get_paginator('describe_instance_information')
+        for page in paginator.paginate(InstanceInformationFilterList=[{'key': 'InstanceIds', 'valueSet': chunk}]):
+            for instance_info in page['InstanceInformationList']:
+                infos[instance_info['InstanceId']] = slim_instance_information(instance_info)
+        return infos
+
+    chunks = [instance_ids[i:i + 50] for i in range(0, len(instance_ids), 50)]
+    instance_infos = {}
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for infos in executor.map(describe_chunk, chunks):
+                instance_infos.update(infos)
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'InvalidInstanceId':
+            raise
+        return None
+    return instance_infos
+
+# Scans the whole region's managed instance list, keeping the result in the local cache so repeated runs skip the scan
+
+def describe_all_instance_information(ssm, session):
+    key = account_cache_key(session)
+    cached_infos, _ = load_cache('ssm-instance-information', key)
+    if cached_infos is not None:
+        return {instance_info['InstanceId']: instance_info for instance_info in cached_infos}
+
+    instance_infos = {}
+    paginator = ssm.get_paginator('describe_instance_information')
+    for page in paginator.paginate():
+        for instance_info in page['InstanceInformationList']:
+            instance_infos[instance_info['InstanceId']] = slim_instance_information(instance_info)
+    store_cache('ssm-instance-information', key, list(instance_infos.values()))
+    return instance_infos
+
+# Checks SSM readiness in every target concurrently
+# Returns {target_label: {instance_id: name}} for the targets with at least one ready instance
+
+def filter_ready_targets(targets, instance_id_name_map, instance_targets, target_workers=8):
+    target_maps = split_by_target(instance_id_name_map, instance_targets, targets)
+    ready_maps = run_across_targets(
+        [target for target in targets if target_label(target) in target_maps],
+        lambda target: filter_ssm_ready_instances(target_maps[target_label(target)], target['session']),
+        target_workers,
+    )
+    return {label: ready_map for label, ready_map in ready_maps.items() if ready_map}
+
+# Sends the command to the instances selected
+#
+# To create custom modules, replace sam-spade's select_command() function with your desired command structure
+# or workflow, and have the new function return the [command] parameter. The function below will execute the
+# command on your desired endpoint
+#
+# Instances are grouped into batches of up to 50 (the most send_command accepts in one call) and the batches are
+# sent concurrently. Lower max_workers if you share the account's SSM API quota with other tooling
+#
+# With a run journal (see sam_toolbox.journal) every accepted batch is recorded under the target's label before
+# the run moves on, and the command carries the run id in its comment
+#
+# WARNING: Only use execute_command() for modules designed to interact with the instances' OS, not for
+# modules which interact with the AWS API
+
+def execute_command(instance_id_name_map, command, session=None, batch_size=50, max_workers=8, journal=None, label=None, options=None):
+    ssm = get_client('ssm', session)
+    successful_instances = {}
+    command_ids = {}
+    throttle = new_throttle()  # Shared by all workers so one throttle slows the whole pool
+
+    instance_ids = list(instance_id_name_map)
+    batches = [instance_ids[i:i + batch_size] for i in range(0, len(instance_ids), batch_size)]
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(send_command_batch, ssm, batch, command, instance_id_name_map, throttle, journal=journal, label=label, options=options) for batch in batches]
+        for future in as_completed(futures):
+            for instance_id, command_id in future.result().items():
+                successful_instances[instance_id] = instance_id_name_map[instance_id]
+                command_ids[instance_id] = command_id
+
+    # Keep the maps in the order the instances were selected
+    successful_instances = {id: successful_instances[id] for id in instance_ids if id in successful_instances}
+    command_ids = {id: command_ids[id] for id in instance_ids if id in command_ids}
+    return successful_instances, command_ids
+
+# Sends one batch of instances the command and returns {instance_id: command_id} for the instances that accepted it
+# A batch containing an ineligible instance is rejected as a whole, so it is split in half until the ineligible
+# instances are isolated and the rest of the batch still receives the command
+
+def send_command_batch(ssm, batch, command, instance_id_name_map, throttle, max_attempts=8, journal=None, label=None, options=None):
+    from botocore.exceptions import ClientError
+    attempts = 0
+    params = dict(options or {})  # Rollout limits and the output store, when used
+    if journal:
+        params['Comment'] = journal_comment(journal['run_id'])
+    while True:
+        wait_for_throttle(throttle)
+        try:
+            response = ssm.send_command(
+                InstanceIds=batch,
+                DocumentName="AWS-RunShellScript",
+                Parameters={'commands': [command]},  # Here we use the command passed to the function
+                **params,
+            )
+            record_throttle(throttle, throttled=False)
+            command_id = response['Command']['CommandId']
+            record(journal, 'sent', sync=True, target=label, command_id=command_id, instance_ids=batch)
+            for instance_id in batch:
+                say(f"Command sent to {instance_id} ({instance_id_name_map[instance_id]})")
+            return {instance_id: command_id for instance_id in batch}
+        except ClientError as e:
+            error_code = e.response['Error']['Code']
+            if is_throttling_error(e) and attempts < max_attempts:
+                record_throttle(throttle, throttled=True)
+                attempts += 1
+                continue
+            if error_code == 'InvalidInstanceId' and len(batch) > 1:
+                middle = len(batch) // 2
+                sent = send_command_batch(ssm, batch[:middle], command, instance_id_name_map, throttle, max_attempts, journal, label, options)
+                sent.update(send_command_batch(ssm, batch[middle:], command, instance_id_name_map, throttle, max_attempts, journal, label, options))
+                return sent
+            for instance_id in batch:
+                instance_name = instance_id_name_map[instance_id]
+                if error_code == 'InvalidInstanceId':
+                    say(f"{instance_id} ({instance_name}) is not eligible for commands.", 'red')
+                else:
+                    say(f"An error occurred while executing the command on {instance_id} ({instance_name}): {e}", 'red')
+            return {}
+
+# Handles the sessions and data flow from the target instances
+# Every outstanding invocation is tracked at once: each poll makes one list_command_invocations call per CommandId
+# (and page) instead of one call per instance, and a CommandResult is yielded as soon as each instance reaches a
+# completed status, so the total wait is roughly that of the slowest instance rather than the sum of all of them
+#
+# The poll interval starts at min_delay, grows towards max_delay while nothing changes and drops back as soon as
+# progress is made. An invocation SSM has not listed registration_timeout seconds after the instance was handed to the
+# monitor is reported as an error; if you receive 'InvocationDoesNotExist' errors you should consider increasing it
+# Invocations that already finished, for example when resuming a run, are collected on the first poll
+#
+# For rolling execution (see sam_toolbox.rollout) refill is called before every poll with the (instance_id, status)
+# pairs that finished since the last call, and returns the {instance_id: command_id} it sent next
+# With an output store (see sam_toolbox.output_store) the full stdout and stderr are saved as each instance completes
+# Setting stop (a threading.Event, see iter_across_targets) ends the monitoring at the next poll
+
+def monitor_command_status_and_fetch_output(ssm_client, command_ids, instance_id_name_map, max_workers=8, min_delay=2, max_delay=30, journal=None, refill=None, store=None,
+                                            registration_timeout=30, stop=None):
+    from botocore.exceptions import ClientError
+    stop = stop or threading.Event()
+    pending = {}  # CommandId -> instance ids still waiting on that command
+    deadlines = {}  # instance id -> time by which SSM must have listed its invocation
+
+    def add_pending(instance_id, command_id):
+        pending.setdefault(command_id, set()).add(instance_id)
+        deadlines[instance_id] = time.monotonic() + registration_timeout
+
+    for instance_id, command_id in command_ids.items():
+        add_pending(instance_id, command_id)
+    last_status = {}
+    finished = []  # (instance_id, status) not yet reported to refill
+    delay = min_delay
+    throttle = new_throttle()  # Shared by the output fetches so one throttle slows them all
+
+    if command_ids:
+        say(f"\nMonitoring command execution status for {len(command_ids)} instances...")
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while True:
+            if refill is not None:
+                for instance_id, command_id in refill(finished).items():
+                    add_pending(instance_id, command_id)
+                finished = []
+            if not pending:
+                break
+            progressed = False
+            throttled = False
+            completed = []
+
+            futures = {executor.submit(list_invocation_statuses, ssm_client, command_id): command_id for command_id in pending}
+            for future in as_completed(futures):
+                command_id = futures[future]
+                try:
+                    statuses = future.result()
+                except ClientError as e:
+                    if is_throttling_error(e):
+                        throttled = True
+                        continue
+                    for instance_id in pending.pop(command_id):
+                        say(f"Error getting command invocation for {instance_id} ({instance_id_name_map[instance_id]}): {e}")
+                        finished.append((instance_id, 'Error'))
+                    continue
+
+                for instance_id in list(pending[command_id]):
+                    instance_name = instance_id_name_map[instance_id]
+                    status = statuses.get(instance_id)
+                    if status is None:
+                        if time.monotonic() > deadlines[instance_id]:
+                            say(f"Error getting command invocation for {instance_id} ({instance_name}) after {registration_timeout}s")
+                            pending[command_id].discard(instance_id)
+                            finished.append((instance_id, 'Error'))
+                        elif instance_id not in last_status:
+                            say(f"Waiting for command invocation to be registered for {instance_id} ({instance_name})...")
+                            last_status[instance_id] = None
+                        continue
+                    if status in COMPLETED_STATUSES:
+                        pending[command_id].discard(instance_id)
+                        completed.append((command_id, instance_id, status))
+                        finished.append((instance_id, status))
+                        record(journal, 'status', instance_id=instance_id, command_id=command_id, status=status)
+                        progressed = True
+                    elif status != last_status.get(instance_id):
+                        say(f"{instance_id} ({instance_name}) {status}...")
+                        progressed = True
+                    last_status[instance_id] = status
+                if not pending[command_id]:
+                    del pending[command_id]
+
+            # Fetch the full output of each completed invocation concurrently and hand it on as soon as it arrives
+            output_futures = [executor.submit(fetch_invocation_output, ssm_client, command_id, instance_id, instance_id_name_map[instance_id], status, store, throttle)
+                              for command_id, instance_id, status in completed]
+            for future in as_completed(output_futures):
+                yield future.result()
+
+            if not pending:
+                continue  # Done, unless refill has more to send
+            if throttled:
+                delay = min(delay * 2, max_delay)
+            elif progressed:
+                delay = min_delay
+            else:
+                delay = min(delay * 1.5, max_delay)
+            with timer('poll sleep'):
+                if stop.wait(random.uniform(delay / 2, delay)):  # Jitter spreads the polls of concurrent runs apart
+                    return
+
+# Sends the command through a rollout (see sam_toolbox.rollout) instead of to every instance at once, yielding results
+# as they arrive. Free slots in the concurrency window are refilled as instances finish, up to 50 instances per
+# send_command, so the window stays full without waiting for whole waves. Every command also carries SSM's own
+# MaxConcurrency and the remaining MaxErrors, so SSM stops dispatching within a command as soon as the budget is spent
+# An instance counts as failed unless its invocation succeeds; instances SSM rejects count as failed too
+
+def rolling_command(ssm_client, instance_id_name_map, command, settings, max_workers=8, journal=None, label=None, store=None, stop=None):
+    rollout = new_rollout(list(instance_id_name_map), settings)
+    throttle = new_throttle()
+
+    def refill(finished):
+        for instance_id, status in finished:
+            finish(rollout, instance_id, failed=status != 'Success')
+        sent = {}
+        while has_work(rollout):
+            batch = release(rollout, limit=50)  # send_command accepts up to 50 instance IDs
+            if not batch:
+                break  # The window is full
+            limits = {'MaxConcurrency': str(rollout['window']), 'MaxErrors': str(remaining_errors(rollout))}
+            batch_sent = send_command_batch(ssm_client, batch, command, instance_id_name_map, throttle, journal=journal, label=label, options={**limits, **send_command_params(store)})
+            for instance_id in batch:
+                if instance_id not in batch_sent:
+                    finish(rollout, instance_id, failed=True)
+            sent.update(batch_sent)
+        return sent
+
+    yield from monitor_command_status_and_fetch_output(ssm_client, {}, instance_id_name_map, max_workers, journal=journal, refill=refill, store=store, stop=stop)
+    skipped = skipped_ids(rollout)
+    if skipped:
+        say(f"{len(skipped)} instance(s){f' in {label}' if label else ''} were not sent the command: {', '.join(skipped)}", 'red')
+
+# Returns {instance_id: status} for every invocation of a command, following the result pages
+
+def list_invocation_statuses(ssm_client, command_id):
+    statuses = {}
+    paginator = ssm_client.get_paginator('list_command_invocations')
+    for page in paginator.paginate(CommandId=command_id):
+        for invocation in page['CommandInvocations']:
+            statuses[invocation['InstanceId']] = invocation['Status']
+    return statuses
+
+# list_command_invocations only returns the first 2500 characters of output, so the output of each completed
+# invocation is fetched once with get_command_invocation, which returns up to 24,000 characters of stdout and
+# 8,000 of stderr. With an output store the complete streams are saved to files and their paths added to the result
+# Throttled fetches are retried through the throttle shared with the other fetches. If the output cannot be fetched
+# the result still carries the instance's status, with the error in standard_error, so the instance keeps its row
+
+def fetch_invocation_output(ssm_client, command_id, instance_id, instance_name, status, store=None, throttle=None, max_attempts=8):
+    from botocore.exceptions import ClientError
+    throttle = throttle or new_throttle()
+    attempts = 0
+    while True:
+        wait_for_throttle(throttle)
+        try:
+            invocation_response = ssm_client.get_command_invocation(
+                CommandId=command_id,
+                InstanceId=instance_id,
+            )
+            record_throttle(throttle, throttled=False)
+            break
+        except ClientError as e:
+            if is_throttling_error(e) and attempts < max_attempts:
+                record_throttle(throttle, throttled=True)
+                attempts += 1
+                continue
+            say(f"Error getting command invocation for {instance_id} ({instance_name}): {e}", 'red')
+            return CommandResult(
+                instance_id=instance_id,
+                instance_name=instance_name,
+                invocation_response='',
+                status=status,
+                response_code=None,
+                standard_error=f"Could not fetch the command output: {e}",
+            )
+
+    say(f"{instance_id} ({instance_name}) command status: {status}")
+    if status == 'Success':
+        say(f"Output for {instance_id} ({instance_name}):", 'green')
+        say(f"{invocation_response['StandardOutputContent']}\n")
+
+# To create custom modules, modify which portions of the invocation_response are filtered. Here, we return the StandardOutputContent
+# along with the status, exit code and StandardErrorContent
+# The full invocation_response value can be see by swapping the commented lines within this function
+    output_file = error_file = None
+    if store is not None:
+        output_file = save_stream(store, command_id, instance_id, 'stdout', invocation_response['StandardOutputContent'])
+        error_file = save_stream(store, command_id, instance_id, 'stderr', invocation_response.get('StandardErrorContent'))
+    return CommandResult(
+        instance_id=instance_id,
+        instance_name=instance_name,
+        invocation_response=invocation_response['StandardOutputContent'],  # Save only the StandardOutputContent
+        #invocation_response=invocation_response,  # Save full invocation_response output
+        status=status,
+        response_code=invocation_response.get('ResponseCode'),
+        standard_error=invocation_response.get('StandardErrorContent', ''),
+        output_file=output_file,
+        error_file=error_file,
+    )
+
+# Executes the command on the ready instances and monitors them, in every target at the same time, yielding a
+# CommandResult carrying its account and region as each instance completes
+# ready_maps comes from filter_ready_targets. With rollout settings (see sam_toolbox.rollout) each target rolls the
+# command out through its own window. With an output store URL the full outputs are saved under output_dir (see
+# sam_toolbox.output_store). An open run journal, as sam-spade keeps, records what was sent and how it ended
+
+def iter_command_results(targets, ready_maps, command, target_workers=8, max_workers=8, batch_size=50, rollout=None,
+                         output_store=None, output_dir=None, journal=None):
+    stop = threading.Event()  # Set when the caller stops reading, to end every target's monitoring
+
+    def run_target(target):
+        label = target_label(target)
+        ssm_client = get_client('ssm', target['session'])
+        store = open_output_store(output_store, output_dir, target['session']) if output_store else None
+        if rollout:
+            results = rolling_command(ssm_client, ready_maps[label], command, rollout, max_workers, journal, label, store, stop)
+        else:
+            successful_instances, command_ids = execute_command(ready_maps[label], command, target['session'], batch_size, max_workers, journal, label, send_command_params(store))
+            if not successful_instances:
+                return
+            results = monitor_command_status_and_fetch_output(ssm_client, command_ids, successful_instances, max_workers, journal=journal, store=store, stop=stop)
+        yield from results
+
+    say("\nSending command to selected instances...")
+    for target, result in iter_across_targets([target for target in targets if target_label(target) in ready_maps], run_target, target_workers, stop):
+        yield with_target(result, target)
+
+# Returns {instance_id: command_id} for the commands a journaled run sent, found by the run id in their comment
+
+def recover_unjournaled_commands(ssm_client, run_id, started_at):
+    from botocore.exceptions import ClientError
+    invoked_after = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(started_at - 60))
+    recovered = {}
+    try:
+        paginator = ssm_client.get_paginator('list_commands')
+        for page in paginator.paginate(Filters=[{'key': 'InvokedAfter', 'value': invoked_after}]):
+            for command in page['Commands']:
+                if command.get('Comment') == journal_comment(run_id):
+                    recovered.update({instance_id: command['CommandId'] for instance_id in command.get('InstanceIds', [])})
+    except ClientError as e:
+        say(f"Could not check the command history for unrecorded commands: {e}", 'yellow')
+    return recovered
+
+def journal_comment(run_id):
+    return f"sam-spade run {run_id}"
@@ -0,0 +1,46 @@
+#Simple AWS Manager (SAM) Toolbox is a set of lightweight scripts and modules for sysadmins in AWS
+#Copyright (C) 2024 Newton Advisory, LLC
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import threading
+
+# Progress messages
+# The toolbox's stages report what they are doing through say() instead of print(), so code that imports them, such
+# as a Lambda function or an orchestration worker, gets no screen output unless it asks for it:
+#   use_terminal()          print every message, in colour, as the sam-*.py scripts do
+#   set_console(fn)         pass every message to fn(message, color), for example to send them to logging
+#   set_console(None)       drop them again (the default)
+# color is None or one of COLORS. Prompts and menus are not messages and stay in the scripts
+
+COLORS = {'green': '\033[92m', 'yellow': '\033[93m', 'red': '\033[91m', 'bold': '\033[1m'}
+
+_sink = None
+_lock = threading.Lock()  # Keeps lines printed by worker threads whole
+
+def set_console(sink):
+    global _sink
+    _sink = sink
+
+def use_terminal():
+    set_console(print_message)
+
+def say(message='', color=None):
+    sink = _sink
+    if sink is not None:
+        sink(message, color)
+
+def print_message(message, color=None):
+    with _lock:
+        print(f"{COLORS[color]}{message}\033[0m" if color else message)
@@ -0,0 +1,245 @@
+#Simple AWS Manager (SAM) Toolbox is a set of lightweight scripts and modules for sysadmins in AWS
+#Copyright (C) 2024 Newton Advisory, LLC
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import re
+import queue
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from sam_toolbox.clients import get_session, new_session, get_client
+from sam_toolbox.console import say
+from sam_toolbox.inventory import session_account_id, remember_account, fetch_inventory
+from sam_toolbox.records import InstanceRecord
+
+# Fan-out across accounts and regions
+# A target is one account and region to work in: {'session': boto3 session, 'account_id': ..., 'region': ...}
+# Without --regions or --role-arn the only target is the Cloudshell session's own account and region, so the scripts
+# behave exactly as before. With them, every target gets its own session and the work runs concurrently across
+# targets, each target keeping the concurrency limits of the functions it runs
+
+def add_target_arguments(parser):
+    parser.add_argument('--regions', metavar='REGIONS',
+                        help="comma separated regions to work in, or 'all' for every region enabled in the account")
+    parser.add_argument('--role-arn', action='append', dest='role_arns', default=[], metavar='ARN',
+                        help="IAM role to assume in another account (repeat for several accounts)")
+    parser.add_argument('--target-workers', type=int, default=8, metavar='N',
+                        help="number of account/region targets worked on at the same time (default 8)")
+    parser.add_argument('--account-id', type=account_id_argument, default=os.environ.get('SAM_ACCOUNT_ID'), metavar='ID',
+                        help="account of the current credentials, to skip looking it up with STS (default: $SAM_ACCOUNT_ID)")
+
+def account_id_argument(text):
+    if not re.fullmatch(r'\d{12}', text):
+        raise argparse.ArgumentTypeError(f"'{text}' is not a 12 digit AWS account id")
+    return text
+
+# Builds one session per account and region
+# The account of the current credentials is looked up with STS, and cached (see get_account_identity), unless
+# account_id gives it. Assumed roles take their account from the role ARN. Their credentials are assumed again shortly
+# before they expire, so long runs and --watch keep working past the role's session duration
+# Raises NoCredentialsError if credentials are missing and ClientError if the regions cannot be listed or a role cannot
+# be assumed; the scripts turn these into a message and exit status 1 (see sam_toolbox.cli)
+
+def build_targets(regions=None, role_arns=None, account_id=None):
+    base_session = get_session()
+    if regions == 'all':
+        ec2 = get_client('ec2', base_session)
+        region_names = sorted(region['RegionName'] for region in ec2.describe_regions()['Regions'])
+    elif regions:
+        region_names = [region.strip() for region in regions.split(',') if region.strip()]
+    else:
+        region_names = [base_session.region_name]
+
+    account_sessions = []  # (account_id, botocore credentials or None for the current ones)
+    if role_arns:
+        sts = get_client('sts', base_session)
+        for role_arn in role_arns:
+            account_sessions.append((role_arn.split(':')[4], assumed_role_credentials(sts, role_arn)))
+    else:
+        account_sessions.append((account_id or session_account_id(base_session), None))
+
+    targets = []
+    for account_id, credentials in account_sessions:
+        for region in region_names:
+            if credentials is None and region == base_session.region_name:
+                session = base_session
+            elif credentials is None:
+                session = new_session(region_name=region)
+            else:
+                session = new_session(region_name=region, credentials=credentials)
+            remember_account(session, account_id)
+            targets.append({'session': session, 'account_id': account_id, 'region': region})
+    return targets
+
+# Assumes the role and returns credentials that assume it again when they are about to expire
+
+def assumed_role_credentials(sts, role_arn):
+    from botocore.credentials import RefreshableCredentials
+
+    def assume():
+        credentials = sts.assume_role(RoleArn=role_arn, RoleSessionName='sam-toolbox')['Credentials']
+        return {
+            'access_key': credentials['AccessKeyId'],
+            'secret_key': credentials['SecretAccessKey'],
+            'token': credentials['SessionToken'],
+            'expiry_time': credentials['Expiration'].isoformat(),
+        }
+    return RefreshableCredentials.create_from_metadata(metadata=assume(), refresh_using=assume, method='sts-assume-role')
+
+def target_label(target):
+    return f"{target['account_id']}/{target['region']}"
+
+# Account and region columns added to output rows when more than one target is used
+
+def target_columns(target):
+    return {'account_id': target['account_id'], 'region': target['region']}
+
+# Runs fn(target) for every target concurrently and returns {target_label: result} in target order
+# A target that fails with an AWS error is reported and left out, so one unreachable region does not stop the others.
+# Any other exception is a bug and is raised
+
+def run_across_targets(targets, fn, max_workers=8):
+    from botocore.exceptions import BotoCoreError, ClientError
+    if len(targets) == 1:
+        return {target_label(targets[0]): fn(targets[0])}
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(fn, target): target for target in targets}
+        for future in as_completed(futures):
+            target = futures[future]
+            try:
+                results[target_label(target)] = future.result()
+            except (ClientError, BotoCoreError) as e:
+                say(f"Skipping {target_label(target)}: {e}", 'red')
+    return {target_label(target): results[target_label(target)] for target in targets if target_label(target) in results}
+
+# Runs the generator fn(target) for every target concurrently and yields (target, item) as soon as any target
+# produces an item, so results from all targets can stream into a single output file
+# AWS errors are handled as in run_across_targets. Any other exception is carried through the queue and raised here,
+# in the consumer, after which the other targets are stopped
+#
+# When the consumer stops early (an exception, Ctrl+C, or simply leaving the loop) stop is set and the targets still
+# running are abandoned rather than waited for. Pass the same threading.Event to the monitors fn runs so they check it
+# between polls and return within one tick instead of polling until every instance has finished
+
+def iter_across_targets(targets, fn, max_workers=8, stop=None):
+    from botocore.exceptions import BotoCoreError, ClientError
+    stop = stop or threading.Event()
+    if len(targets) == 1:
+        try:
+            for item in fn(targets[0]):
+                yield targets[0], item
+        finally:
+            stop.set()
+        return
+
+    items = queue.Queue(maxsize=1000)  # Bounded so a fast target cannot outrun the writer by much
+    done = object()
+    failed = object()
+
+    # Waits for room in the queue, giving up once the consumer has stopped
+    def put(entry):
+        while not stop.is_set():
+            try:
+                items.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce(target):
+        try:
+            for item in fn(target):
+                if not put((target, item)):
+                    return
+        except (ClientError, BotoCoreError) as e:
+            say(f"Skipping {target_label(target)}: {e}", 'red')
+        except Exception as e:
+            put((target, (failed, e)))
+        finally:
+            put((target, done))
+
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    for target in targets:
+        executor.submit(produce, target)
+    remaining = len(targets)
+    try:
+        while remaining:
+            target, item = items.get()
+            if item is done:
+                remaining -= 1
+            elif type(item) is tuple and item and item[0] is failed:
+                raise item[1]
+            else:
+                yield target, item
+    finally:
+        stop.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+# Fetches every target's inventory concurrently and merges them into one {instance_id: (name, state)} map
+# Returns (inventory, {instance_id: target}, {instance_id: label shown in the selection list or None})
+
+def fetch_target_inventories(targets, max_workers=8, **inventory_kwargs):
+    target_by_label = {target_label(target): target for target in targets}
+    inventories = run_across_targets(targets, lambda target: fetch_inventory(session=target['session'], **inventory_kwargs), max_workers)
+
+    inventory = {}
+    instance_targets = {}
+    for label, target_inventory in inventories.items():
+        for instance_id, details in target_inventory.items():
+            inventory[instance_id] = details
+            instance_targets[instance_id] = target_by_label[label]
+    labels = {instance_id: target_label(target) for instance_id, target in instance_targets.items()} if len(targets) > 1 else None
+    return inventory, instance_targets, labels
+
+# Yields an InstanceRecord for every instance of every target as each target's inventory arrives, for code that
+# works through the inventory instead of prompting for a selection. Takes the same keyword arguments as fetch_inventory
+
+def iter_inventory_records(targets, max_workers=8, **inventory_kwargs):
+    inventory_kwargs['with_tags'] = True
+    fetch = lambda target: fetch_inventory(session=target['session'], **inventory_kwargs).items()
+    for target, (instance_id, (name, state, tags)) in iter_across_targets(targets, fetch, max_workers):
+        yield InstanceRecord(instance_id, name, state, tags, target['account_id'], target['region'])
+
+# Turns InstanceRecords into the maps the stages take: ({instance_id: (name, state)}, {instance_id: target})
+# Records whose account and region are not one of the targets are left out
+
+def records_to_maps(records, targets):
+    by_label = {target_label(target): target for target in targets}
+    instance_map = {}
+    instance_targets = {}
+    for record in records:
+        target = by_label.get(f"{record.account_id}/{record.region}")
+        if target is not None:
+            instance_map[record.instance_id] = (record.name, record.state)
+            instance_targets[record.instance_id] = target
+    return instance_map, instance_targets
+
+# Splits a selected instance map into {target_label: {instance_id: details}}, leaving out targets without instances
+# With a single target, instances not found in any inventory (for example hard-coded in a custom script) go to it
+# Raises ValueError for such an instance when there are several targets, since there is no telling which one it is in
+
+def split_by_target(instance_map, instance_targets, targets):
+    grouped = {}
+    for instance_id, details in instance_map.items():
+        target = instance_targets.get(instance_id)
+        if target is None:
+            if len(targets) > 1:
+                raise ValueError(f"No target given for {instance_id}, pass its target in instance_targets")
+            target = targets[0]
+        grouped.setdefault(target_label(target), {})[instance_id] = details
+    return {target_label(target): grouped[target_label(target)] for target in targets if target_label(target) in grouped}
@@ -0,0 +1,84 @@
+#Simple AWS Manager (SAM) Toolbox is a set of lightweight scripts and modules for sysadmins in AWS
+#Copyright (C) 2024 Newton Advisory, LLC
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import re
+
+# Filter expressions narrow the instances a script works on, for example
+#   vpc=vpc-0abc123        subnet=subnet-1,subnet-2        type=t3.*        az=us-east-1a        tag:Env=prod
+# key=value (several values separated by commas, * wildcards allowed) is sent to describe_instances as a Filter, so
+# only matching instances are downloaded. key!=value and key~regex cannot be expressed as EC2 filters and are
+# checked on each instance as the pages stream in
+
+# Short name -> (EC2 filter name, path of the value in an instance description)
+FILTER_KEYS = {
+    'vpc': ('vpc-id', 'VpcId'),
+    'subnet': ('subnet-id', 'SubnetId'),
+    'type': ('instance-type', 'InstanceType'),
+    'az': ('availability-zone', 'Placement.AvailabilityZone'),
+    'state': ('instance-state-name', 'State.Name'),
+    'image': ('image-id', 'ImageId'),
+    'name': ('tag:Name', 'tag:Name'),
+}
+
+FILTER_PATTERN = re.compile(r'^\s*(?P<key>[^=!~]+?)\s*(?P<op>!=|=|~)\s*(?P<value>.*?)\s*$')
+
+def instance_value(instance, path):
+    if path.startswith('tag:'):
+        return next((tag['Value'] for tag in instance.get('Tags', []) if tag['Key'] == path[4:]), None)
+    current = instance
+    for key in path.split('.'):
+        if not isinstance(current, dict) or key not in current:
+            return None
+        current = current[key]
+    return current
+
+# Parses filter expressions into (EC2 Filters, client-side predicate or None)
+# Raises ValueError for expressions that cannot be parsed
+
+def parse_filters(expressions):
+    server_filters = []
+    checks = []
+    for expression in expressions or []:
+        match = FILTER_PATTERN.match(expression)
+        if not match or not match.group('value'):
+            raise ValueError(f"Invalid filter '{expression}', expected key=value, key!=value or key~regex")
+        key, op, value = match.group('key'), match.group('op'), match.group('value')
+        if key.startswith('tag:'):
+            filter_name, path = key, key
+        elif key in FILTER_KEYS:
+            filter_name, path = FILTER_KEYS[key]
+        else:
+            raise ValueError(f"Unknown filter key '{key}', expected tag:<Key> or one of: {', '.join(FILTER_KEYS)}")
+
+        if op == '=':
+            server_filters.append({'Name': filter_name, 'Values': [v.strip() for v in value.split(',')]})
+        elif op == '!=':
+            excluded = {v.strip() for v in value.split(',')}
+            checks.append(lambda instance, path=path, excluded=excluded: instance_value(instance, path) not in excluded)
+        else:
+            try:
+                pattern = re.compile(value)
+            except re.error as e:
+                raise ValueError(f"Invalid regular expression in filter '{expression}': {e}")
+            checks.append(lambda instance, path=path, pattern=pattern: pattern.search(str(instance_value(instance, path) or '')) is not None)
+
+    predicate = (lambda instance: all(check(instance) for check in checks)) if checks else None
+    return server_filters, predicate
+
+def add_filter_arguments(parser):
+    parser.add_argument('--filter', action='append', dest='filters', metavar='EXPR', default=[],
+                        help="only work on matching instances, e.g. vpc=vpc-0abc, subnet=subnet-1, type=t3.*, "
+                             "az=us-east-1a, tag:Env=prod, tag:Team!=ops or name~^web (repeat to combine)")
@@ -0,0 +1,249 @@
+#Simple AWS Manager (SAM) Toolbox is a set of lightweight scripts and modules for sysadmins in AWS
+#Copyright (C) 2024 Newton Advisory, LLC
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import json
+import hashlib
+from sam_toolbox.console import say
+from sam_toolbox.metrics import timer
+from sam_toolbox.writers import FORMATS
+
+# Grouping identical outputs
+# A command such as cat /etc/os-release run across a fleet mostly returns the same few outputs. With --group each
+# instance's output is hashed as its result arrives and the instances are grouped by identical output:
+#   the report keeps one row per instance, with the output's hash in an output_hash column instead of the output
+#   <report>-groups.json holds every unique output once, with its status, exit code and the instances that returned it
+# The hash covers the status, the exit code, stdout and stderr. When the full outputs were saved through an output
+# store, the saved files are hashed instead of the inline output, which SSM cuts off at 24,000 characters
+#
+# --diff compares the groups with those of a previous grouped run and writes <report>-diff.json listing the instances
+# whose output changed, the new ones and the ones missing since. Both runs must hash the same way, so compare runs
+# made with or without an output store alike
+#
+# Groups are a dict {hash: group}, each group a dict as saved in the groups file. Only the first instance's output
+# of each group is kept in memory
+#
+# The groups file is written once, when the report is closed. Until then each grouped instance is appended to
+# <report>-groups.json.log as one JSON line, carrying its group's output the first time the group is seen, so a run
+# killed without closing its report can still be resumed with its groups. The log is removed once the file is written
+
+OUTLIER_SHARE = 0.05  # Groups holding less than this share of the instances are highlighted as outliers
+SUMMARY_GROUPS = 20  # Most groups printed after a run, largest first
+CHUNK_SIZE = 1024 * 1024
+
+def add_grouping_arguments(parser):
+    parser.add_argument('--group', action='store_true',
+                        help="group instances by identical output and save each unique output once, in <report>-groups.json")
+    parser.add_argument('--diff', metavar='FILE',
+                        help="compare the outputs with a previous grouped run's report or groups file (implies --group)")
+
+def groups_path(csv_file):
+    return f"{strip_report_extension(csv_file)}-groups.json"
+
+def diff_path(csv_file):
+    return f"{strip_report_extension(csv_file)}-diff.json"
+
+def group_log_path(groups_file):
+    return f"{groups_file}.log"
+
+# spade.csv, spade.jsonl.gz and spade.parquet all become spade. Only report formats are stripped, so kernels.v2.csv
+# becomes kernels.v2
+
+def strip_report_extension(path):
+    for extension in sorted(FORMATS, key=len, reverse=True):
+        if path.endswith(f".{extension}") and len(os.path.basename(path)) > len(extension) + 1:
+            return path[:-len(extension) - 1]
+    return path
+
+# Returns the hash of a CommandResult's output, reading saved output files in chunks
+
+def output_digest(result):
+    digest = hashlib.sha256(f"{result.status}\0{result.response_code}\0".encode())
+    for inline, saved in ((result.invocation_response, result.output_file), (result.standard_error, result.error_file)):
+        if saved:
+            with open(saved, 'rb') as file:
+                for chunk in iter(lambda: file.read(CHUNK_SIZE), b''):
+                    digest.update(chunk)
+        else:
+            digest.update(str(inline or '').encode())
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+# Passes the command results through, adding each to groups and filling in its output_hash
+# With pending, a list, the log line of each result is added to it for append_group_log
+
+def group_results(command_results, groups, pending=None):
+    for result in command_results:
+        with timer('output hashing'):
+            digest = output_digest(result)
+            is_new = digest not in groups
+            instance = add_to_group(groups, result, digest)
+            if pending is not None:
+                entry = {'output_hash': digest, 'instance': instance}
+                if is_new:
+                    entry['group'] = {key: value for key, value in groups[digest].items() if key != 'instances'}
+                pending.append(entry)
+        yield result._replace(output_hash=digest)
+
+# Adds the result's instance to the group of its output and returns the instance entry
+
+def add_to_group(groups, result, digest):
+    group = groups.get(digest)
+    if group is None:
+        group = groups[digest] = {
+            'output_hash': digest, 'status': result.status, 'response_code': result.response_code,
+            'output': result.invocation_response, 'standard_error': result.standard_error,
+            'output_file': result.output_file, 'error_file': result.error_file, 'instances': [],
+        }
+    instance = {'instance_id': result.instance_id, 'instance_name': result.instance_name,
+                'account_id': result.account_id, 'region': result.region}
+    group['instances'].append(instance)
+    return instance
+
+# Appends the pending log lines to the group log and makes them durable, then clears them
+
+def append_group_log(pending, path):
+    if not pending:
+        return
+    with open(path, 'a') as file:
+        for entry in pending:
+            file.write(json.dumps(entry, default=str) + '\n')
+        file.flush()
+        os.fsync(file.fileno())
+    pending.clear()
+
+# Writes the groups file and removes the log it replaces
+
+def finish_groups(groups, path):
+    save_groups(groups, path)
+    if os.path.exists(group_log_path(path)):
+        os.remove(group_log_path(path))
+
+# Loads the groups of an interrupted run: its groups file if it got that far, plus whatever its log holds
+# Instances already grouped are skipped, so a log left next to a finished groups file does no harm
+
+def load_run_groups(path):
+    groups = load_groups(path) if os.path.exists(path) else {}
+    if not os.path.exists(group_log_path(path)):
+        return groups
+    grouped = set(instance_hashes(groups))
+    with open(group_log_path(path)) as file:
+        for line in file:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                break  # A line cut off by the interruption
+            digest = entry['output_hash']
+            if digest not in groups and 'group' in entry:
+                groups[digest] = {**entry['group'], 'instances': []}
+            if digest in groups and entry['instance']['instance_id'] not in grouped:
+                groups[digest]['instances'].append(entry['instance'])
+                grouped.add(entry['instance']['instance_id'])
+    return groups
+
+# Writes the groups, largest first, replacing the file in one step so an interruption never leaves half a file
+
+def save_groups(groups, path):
+    ordered = sorted(groups.values(), key=lambda group: -len(group['instances']))
+    document = {'instances': sum(len(group['instances']) for group in ordered),
+                'groups': [{**group, 'count': len(group['instances'])} for group in ordered]}
+    temporary = f"{path}.tmp"
+    with open(temporary, 'w') as file:
+        json.dump(document, file, indent=1)
+    os.replace(temporary, path)
+
+# Loads the groups saved by a grouped run, from its groups file or from its report next to it
+# Raises ValueError if there are none
+
+def load_groups(path):
+    if not path.endswith('-groups.json'):
+        path = groups_path(path)
+    try:
+        with open(path) as file:
+            document = json.load(file)
+        groups = {group['output_hash']: group for group in document['groups']}
+    except (OSError, ValueError, KeyError, TypeError):
+        raise ValueError(f"No groups found in {path}, the previous run must have been made with --group")
+    for group in groups.values():
+        group.pop('count', None)
+    return groups
+
+# Prints the unique outputs, largest group first. When most instances agree, groups holding few of them are shown in yellow
+# Each group is shown by the first line of its output that the largest group's output does not have, which is usually
+# the line that makes it different
+
+def print_group_summary(groups):
+    total = sum(len(group['instances']) for group in groups.values())
+    if not total:
+        return
+    say(f"\n{len(groups)} unique output(s) across {total} instance(s):")
+    ordered = sorted(groups.values(), key=lambda group: -len(group['instances']))
+    common_lines = set(group_lines(ordered[0]))
+    majority = len(ordered[0]['instances']) * 2 > total
+    for index, group in enumerate(ordered[:SUMMARY_GROUPS]):
+        count = len(group['instances'])
+        lines = group_lines(group)
+        distinct = [text for text in lines if text not in common_lines] if index else lines
+        sample = (distinct or lines or [''])[0][:60]
+        line = f"{count:>7}  {group['output_hash'][:12]}  {group['status']} ({group['response_code']})  {sample}"
+        if majority and count < total * OUTLIER_SHARE:
+            example = ', '.join(instance['instance_id'] for instance in group['instances'][:3])
+            say(f"{line}  [{example}{', ...' if count > 3 else ''}]", 'yellow')
+        else:
+            say(line)
+    if len(ordered) > SUMMARY_GROUPS:
+        say(f"... and {len(ordered) - SUMMARY_GROUPS} smaller group(s), see the groups file")
+
+def group_lines(group):
+    return [text.strip() for text in f"{group['output'] or ''}\n{group['standard_error'] or ''}".split('\n') if text.strip()]
+
+# Compares the groups of two runs instance by instance
+# Returns {'changed': [...], 'new': [...], 'missing': [...]}, each entry naming the instance and its output hashes
+
+def diff_groups(previous, current):
+    previous_hashes = instance_hashes(previous)
+    current_hashes = instance_hashes(current)
+    diff = {'changed': [], 'new': [], 'missing': []}
+    for instance_id, (instance, digest) in current_hashes.items():
+        if instance_id not in previous_hashes:
+            diff['new'].append({**instance, 'output_hash': digest})
+        elif previous_hashes[instance_id][1] != digest:
+            diff['changed'].append({**instance, 'previous_hash': previous_hashes[instance_id][1], 'output_hash': digest})
+    for instance_id, (instance, digest) in previous_hashes.items():
+        if instance_id not in current_hashes:
+            diff['missing'].append({**instance, 'previous_hash': digest})
+    return diff
+
+def instance_hashes(groups):
+    return {instance['instance_id']: (instance, digest) for digest, group in groups.items() for instance in group['instances']}
+
+# Prints how many instances changed output, grouped by the change from one output to another, and saves the diff
+
+def report_diff(diff, path, previous_file):
+    with open(path, 'w') as file:
+        json.dump({'previous': previous_file, **diff}, file, indent=1)
+
+    if not any(diff.values()):
+        say(f"\nNo output changed since {previous_file}", 'green')
+        return
+    say(f"\nCompared with {previous_file}: {len(diff['changed'])} changed, {len(diff['new'])} new, {len(diff['missing'])} missing")
+    transitions = {}
+    for entry in diff['changed']:
+        transitions.setdefault((entry['previous_hash'], entry['output_hash']), []).append(entry['instance_id'])
+    for (before, after), instance_ids in sorted(transitions.items(), key=lambda item: -len(item[1])):
+        example = ', '.join(instance_ids[:3]) + (', ...' if len(instance_ids) > 3 else '')
+        say(f"{len(instance_ids):>7}  {before[:12]} -> {after[:12]}  [{example}]", 'yellow')
+    say(f"Diff saved to {path}")
@@ -0,0 +1,326 @@
+#Simple AWS Manager (SAM) Toolbox is a set of lightweight scripts and modules for sysadmins in AWS
+#Copyright (C) 2024 Newton Advisory, LLC
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import re
+import json
+import time
+import sqlite3
+import argparse
+from datetime import datetime
+from sam_toolbox.clients import get_client
+from sam_toolbox.console import say
+from sam_toolbox.fanout import iter_across_targets
+from sam_toolbox.filters import FILTER_PATTERN
+from sam_toolbox.inventory import iter_instances, instance_name
+
+# Local inventory index
+# sam-list --index saves everything describe_instances returns about every matching instance, in every target, to a
+# SQLite database, together with the instances' tags, security groups, EBS volumes and SSM agent details. Questions
+# about the fleet can then be answered with --query from the database in milliseconds, without another API sweep:
+#   ./sam-list.py --query --filter subnet=subnet-0abc --filter image=ami-0123
+# Each --index run adds a timestamped snapshot per account and region, so older states stay queryable with --as-of
+# and --changes-since lists what changed between two points in time. The newest KEEP_SNAPSHOTS snapshots of each
+# account and region are kept
+# A snapshot taken with --filter holds only part of the inventory, so it records its filters and is left out of
+# --query and --changes-since, which would otherwise lose or report as removed every instance it does not hold.
+# Filtered snapshots are kept, KEEP_SNAPSHOTS of them apart from the full ones, and --snapshots lists them
+#
+# The database is ~/.sam-toolbox/inventory.db, or SAM_INDEX_DB or --index-db when set. Its tables:
+#   snapshots         one row per account/region and --index run, complete once every instance was saved, with the
+#                     filter expressions as a JSON list when only matching instances were saved
+#   instances         the columns queried most often, plus the full description as JSON in 'document'
+#   tags, security_groups, volumes, ssm     one row per tag, group, attached volume and SSM managed instance
+# Indexes cover tag keys and values, VPC, subnet, AMI and state. Any SQL client can read the database too
+
+INDEX_DB = os.environ.get('SAM_INDEX_DB', os.path.join(os.path.expanduser('~'), '.sam-toolbox', 'inventory.db'))
+KEEP_SNAPSHOTS = 30
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS snapshots (
+    snapshot_id INTEGER PRIMARY KEY, taken_at REAL, account_id TEXT, region TEXT, instance_count INTEGER, complete INTEGER DEFAULT 0,
+    filters TEXT);
+CREATE TABLE IF NOT EXISTS instances (
+    snapshot_id INTEGER, instance_id TEXT, name TEXT, state TEXT, instance_type TEXT, image_id TEXT, vpc_id TEXT,
+    subnet_id TEXT, availability_zone TEXT, private_ip TEXT, public_ip TEXT, launch_time TEXT, platform TEXT,
+    key_name TEXT, iam_profile TEXT, document TEXT, PRIMARY KEY (snapshot_id, instance_id));
+CREATE TABLE IF NOT EXISTS tags (snapshot_id INTEGER, instance_id TEXT, key TEXT, value TEXT);
+CREATE TABLE IF NOT EXISTS security_groups (snapshot_id INTEGER, instance_id TEXT, group_id TEXT, group_name TEXT);
+CREATE TABLE IF NOT EXISTS volumes (
+    snapshot_id INTEGER, instance_id TEXT, volume_id TEXT, device_name TEXT, size INTEGER, volume_type TEXT,
+    encrypted INTEGER, delete_on_termination INTEGER);
+CREATE TABLE IF NOT EXISTS ssm (
+    snapshot_id INTEGER, instance_id TEXT, ping_status TEXT, agent_version TEXT, platform_type TEXT, platform_name TEXT,
+    platform_version TEXT, last_ping TEXT);
+CREATE INDEX IF NOT EXISTS snapshots_target ON snapshots (account_id, region, complete);
+CREATE INDEX IF NOT EXISTS instances_vpc ON instances (vpc_id, snapshot_id);
+CREATE INDEX IF NOT EXISTS instances_subnet ON instances (subnet_id, snapshot_id);
+CREATE INDEX IF NOT EXISTS instances_image ON instances (image_id, snapshot_id);
+CREATE INDEX IF NOT EXISTS instances_state ON instances (state, snapshot_id);
+CREATE INDEX IF NOT EXISTS tags_key_value ON tags (key, value, snapshot_id);
+CREATE INDEX IF NOT EXISTS tags_instance ON tags (snapshot_id, instance_id);
+CREATE INDEX IF NOT EXISTS security_groups_instance ON security_groups (snapshot_id, instance_id);
+CREATE INDEX IF NOT EXISTS volumes_instance ON volumes (snapshot_id, instance_id);
+CREATE INDEX IF NOT EXISTS ssm_instance ON ssm (snapshot_id, instance_id);
+"""
+
+# Query keys -> (column or table the value is matched against). The keys of sam_toolbox.filters work here too
+QUERY_COLUMNS = {
+    'vpc': 'i.vpc_id',
+    'subnet': 'i.subnet_id',
+    'type': 'i.instance_type',
+    'az': 'i.availability_zone',
+    'state': 'i.state',
+    'image': 'i.image_id',
+    'name': 'i.name',
+    'id': 'i.instance_id',
+    'ip': 'i.private_ip',
+    'platform': 'i.platform',
+    'account': 's.account_id',
+    'region': 's.region',
+}
+QUERY_TABLES = {
+    'sg': ('security_groups', ('group_id', 'group_name')),
+    'volume': ('volumes', ('volume_id',)),
+    'ssm': ('ssm', ('ping_status',)),
+}
+
+def add_index_arguments(parser):
+    parser.add_argument('--index', action='store_true',
+                        help="save the full inventory of every instance matching --filter to the local index, then exit")
+    parser.add_argument('--query', action='store_true',
+                        help="list the instances in the local index matching --filter, without contacting AWS")
+    parser.add_argument('--snapshots', action='store_true', help="list the snapshots in the local index, then exit")
+    parser.add_argument('--as-of', type=time_argument, metavar='WHEN',
+                        help="with --query, use the snapshots taken at or before WHEN (YYYY-MM-DD or YYYY-MM-DDTHH:MM)")
+    parser.add_argument('--changes-since', type=time_argument, metavar='WHEN',
+                        help="list the instances added, removed or changed since the snapshots taken at or before WHEN, then exit")
+    parser.add_argument('--index-db', default=INDEX_DB, metavar='FILE', help=f"the local index (default {INDEX_DB})")
+
+def time_argument(text):
+    try:
+        return datetime.fromisoformat(text).timestamp()
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"'{text}' is not a date or time such as 2024-06-11 or 2024-06-11T09:30")
+
+def open_index(path=INDEX_DB):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+    db = sqlite3.connect(path)
+    db.executescript(SCHEMA)
+    if 'filters' not in {row[1] for row in db.execute("PRAGMA table_info(snapshots)")}:
+        db.execute("ALTER TABLE snapshots ADD COLUMN filters TEXT")  # Indexes made before filters were recorded
+    db.create_function('regexp', 2, lambda pattern, value: value is not None and re.search(pattern, str(value)) is not None)
+    return db
+
+# Yields what one target's snapshot is made of, as (kind, item) pairs: every instance, then the volumes and the SSM
+# managed instances, then ('done', None). Volumes and SSM details the credentials cannot read are left out with a warning
+
+def iter_target_inventory(target, filters=None, predicate=None):
+    from botocore.exceptions import ClientError
+    session = target['session']
+    instance_ids = set()
+    for instance in iter_instances(get_client('ec2', session), filters=filters, predicate=predicate):
+        instance_ids.add(instance['InstanceId'])
+        yield 'instance', instance
+
+    for kind, service, operation, key in (('volume', 'ec2', 'describe_volumes', 'Volumes'),
+                                          ('ssm', 'ssm', 'describe_instance_information', 'InstanceInformationList')):
+        try:
+            for page in get_client(service, session).get_paginator(operation).paginate():
+                for item in page[key]:
+                    attached = [a['InstanceId'] for a in item.get('Attachments', [])] if kind == 'volume' else [item['InstanceId']]
+                    if any(instance_id in instance_ids for instance_id in attached):
+                        yield kind, item
+        except ClientError as e:
+            say(f"Could not read {key} in {target['account_id']}/{target['region']}, they are left out: {e}", 'yellow')
+    yield 'done', None
+
+# Saves a snapshot of every target to the index, fetching the targets concurrently and writing from this thread
+# With filters or a predicate the snapshots are marked as filtered and record expressions, the --filter expressions
+# they came from
+# Returns {(account_id, region): instance count} for the targets saved completely
+
+def index_targets(db, targets, filters=None, predicate=None, target_workers=8, expressions=None):
+    taken_at = time.time()
+    recorded_filters = json.dumps(list(expressions or [])) if filters or predicate else None
+    snapshot_ids = {}
+    counts = {}
+    for target, (kind, item) in iter_across_targets(targets, lambda target: iter_target_inventory(target, filters, predicate), target_workers):
+        key = (target['account_id'], target['region'])
+        if key not in snapshot_ids:
+            snapshot_ids[key] = db.execute("INSERT INTO snapshots (taken_at, account_id, region, filters) VALUES (?, ?, ?, ?)",
+                                              (taken_at, *key, recorded_filters)).lastrowid
+            counts[key] = 0
+        snapshot_id = snapshot_ids[key]
+        if kind == 'instance':
+            save_instance(db, snapshot_id, item)
+            counts[key] += 1
+        elif kind == 'volume':
+            save_volume(db, snapshot_id, item)
+        elif kind == 'ssm':
+            save_ssm(db, snapshot_id, item)
+        else:
+            db.execute("UPDATE snapshots SET instance_count = ?, complete = 1 WHERE snapshot_id = ?", (counts[key], snapshot_id))
+            prune_snapshots(db, *key)
+            db.commit()
+    db.commit()
+    return {key: count for key, count in counts.items()
+            if db.execute("SELECT complete FROM snapshots WHERE snapshot_id = ?", (snapshot_ids[key],)).fetchone()[0]}
+
+def save_instance(db, snapshot_id, instance):
+    instance_id = instance['InstanceId']
+    launch_time = instance.get('LaunchTime')
+    db.execute("INSERT OR REPLACE INTO instances VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", (
+        snapshot_id, instance_id, instance_name(instance), instance.get('State', {}).get('Name'), instance.get('InstanceType'),
+        instance.get('ImageId'), instance.get('VpcId'), instance.get('SubnetId'), instance.get('Placement', {}).get('AvailabilityZone'),
+        instance.get('PrivateIpAddress'), instance.get('PublicIpAddress'), launch_time.isoformat() if launch_time else None,
+        instance.get('PlatformDetails'), instance.get('KeyName'), instance.get('IamInstanceProfile', {}).get('Arn'),
+        json.dumps(instance, default=str),
+    ))
+    db.executemany("INSERT INTO tags VALUES (?, ?, ?, ?)",
+                   [(snapshot_id, instance_id, tag['Key'], tag['Value']) for tag in instance.get('Tags', [])])
+    db.executemany("INSERT INTO security_groups VALUES (?, ?, ?, ?)",
+                   [(snapshot_id, instance_id, group['GroupId'], group.get('GroupName')) for group in instance.get('SecurityGroups', [])])
+
+def save_volume(db, snapshot_id, volume):
+    for attachment in volume.get('Attachments', []):
+        db.execute("INSERT INTO volumes VALUES (?, ?, ?, ?, ?, ?, ?, ?)", (
+            snapshot_id, attachment['InstanceId'], volume['VolumeId'], attachment.get('Device'), volume.get('Size'),
+            volume.get('VolumeType'), volume.get('Encrypted'), attachment.get('DeleteOnTermination'),
+        ))
+
+def save_ssm(db, snapshot_id, info):
+    last_ping = info.get('LastPingDateTime')
+    db.execute("INSERT INTO ssm VALUES (?, ?, ?, ?, ?, ?, ?, ?)", (
+        snapshot_id, info['InstanceId'], info.get('PingStatus'), info.get('AgentVersion'), info.get('PlatformType'),
+        info.get('PlatformName'), info.get('PlatformVersion'), last_ping.isoformat() if hasattr(last_ping, 'isoformat') else last_ping,
+    ))
+
+# Drops the snapshots of an account and region beyond the newest KEEP_SNAPSHOTS full and KEEP_SNAPSHOTS filtered
+# ones, and incomplete ones left behind
+
+def prune_snapshots(db, account_id, region):
+    stale = []
+    for filtered in ('filters IS NULL', 'filters IS NOT NULL'):
+        stale += [row[0] for row in db.execute(
+            f"SELECT snapshot_id FROM snapshots WHERE account_id = ? AND region = ? AND complete = 1 AND {filtered} "
+            f"ORDER BY snapshot_id DESC LIMIT -1 OFFSET ?", (account_id, region, KEEP_SNAPSHOTS))]
+    newest = db.execute("SELECT MAX(snapshot_id) FROM snapshots WHERE account_id = ? AND region = ? AND complete = 1", (account_id, region)).fetchone()[0]
+    stale += [row[0] for row in db.execute(
+        "SELECT snapshot_id FROM snapshots WHERE account_id = ? AND region = ? AND complete = 0 AND snapshot_id < ?", (account_id, region, newest))]
+    for snapshot_id in stale:
+        for table in ('instances', 'tags', 'security_groups', 'volumes', 'ssm', 'snapshots'):
+            db.execute(f"DELETE FROM {table} WHERE snapshot_id = ?", (snapshot_id,))
+
+# Returns [(snapshot_id, taken_at, account_id, region, instance_count, filter expressions or None)], newest first
+
+def list_snapshots(db):
+    return [(*row[:5], json.loads(row[5]) if row[5] is not None else None) for row in db.execute(
+        "SELECT snapshot_id, taken_at, account_id, region, instance_count, filters FROM snapshots WHERE complete = 1 "
+        "ORDER BY taken_at DESC, account_id, region")]
+
+# Returns the ids of the newest complete, unfiltered snapshot of every account and region, taken at or before as_of
+# when given
+
+def current_snapshots(db, as_of=None):
+    return [row[0] for row in db.execute(
+        "SELECT MAX(snapshot_id) FROM snapshots WHERE complete = 1 AND filters IS NULL AND taken_at <= ? GROUP BY account_id, region",
+        (as_of if as_of is not None else float('inf'),))]
+
+# Turns filter expressions (see sam_toolbox.filters) into a SQL condition and its parameters
+# key=value matches any of its comma separated values, with * wildcards; key!=value matches none of them; key~regex
+# searches the value. tag:<Key> matches the instance's tag, and sg, volume and ssm match its security groups (id or
+# name), attached volume ids and SSM ping status
+# Raises ValueError for expressions that cannot be parsed
+
+def query_condition(expressions):
+    conditions = []
+    parameters = []
+    for expression in expressions or []:
+        match = FILTER_PATTERN.match(expression)
+        if not match or not match.group('value'):
+            raise ValueError(f"Invalid query '{expression}', expected key=value, key!=value or key~regex")
+        key, op, value = match.group('key'), match.group('op'), match.group('value')
+        if op == '~':
+            try:
+                re.compile(value)
+            except re.error as e:
+                raise ValueError(f"Invalid regular expression in query '{expression}': {e}")
+            test, values = "regexp(?, {column})", [value]
+        else:
+            values = [v.strip() for v in value.split(',')]
+            test = '(' + ' OR '.join("{column} GLOB ?" for _ in values) + ')'
+
+        if key.startswith('tag:'):
+            condition = ("EXISTS (SELECT 1 FROM tags t WHERE t.snapshot_id = i.snapshot_id AND t.instance_id = i.instance_id "
+                         "AND t.key = ? AND " + test.format(column='t.value') + ")")
+            condition_parameters = [key[4:], *values]
+        elif key in QUERY_TABLES:
+            table, columns = QUERY_TABLES[key]
+            tests = ' OR '.join(test.format(column=f"x.{column}") for column in columns)
+            condition = (f"EXISTS (SELECT 1 FROM {table} x WHERE x.snapshot_id = i.snapshot_id AND x.instance_id = i.instance_id "
+                         f"AND ({tests}))")
+            condition_parameters = values * len(columns)
+        elif key in QUERY_COLUMNS:
+            condition = test.format(column=QUERY_COLUMNS[key])
+            condition_parameters = values
+        else:
+            keys = list(QUERY_COLUMNS) + list(QUERY_TABLES)
+            raise ValueError(f"Unknown query key '{key}', expected tag:<Key> or one of: {', '.join(keys)}")
+        conditions.append(f"NOT IFNULL({condition}, 0)" if op == '!=' else condition)  # Missing values are not excluded
+        parameters += condition_parameters
+    return ' AND '.join(conditions) or '1', parameters
+
+# Returns the matching instances of the current (or as_of) snapshots as dicts, ordered by account, region and name
+# Raises ValueError for expressions that cannot be parsed
+
+def query_index(db, expressions=None, as_of=None):
+    condition, parameters = query_condition(expressions)
+    snapshot_ids = current_snapshots(db, as_of)
+    db.row_factory = sqlite3.Row
+    try:
+        rows = db.execute(
+            f"SELECT s.account_id, s.region, s.taken_at, i.* FROM instances i JOIN snapshots s ON s.snapshot_id = i.snapshot_id "
+            f"WHERE i.snapshot_id IN ({','.join('?' * len(snapshot_ids))}) AND {condition} "
+            f"ORDER BY s.account_id, s.region, i.name, i.instance_id",
+            [*snapshot_ids, *parameters]).fetchall()
+    finally:
+        db.row_factory = None
+    return [dict(row) for row in rows]
+
+# Compares every account and region's snapshot at or before since with its newest one
+# Returns {'added': [...], 'removed': [...], 'changed': [...]}, changed entries holding {column: [old, new]}
+
+CHANGE_COLUMNS = ('name', 'state', 'instance_type', 'image_id', 'vpc_id', 'subnet_id', 'private_ip', 'public_ip', 'iam_profile')
+
+def index_changes(db, since):
+    before = {(row['account_id'], row['region'], row['instance_id']): row for row in query_index(db, as_of=since)}
+    after = {(row['account_id'], row['region'], row['instance_id']): row for row in query_index(db)}
+    changes = {'added': [], 'removed': [], 'changed': []}
+    for key, row in after.items():
+        if key not in before:
+            changes['added'].append(row)
+            continue
+        differences = {column: [before[key][column], row[column]] for column in CHANGE_COLUMNS if before[key][column] != row[column]}
+        if differences:
+            changes['changed'].append({**row, 'changes': differences})
+    changes['removed'] = [row for key, row in before.items() if key not in after]
+    return changes
+
+def format_time(timestamp):
+    return datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')
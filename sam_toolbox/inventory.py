@@ -0,0 +1,184 @@
+#Simple AWS Manager (SAM) Toolbox is a set of lightweight scripts and modules for sysadmins in AWS
+#Copyright (C) 2024 Newton Advisory, LLC
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+from sam_toolbox.clients import get_session, get_client
+from sam_toolbox.console import say
+from sam_toolbox.cache import settings as cache_settings, cache_key, load_cache, store_cache, clear_cache
+
+ALL_STATES = ['pending', 'running', 'shutting-down', 'terminated', 'stopping', 'stopped']
+TRANSITIONAL_STATES = ['pending', 'shutting-down', 'stopping']
+IDENTITY_TTL = 12 * 60 * 60  # The account behind a set of credentials does not change, so it is cached for longer
+INVENTORY_CACHE = 'tagged-inventory'  # Renamed when tags were added, so entries cached without them are not read
+
+_session_accounts = {}  # session -> account id, known from build_targets or an earlier lookup
+
+# Returns the STS caller identity, cached per set of credentials and region
+
+def get_account_identity(session=None):
+    session = session or get_session()
+    credentials = session.get_credentials()
+    key = cache_key(credentials.access_key if credentials else None, session.region_name)
+    identity, _ = load_cache('identity', key, ttl=IDENTITY_TTL)
+    if identity is None:
+        response = get_client('sts', session).get_caller_identity()
+        identity = {'Account': response['Account'], 'Arn': response['Arn']}
+        store_cache('identity', key, identity)
+    return identity
+
+# Returns the account id of a session, looking it up with STS (see get_account_identity) only when it is not known yet
+# build_targets records the account of every session it makes, so assumed roles and --account-id never need the call
+
+def session_account_id(session=None):
+    session = session or get_session()
+    account_id = _session_accounts.get(session)
+    if account_id is None:
+        account_id = get_account_identity(session)['Account']
+        remember_account(session, account_id)
+    return account_id
+
+def remember_account(session, account_id):
+    _session_accounts[session] = account_id
+
+# Cache key for data that belongs to the session's account and region, or None with the cache disabled
+
+def account_cache_key(session, *parts):
+    if not cache_settings['enabled']:
+        return None
+    session = session or get_session()
+    return cache_key(session_account_id(session), session.region_name, *parts)
+
+# Yields every instance matching the states and filters, following all describe_instances pages so accounts with
+# more than 1000 instances are not silently truncated. Only one page is held in memory at a time, and instances the
+# optional predicate rejects are dropped as each page arrives
+
+def iter_instances(ec2, states=None, instance_ids=None, filters=None, predicate=None, page_size=1000):
+    params = {}
+    filters = list(filters or [])
+    if states:
+        filters.append({'Name': 'instance-state-name', 'Values': list(states)})
+    if filters:
+        params['Filters'] = filters
+    if instance_ids:
+        params['InstanceIds'] = list(instance_ids)
+    else:
+        params['PaginationConfig'] = {'PageSize': page_size}  # MaxResults cannot be combined with InstanceIds
+    paginator = ec2.get_paginator('describe_instances')
+    for page in paginator.paginate(**params):
+        for reservation in page['Reservations']:
+            for instance in reservation['Instances']:
+                if predicate is None or predicate(instance):
+                    yield instance
+
+# Describes the given instances, 200 per paginated describe_instances call since an instance-id filter accepts up to
+# 200 values. Instance ids that no longer exist are skipped rather than failing the call as InstanceIds would
+# Yields (chunk of instance ids, [instances found in it]) so callers can keep their own order within each chunk
+
+def iter_instance_chunks(ec2, instance_ids, filters=None, predicate=None, chunk_size=200):
+    instance_ids = list(instance_ids)
+    for i in range(0, len(instance_ids), chunk_size):
+        chunk_ids = instance_ids[i:i + chunk_size]
+        chunk_filter = [{'Name': 'instance-id', 'Values': chunk_ids}] + list(filters or [])
+        yield chunk_ids, list(iter_instances(ec2, filters=chunk_filter, predicate=predicate))
+
+# Yields every instance of instance_ids that still exists and matches the filters and predicate, one chunk at a time
+
+def iter_instances_by_id(ec2, instance_ids, filters=None, predicate=None):
+    for chunk_ids, instances in iter_instance_chunks(ec2, instance_ids, filters, predicate):
+        yield from instances
+
+# Returns {instance_id: state name} for every instance, following all describe_instance_status pages
+
+def fetch_instance_states(ec2):
+    paginator = ec2.get_paginator('describe_instance_status')
+    return {
+        status['InstanceId']: status['InstanceState']['Name']
+        for page in paginator.paginate(IncludeAllInstances=True)
+        for status in page['InstanceStatuses']
+    }
+
+def instance_name(instance, tag_key='Name'):
+    return next((tag['Value'] for tag in instance.get('Tags', []) if tag['Key'] == tag_key), f'No {tag_key} Tag')
+
+# Uses the EC2 API to create a real-time inventory of EC2 instances as (instance_id, name, state, tags)
+# This function is scoped to the region and account and does not see global resources
+# The describe_instances and describe_instance_status page streams are fetched concurrently
+# To use a different tag for the instance name, change tag_key to the key of the desired tag's key/value pair
+
+def iter_inventory(ec2=None, states=ALL_STATES, tag_key='Name', filters=None, predicate=None):
+    ec2 = ec2 or get_client('ec2')
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        states_future = executor.submit(fetch_instance_states, ec2)
+        instances = [inventory_entry(instance, tag_key) for instance in iter_instances(ec2, states, filters=filters, predicate=predicate)]
+        state_by_id = states_future.result()
+
+    for instance_id, name, described_state, tags in instances:
+        # describe_instance_status is preferred, falling back to the state describe_instances reported
+        yield instance_id, name, state_by_id.get(instance_id, described_state), tags
+
+def inventory_entry(instance, tag_key='Name'):
+    tags = {tag['Key']: tag['Value'] for tag in instance.get('Tags', [])}
+    return instance['InstanceId'], instance_name(instance, tag_key), instance.get('State', {}).get('Name', 'Unknown'), tags
+
+# Returns the inventory as an ordered {instance_id: (name, state)} map, or (name, state, tags) with with_tags for
+# selecting by tag (see sam_toolbox.selection)
+# With the local cache enabled the inventory of every state is cached per account and region. Within the TTL only
+# instances whose state could have changed are queried again: those cached mid-transition, plus anything now
+# pending, stopping or shutting down (which includes new launches). Expired entries are downloaded again in full
+# Filtered inventories (see sam_toolbox.filters) are always downloaded, since only the matching instances are fetched
+
+def fetch_inventory(session=None, states=ALL_STATES, tag_key='Name', filters=None, predicate=None, with_tags=False):
+    session = session or get_session()
+    ec2 = get_client('ec2', session)
+    key = None if filters or predicate else account_cache_key(session, tag_key)
+    if key is None:
+        inventory = {instance_id: (name, state, tags) for instance_id, name, state, tags in iter_inventory(ec2, states, tag_key, filters, predicate)}
+    else:
+        cached, age = load_cache(INVENTORY_CACHE, key)
+        if cached is None:
+            inventory = {instance_id: (name, state, tags) for instance_id, name, state, tags in iter_inventory(ec2, ALL_STATES, tag_key)}
+            saved_at = None
+        else:
+            say(f"Using inventory cached {int(age)}s ago (run with --refresh to download it again)")
+            inventory = {instance_id: (name, state, tags) for instance_id, name, state, tags in cached}
+            inventory.update(refresh_transitional_instances(ec2, inventory, tag_key))
+            saved_at = time.time() - age  # Still expires a TTL after the full download
+        store_cache(INVENTORY_CACHE, key, [[instance_id, *details] for instance_id, details in inventory.items()], saved_at)
+
+    if with_tags:
+        return {instance_id: details for instance_id, details in inventory.items() if details[1] in states}
+    return {instance_id: (name, state) for instance_id, (name, state, tags) in inventory.items() if state in states}
+
+# Returns {instance_id: (name, state, tags)} for every instance that is, or was last seen, between states
+
+def refresh_transitional_instances(ec2, inventory, tag_key='Name'):
+    refreshed = {}
+    for instance in iter_instances(ec2, TRANSITIONAL_STATES):
+        instance_id, name, state, tags = inventory_entry(instance, tag_key)
+        refreshed[instance_id] = (name, state, tags)
+
+    stale_ids = [instance_id for instance_id, (name, state, tags) in inventory.items()
+                 if state in TRANSITIONAL_STATES and instance_id not in refreshed]
+    for instance in iter_instances_by_id(ec2, stale_ids):
+        instance_id, name, state, tags = inventory_entry(instance, tag_key)
+        refreshed[instance_id] = (name, state, tags)
+    return refreshed
+
+# Drops the cached inventory of the session's account and region, for use after changing instance states
+
+def forget_inventory(session, tag_key='Name'):
+    clear_cache(INVENTORY_CACHE, account_cache_key(session, tag_key))
@@ -0,0 +1,265 @@
+#Simple AWS Manager (SAM) Toolbox is a set of lightweight scripts and modules for sysadmins in AWS
+#Copyright (C) 2024 Newton Advisory, LLC
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import re
+import json
+from sam_toolbox.fanout import build_targets, fetch_target_inventories
+from sam_toolbox.filters import parse_filters
+from sam_toolbox.inventory import ALL_STATES
+from sam_toolbox.output_store import parse_output_store
+from sam_toolbox.rollout import LIMIT_PATTERN, rollout_settings
+from sam_toolbox.selection import build_index, parse_selection, select
+from sam_toolbox.writers import check_format
+
+# Job files let the scripts run without prompts, from cron, Lambda or CI
+# A job file is JSON, or YAML when PyYAML is installed, with an optional 'defaults' section merged into every job:
+#
+#   defaults:
+#     regions: us-east-1,us-west-2        # or 'all'; defaults to the session's region
+#     role_arns: []                       # roles to assume in other accounts
+#     account_id: '123456789012'          # account of the current credentials, skips the STS lookup (optional)
+#     concurrency: {target_workers: 8, max_workers: 8}
+#   jobs:
+#     - name: kernel-versions
+#       tool: spade                       # spade, init or list
+#       targets: {tags: {Env: prod}, states: [running], filters: ['vpc=vpc-0abc123'], instance_ids: []}
+#       command: uname -r                 # spade: the shell command to send
+#       output: reports/kernels.csv
+#       format: jsonl.gz                  # report format, see sam_toolbox.writers (default csv)
+#       rollout: {canary: 1, max_concurrency: 10%, max_errors: 2}   # spade and init: see sam_toolbox.rollout
+#       output_store: s3://my-bucket/spade   # spade: full outputs, saved next to the output (see sam_toolbox.output_store)
+#       group: true                       # spade: group identical outputs (see sam_toolbox.grouping)
+#       diff: reports/kernels-groups.json   # spade: report what changed since a previous grouped run
+#     - name: stop-dev
+#       tool: init
+#       targets: {tags: {Env: dev}, select: 'name=web-* !tag:Keep'}   # select: see sam_toolbox.selection
+#       action: stop                      # init: start, stop or reboot
+#       timeout: 600                      # init: seconds to wait for the new state (optional)
+#       monitor_reboot: false             # init: wait for status checks after a reboot (optional)
+#     - name: inventory
+#       tool: list
+#       values: [InstanceId, InstanceType, Placement.AvailabilityZone]
+#
+# Each script runs the jobs for its own tool, one after the other, reusing clients and inventory between them
+
+JOB_TOOLS = ('spade', 'init', 'list')
+JOB_KEYS = {'name', 'tool', 'targets', 'output', 'regions', 'role_arns', 'account_id', 'concurrency',
+            'command', 'action', 'timeout', 'monitor_reboot', 'values', 'rollout', 'output_store', 'group', 'diff', 'format'}
+TARGET_KEYS = {'instance_ids', 'tags', 'states', 'filters', 'select'}
+CONCURRENCY_KEYS = {'target_workers', 'max_workers', 'batch_size'}
+ROLLOUT_KEYS = {'canary', 'max_concurrency', 'max_errors'}
+INIT_ACTIONS = {
+    'start': 'aws ec2 start-instances',
+    'stop': 'aws ec2 stop-instances',
+    'reboot': 'aws ec2 reboot-instances',
+}
+
+def add_job_arguments(parser):
+    parser.add_argument('--job', metavar='FILE',
+                        help="run the jobs in a JSON or YAML job file without prompting, then exit")
+    parser.add_argument('--check', action='store_true',
+                        help="with --job, validate the job file and exit without contacting AWS")
+
+# Reads and validates a job file, returning (jobs for this tool, names of jobs for other tools)
+# cli_defaults holds settings given on the command line (regions, role_arns, account_id, format), which the job file can override
+# Raises ValueError describing the first problem found, before any job has run
+
+def load_jobs(path, tool, cli_defaults=None):
+    try:
+        with open(path) as file:
+            text = file.read()
+    except OSError as e:
+        raise ValueError(f"Cannot read job file {path}: {e}")
+
+    if os.path.splitext(path)[1].lower() in ('.yaml', '.yml'):
+        try:
+            import yaml
+        except ImportError:
+            raise ValueError("YAML job files need PyYAML (pip install pyyaml); use a .json job file instead")
+        try:
+            document = yaml.safe_load(text)
+        except yaml.YAMLError as e:
+            raise ValueError(f"Invalid YAML in {path}: {e}")
+    else:
+        try:
+            document = json.loads(text)
+        except ValueError as e:
+            raise ValueError(f"Invalid JSON in {path}: {e}")
+
+    if isinstance(document, list):
+        document = {'jobs': document}
+    if not isinstance(document, dict) or not isinstance(document.get('jobs'), list) or not document['jobs']:
+        raise ValueError(f"{path} must contain a non-empty 'jobs' list")
+    defaults = document.get('defaults') or {}
+    if not isinstance(defaults, dict):
+        raise ValueError("'defaults' must be a mapping")
+    defaults = {**{key: value for key, value in (cli_defaults or {}).items() if value}, **defaults}
+
+    jobs = []
+    skipped = []
+    for index, entry in enumerate(document['jobs'], start=1):
+        if not isinstance(entry, dict):
+            raise ValueError(f"Job {index} must be a mapping")
+        job = {**defaults, **entry}
+        job['concurrency'] = {**(defaults.get('concurrency') or {}), **(entry.get('concurrency') or {})}
+        job.setdefault('name', f"job {index}")
+        job.setdefault('tool', tool)
+        validate_job(job)
+        if job['tool'] == tool:
+            jobs.append(job)
+        else:
+            skipped.append(job['name'])
+    return jobs, skipped
+
+def validate_job(job):
+    name = job['name']
+    unknown = set(job) - JOB_KEYS
+    if unknown:
+        raise ValueError(f"Job '{name}': unknown keys {', '.join(sorted(unknown))}")
+    if job['tool'] not in JOB_TOOLS:
+        raise ValueError(f"Job '{name}': tool must be one of {', '.join(JOB_TOOLS)}")
+
+    targets = job.get('targets') or {}
+    if not isinstance(targets, dict) or set(targets) - TARGET_KEYS:
+        raise ValueError(f"Job '{name}': targets may only contain {', '.join(sorted(TARGET_KEYS))}")
+    if not isinstance(targets.get('tags', {}), dict):
+        raise ValueError(f"Job '{name}': targets.tags must map tag keys to values")
+    for key in ('instance_ids', 'states', 'filters'):
+        if not isinstance(targets.get(key, []), list):
+            raise ValueError(f"Job '{name}': targets.{key} must be a list")
+    parse_filters(targets.get('filters'))  # Raises ValueError for bad expressions
+    if 'select' in targets:
+        if not isinstance(targets['select'], str):
+            raise ValueError(f"Job '{name}': targets.select must be a selection expression")
+        try:
+            parse_selection(targets['select'])
+        except ValueError as e:
+            raise ValueError(f"Job '{name}': targets.select: {e}")
+    if not isinstance(job.get('regions', ''), (str, list)) or not isinstance(job.get('role_arns', []), list):
+        raise ValueError(f"Job '{name}': regions must be a string or list and role_arns a list")
+    if 'account_id' in job and not re.fullmatch(r'\d{12}', str(job['account_id'])):
+        raise ValueError(f"Job '{name}': account_id must be a 12 digit AWS account id")
+
+    concurrency = job['concurrency']
+    if set(concurrency) - CONCURRENCY_KEYS or not all(isinstance(v, int) and v > 0 for v in concurrency.values()):
+        raise ValueError(f"Job '{name}': concurrency may only set positive integers for {', '.join(sorted(CONCURRENCY_KEYS))}")
+
+    rollout = job.get('rollout') or {}
+    if not isinstance(rollout, dict) or set(rollout) - ROLLOUT_KEYS:
+        raise ValueError(f"Job '{name}': rollout may only set {', '.join(sorted(ROLLOUT_KEYS))}")
+    if not all(LIMIT_PATTERN.match(str(value)) for value in rollout.values()):
+        raise ValueError(f"Job '{name}': rollout limits must be counts or percentages such as 10 or 25%")
+    if rollout and job['tool'] == 'list':
+        raise ValueError(f"Job '{name}': list jobs do not roll out")
+
+    if 'output_store' in job:
+        if job['tool'] != 'spade':
+            raise ValueError(f"Job '{name}': only spade jobs have an output_store")
+        try:
+            parse_output_store(str(job['output_store']))
+        except ValueError as e:
+            raise ValueError(f"Job '{name}': {e}")
+
+    if ('group' in job or 'diff' in job) and job['tool'] != 'spade':
+        raise ValueError(f"Job '{name}': only spade jobs group their outputs")
+    if not isinstance(job.get('group', False), bool) or not isinstance(job.get('diff', ''), str):
+        raise ValueError(f"Job '{name}': group must be true or false and diff the report or groups file of a previous run")
+
+    if 'format' in job:
+        try:
+            check_format(str(job['format']))
+        except ValueError as e:
+            raise ValueError(f"Job '{name}': {e}")
+
+    if job['tool'] == 'spade' and not (isinstance(job.get('command'), str) and job['command'].strip()):
+        raise ValueError(f"Job '{name}': spade jobs need a command")
+    if job['tool'] == 'init' and job.get('action') not in INIT_ACTIONS:
+        raise ValueError(f"Job '{name}': init jobs need an action of {', '.join(INIT_ACTIONS)}")
+    if job['tool'] == 'list' and not (isinstance(job.get('values'), list) and job['values']):
+        raise ValueError(f"Job '{name}': list jobs need a list of values")
+
+# Turns a job's target selectors into EC2 filters plus an optional client-side predicate
+# Tags, states and short instance id lists are sent to describe_instances; long id lists are checked as pages stream in
+
+def job_filters(job):
+    targets = job.get('targets') or {}
+    filters, predicate = parse_filters(targets.get('filters'))
+    for key, value in (targets.get('tags') or {}).items():
+        values = value if isinstance(value, list) else [value]
+        filters.append({'Name': f"tag:{key}", 'Values': [str(v) for v in values]})
+
+    instance_ids = targets.get('instance_ids') or []
+    if 0 < len(instance_ids) <= 200:  # An instance-id filter accepts up to 200 values
+        filters.append({'Name': 'instance-id', 'Values': instance_ids})
+    elif instance_ids:
+        wanted = set(instance_ids)
+        checks = [check for check in (predicate, lambda instance: instance['InstanceId'] in wanted) if check]
+        predicate = lambda instance: all(check(instance) for check in checks)
+    return filters, predicate
+
+# Returns the job's rollout settings, or None to send to every instance at once
+
+def job_rollout(job):
+    rollout = job.get('rollout') or {}
+    return rollout_settings(*(None if rollout.get(key) is None else str(rollout[key]) for key in ('canary', 'max_concurrency', 'max_errors')))
+
+def job_regions(job):
+    regions = job.get('regions')
+    return ','.join(regions) if isinstance(regions, list) else regions
+
+# Lookups shared between the jobs of one run are kept in a memo dict, so jobs using the same accounts, regions and
+# target selectors reuse the same sessions, clients and inventory
+
+def cached_lookup(memo, key, build):
+    if key not in memo:
+        memo[key] = build()
+    return memo[key]
+
+def job_targets_key(job):
+    return (job_regions(job), tuple(job.get('role_arns') or []), job.get('account_id'))
+
+def job_targets(job, memo):
+    key = ('targets',) + job_targets_key(job)
+    return cached_lookup(memo, key, lambda: build_targets(job_regions(job), job.get('role_arns'), job.get('account_id') and str(job['account_id'])))
+
+# Returns the job's selected instances as (inventory {instance_id: (name, state)}, {instance_id: target})
+# default_states applies when the job does not list states, for example only running instances for sam-list
+# The EC2 side selectors decide what is downloaded; a select expression then picks from that inventory through the
+# selection indexes, which are memoized with it so jobs sharing selectors only build them once
+
+def select_job_instances(job, targets, memo, default_states=ALL_STATES):
+    selector = dict(job.get('targets') or {})
+    selection = selector.pop('select', None)
+    states = selector.get('states') or default_states
+    filters, predicate = job_filters(job)
+    target_workers = job['concurrency'].get('target_workers', 8)
+    key = ('inventory', job_targets_key(job), json.dumps(selector, sort_keys=True), tuple(states))
+    inventory, instance_targets, _ = cached_lookup(memo, key, lambda: fetch_target_inventories(
+        targets, target_workers, states=states, filters=filters, predicate=predicate, with_tags=True))
+
+    if selection is None:
+        selected_ids = list(inventory)
+    else:
+        index = cached_lookup(memo, ('inventory-index',) + key[1:], lambda: build_index(inventory))
+        selected_ids = select(index, selection)
+    return {instance_id: inventory[instance_id][:2] for instance_id in selected_ids}, instance_targets
+
+# Drops memoized inventories, for use after a job has changed instance states
+
+def forget_job_inventories(memo):
+    for key in [key for key in memo if key[0] in ('inventory', 'inventory-index')]:
+        del memo[key]
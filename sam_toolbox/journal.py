@@ -0,0 +1,123 @@
+#Simple AWS Manager (SAM) Toolbox is a set of lightweight scripts and modules for sysadmins in AWS
+#Copyright (C) 2024 Newton Advisory, LLC
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import json
+import time
+import uuid
+import threading
+from sam_toolbox.console import say
+
+# Run journals let an interrupted sam-spade run be picked up again without sending the command a second time
+# Each run appends JSON lines to <run_id>.jsonl in ~/.sam-toolbox/runs (the Cloudshell home directory survives
+# disconnects), or in SAM_JOURNAL_DIR when set:
+#   {"event": "run", ...}        the command, output file, format, store and grouping, and the --regions/--role-arn of the targets
+#   {"event": "selected", ...}   the ready instances of one account/region target and their names
+#   {"event": "sent", ...}       a CommandId and the instances of the target that accepted it
+#   {"event": "status", ...}     an invocation that reached a completed status
+#   {"event": "written", ...}    instances whose output is safely on disk in the output file
+#   {"event": "finished"}        every invocation was collected
+# sent and written records are fsynced before the run moves on, so after a disconnect the journal never claims less
+# than was sent or more than was saved
+
+JOURNAL_DIR = os.environ.get('SAM_JOURNAL_DIR', os.path.join(os.path.expanduser('~'), '.sam-toolbox', 'runs'))
+
+def add_journal_arguments(parser):
+    parser.add_argument('--resume', metavar='RUN_ID',
+                        help="collect the missing results of an interrupted run ('last' for the most recent) instead of sending a new command")
+
+def journal_path(run_id):
+    return os.path.join(JOURNAL_DIR, f"{run_id}.jsonl")
+
+# Starts a journal for a new run and records its header. Returns the journal, a dict holding the open file
+# The run id sorts by start time, so 'last' can find the most recent run
+
+def start_journal(command, csv_file, include_targets, regions=None, role_arns=None, output_store=None, output_dir=None, output_format='csv',
+                  grouped=False):
+    run_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:6]}"
+    journal = open_journal(run_id)
+    record(journal, 'run', run_id=run_id, command=command, csv_file=csv_file, include_targets=include_targets,
+           regions=regions, role_arns=role_arns or [], output_store=output_store, output_dir=output_dir, output_format=output_format,
+           grouped=grouped, started_at=time.time())
+    say(f"Run ID: {run_id} (if interrupted, collect the remaining results with --resume {run_id})")
+    return journal
+
+def open_journal(run_id):
+    os.makedirs(JOURNAL_DIR, mode=0o700, exist_ok=True)
+    return {'run_id': run_id, 'file': open(journal_path(run_id), 'a'), 'lock': threading.Lock()}
+
+def close_journal(journal):
+    if journal is not None:
+        journal['file'].close()
+
+# Appends one event. Workers on several threads record events, so writes are serialized by the journal's lock
+# sync forces the line to disk before returning, for events that must survive a disconnect
+
+def record(journal, event, sync=False, **fields):
+    if journal is None:
+        return
+    line = json.dumps({'event': event, 'at': time.time(), **fields})
+    with journal['lock']:
+        journal['file'].write(line + '\n')
+        journal['file'].flush()
+        if sync:
+            os.fsync(journal['file'].fileno())
+
+# Returns the id of the most recently started run, or None if there is none
+
+def last_run_id():
+    try:
+        run_ids = sorted(name[:-len('.jsonl')] for name in os.listdir(JOURNAL_DIR) if name.endswith('.jsonl'))
+    except OSError:
+        return None
+    return run_ids[-1] if run_ids else None
+
+# Replays a journal into the state of its run:
+#   {'run': header, 'names': {instance_id: name}, 'targets': {instance_id: target label},
+#    'sent': {instance_id: command_id}, 'statuses': {instance_id: status}, 'written': set, 'finished': bool}
+# A line cut short by a disconnect can only be the last one and is ignored
+# Raises ValueError if the run cannot be found
+
+def load_journal(run_id):
+    state = {'run': None, 'names': {}, 'targets': {}, 'sent': {}, 'statuses': {}, 'written': set(), 'finished': False}
+    try:
+        with open(journal_path(run_id)) as file:
+            lines = file.readlines()
+    except OSError:
+        raise ValueError(f"No journal found for run {run_id} in {JOURNAL_DIR}")
+
+    for line in lines:
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            continue
+        event = entry['event']
+        if event == 'run':
+            state['run'] = entry
+        elif event == 'selected':
+            state['names'].update(entry['instances'])
+            state['targets'].update({instance_id: entry['target'] for instance_id in entry['instances']})
+        elif event == 'sent':
+            state['sent'].update({instance_id: entry['command_id'] for instance_id in entry['instance_ids']})
+        elif event == 'status':
+            state['statuses'][entry['instance_id']] = entry['status']
+        elif event == 'written':
+            state['written'].update(entry['instance_ids'])
+        elif event == 'finished':
+            state['finished'] = True
+    if state['run'] is None:
+        raise ValueError(f"The journal of run {run_id} has no run header")
+    return state
@@ -0,0 +1,217 @@
+#Simple AWS Manager (SAM) Toolbox is a set of lightweight scripts and modules for sysadmins in AWS
+#Copyright (C) 2024 Newton Advisory, LLC
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import sys
+import json
+import time
+import atexit
+import threading
+from contextlib import contextmanager
+from sam_toolbox.throttle import THROTTLING_ERROR_CODES
+
+# Run metrics, for tuning polling intervals and concurrency with data instead of guesses
+# With --metrics every client made by get_client() reports its API calls through botocore's events, and the scripts
+# time their phases (accounts, inventory, selection, SSM readiness, the run itself...) and the work their threads
+# share (report writing, poll sleeps, output downloads). When the script exits a summary table is printed, and with
+# --metrics FILE the same numbers are also written to FILE as JSON:
+#   phases       wall time of each phase and the API calls, retries and throttles made while it ran
+#   operations   per service.Operation: calls, errors, retries, throttled attempts and latency
+#   timers       time summed across threads, so it can exceed the wall time of the phase that ran it
+# Time spent at prompts falls between phases and shows as the rest of the wall time
+# Without --metrics nothing is hooked and phase() and timer() cost a flag check
+
+_lock = threading.Lock()
+_metrics = None  # The metrics of this run once enabled
+
+def add_metrics_arguments(parser):
+    parser.add_argument('--metrics', nargs='?', const='', metavar='FILE',
+                        help="print a summary of phase timings and AWS API calls at exit, and write them to FILE as JSON")
+
+# Turns metrics on for this run if --metrics was given, before any client is made
+# The summary is printed, and the file written, when the script exits, also after an error or Ctrl-C
+
+def configure_metrics(args, tool):
+    if getattr(args, 'metrics', None) is None:
+        return
+    global _metrics
+    _metrics = {
+        'tool': tool,
+        'started_at': time.time(),
+        'started': time.perf_counter(),
+        'phase': None,
+        'phases': {},
+        'operations': {},
+        'timers': {},
+    }
+    atexit.register(report_metrics, args.metrics or None)
+
+def metrics_enabled():
+    return _metrics is not None
+
+# Registers the event handlers on a new client. Called by get_client() for every client it creates
+# Latency is measured from before-call to after-call, so it includes botocore's own retries and their sleeps
+
+def instrument_client(client):
+    if _metrics is None:
+        return
+    events = client.meta.events
+    events.register('before-call.*.*', start_call)
+    events.register('after-call.*.*', end_call)
+    events.register('after-call-error.*.*', failed_call)
+    events.register('needs-retry.*.*', check_throttle)
+
+def operation_name(model):
+    return f"{model.service_model.service_name}.{model.name}"
+
+def start_call(model, context, **kwargs):
+    context['sam_metrics_operation'] = operation_name(model)  # after-call-error is not given the model
+    context['sam_metrics_started'] = time.perf_counter()
+
+def end_call(model, context, http_response, parsed, **kwargs):
+    error = http_response.status_code >= 300
+    retries = parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+    count_call(operation_name(model), context, error, retries)
+
+def failed_call(context, exception, **kwargs):
+    operation = context.get('sam_metrics_operation')
+    if operation:
+        count_call(operation, context, True, 0)
+
+# needs-retry fires after every attempt. Returning None leaves the decision to botocore's retry handler
+
+def check_throttle(operation, response=None, **kwargs):
+    if response is None or response[1].get('Error', {}).get('Code') not in THROTTLING_ERROR_CODES:
+        return None
+    with _lock:
+        operation_entry(operation_name(operation))['throttles'] += 1
+        phase_entry(_metrics['phase'])['throttles'] += 1
+    return None
+
+def count_call(operation, context, error, retries):
+    latency = time.perf_counter() - context.get('sam_metrics_started', time.perf_counter())
+    with _lock:
+        entry = operation_entry(operation)
+        entry['calls'] += 1
+        entry['errors'] += bool(error)
+        entry['retries'] += retries
+        entry['seconds'] += latency
+        entry['max_seconds'] = max(entry['max_seconds'], latency)
+        phase = phase_entry(_metrics['phase'])
+        phase['api_calls'] += 1
+        phase['retries'] += retries
+
+def operation_entry(operation):
+    return _metrics['operations'].setdefault(operation, {'calls': 0, 'errors': 0, 'retries': 0, 'throttles': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+
+# API calls made outside any phase are counted under '(other)'
+
+def phase_entry(name):
+    return _metrics['phases'].setdefault(name or '(other)', {'seconds': 0.0, 'runs': 0, 'api_calls': 0, 'retries': 0, 'throttles': 0})
+
+# Times a phase of the run on the main thread. API calls made meanwhile, from any thread, count towards it
+# A phase that runs again, such as one per job, adds to its earlier time
+
+@contextmanager
+def phase(name):
+    if _metrics is None:
+        yield
+        return
+    previous = _metrics['phase']
+    with _lock:
+        phase_entry(name)['runs'] += 1
+        _metrics['phase'] = name
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        with _lock:
+            phase_entry(name)['seconds'] += time.perf_counter() - started
+            _metrics['phase'] = previous
+
+# Adds the time of a block to a named timer. Safe to use from worker threads
+
+@contextmanager
+def timer(name):
+    if _metrics is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_time(name, time.perf_counter() - started)
+
+def add_time(name, seconds):
+    if _metrics is None:
+        return
+    with _lock:
+        entry = _metrics['timers'].setdefault(name, {'count': 0, 'seconds': 0.0})
+        entry['count'] += 1
+        entry['seconds'] += seconds
+
+# Returns the metrics collected so far as a plain dict, as written to the JSON file
+
+def metrics_snapshot():
+    with _lock:
+        wall = time.perf_counter() - _metrics['started']
+        return {
+            'tool': _metrics['tool'],
+            'started_at': _metrics['started_at'],
+            'wall_seconds': round(wall, 3),
+            'phases': {name: {**entry, 'seconds': round(entry['seconds'], 3)} for name, entry in _metrics['phases'].items()},
+            'operations': {
+                name: {**entry, 'seconds': round(entry['seconds'], 3), 'max_seconds': round(entry['max_seconds'], 3),
+                       'avg_ms': round(entry['seconds'] / entry['calls'] * 1000, 1) if entry['calls'] else 0.0,
+                       'max_ms': round(entry['max_seconds'] * 1000, 1)}  # From the unrounded maximum, so it is never below avg_ms
+                for name, entry in sorted(_metrics['operations'].items())
+            },
+            'timers': {name: {**entry, 'seconds': round(entry['seconds'], 3)} for name, entry in _metrics['timers'].items()},
+        }
+
+def report_metrics(path=None):
+    if _metrics is None:
+        return
+    snapshot = metrics_snapshot()
+    print_metrics(snapshot)
+    if path:
+        try:
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as file:
+                json.dump(snapshot, file, indent=2)
+            print(f"Metrics saved to {path}")
+        except OSError as e:
+            print(f"\033[91mCould not save metrics to {path}: {e}\033[0m", file=sys.stderr)
+
+def print_metrics(snapshot):
+    print(f"\n\033[1mRun metrics\033[0m ({snapshot['wall_seconds']:.2f}s wall time)")
+    phased = sum(entry['seconds'] for entry in snapshot['phases'].values())
+    print(f"{'Phase':<28}{'Time':>10}{'API calls':>11}{'Retries':>9}{'Throttles':>11}")
+    for name, entry in snapshot['phases'].items():
+        print(f"{name:<28}{entry['seconds']:>9.2f}s{entry['api_calls']:>11}{entry['retries']:>9}{entry['throttles']:>11}")
+    print(f"{'(prompts and the rest)':<28}{max(snapshot['wall_seconds'] - phased, 0):>9.2f}s")
+
+    if snapshot['operations']:
+        print(f"\n{'Operation':<40}{'Calls':>7}{'Errors':>8}{'Retries':>9}{'Throttles':>11}{'Avg ms':>9}{'Max ms':>9}")
+        for name, entry in snapshot['operations'].items():
+            print(f"{name:<40}{entry['calls']:>7}{entry['errors']:>8}{entry['retries']:>9}{entry['throttles']:>11}"
+                  f"{entry['avg_ms']:>9.1f}{entry['max_ms']:>9.1f}")
+
+    if snapshot['timers']:
+        print(f"\n{'Timer (summed across threads)':<40}{'Count':>7}{'Time':>10}")
+        for name, entry in snapshot['timers'].items():
+            print(f"{name:<40}{entry['count']:>7}{entry['seconds']:>9.2f}s")
@@ -0,0 +1,156 @@
+#Simple AWS Manager (SAM) Toolbox is a set of lightweight scripts and modules for sysadmins in AWS
+#Copyright (C) 2024 Newton Advisory, LLC
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import time
+import shutil
+import argparse
+from sam_toolbox.clients import get_client
+from sam_toolbox.console import say
+from sam_toolbox.metrics import timer
+
+# Full command output through an output store
+# get_command_invocation returns at most 24,000 characters of stdout and 8,000 of stderr. With --output-store SSM also
+# writes the complete streams to S3 or CloudWatch Logs, and each instance's stdout and stderr are streamed from there
+# into files in the local output directory as soon as its invocation completes, never holding a whole stream in memory
+#   s3://bucket/prefix            send_command uploads to the bucket, objects are downloaded in 1 MB chunks
+#   cloudwatch://log-group        send_command ships to the log group, events are written as their pages arrive
+#   file:///path                  a local directory laid out like the S3 prefix, for tests or a copy synced from S3
+# The directory backend does not change what send_command is asked to do
+
+S3_PLUGIN_PATH = ('awsrunShellScript', '0.awsrunShellScript')  # Where AWS-RunShellScript puts its streams in S3
+LOG_PLUGIN_ID = 'aws-runShellScript'  # The same plugin in CloudWatch log stream names
+CHUNK_SIZE = 1024 * 1024
+
+def add_output_store_arguments(parser):
+    parser.add_argument('--output-store', type=output_store_argument, metavar='URL',
+                        help="collect full stdout/stderr through s3://bucket/prefix, cloudwatch://log-group or file:///dir")
+    parser.add_argument('--output-dir', metavar='DIR',
+                        help="where full outputs are saved (default: the CSV file name with -output)")
+
+def output_store_argument(text):
+    try:
+        return parse_output_store(text)['url']
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+# Parses an output store URL into {'url', 'kind', and 'bucket'/'prefix', 'log_group' or 'path'}
+# Raises ValueError for URLs that name no store
+
+def parse_output_store(url):
+    scheme, _, rest = url.partition('://')
+    if scheme == 's3' and rest.split('/', 1)[0]:
+        bucket, _, prefix = rest.partition('/')
+        return {'url': url, 'kind': 's3', 'bucket': bucket, 'prefix': prefix.strip('/')}
+    if scheme == 'cloudwatch' and rest.strip('/'):
+        return {'url': url, 'kind': 'cloudwatch', 'log_group': rest.strip('/')}
+    if scheme == 'file' and rest:
+        return {'url': url, 'kind': 'file', 'path': rest}
+    raise ValueError(f"'{url}' is not an output store, expected s3://bucket/prefix, cloudwatch://log-group or file:///dir")
+
+def default_output_dir(csv_file):
+    return f"{os.path.splitext(csv_file)[0]}-output"
+
+# Returns the store bound to one account/region session, as passed to fetch_invocation_output
+
+def open_output_store(url, output_dir, session=None):
+    store = parse_output_store(url)
+    store['output_dir'] = output_dir
+    if store['kind'] == 's3':
+        store['client'] = get_client('s3', session)
+    elif store['kind'] == 'cloudwatch':
+        store['client'] = get_client('logs', session)
+    return store
+
+# Extra send_command parameters that point SSM at the store
+
+def send_command_params(store):
+    if store is None:
+        return {}
+    if store['kind'] == 's3':
+        params = {'OutputS3BucketName': store['bucket']}
+        if store['prefix']:
+            params['OutputS3KeyPrefix'] = store['prefix']
+        return params
+    if store['kind'] == 'cloudwatch':
+        return {'CloudWatchOutputConfig': {'CloudWatchLogGroupName': store['log_group'], 'CloudWatchOutputEnabled': True}}
+    return {}
+
+# Streams one stream ('stdout' or 'stderr') of an invocation into <output_dir>/<instance_id>.<stream>
+# SSM only writes non-empty streams and may finish uploading shortly after the invocation completes, so a stream the
+# inline output shows to be non-empty is waited for with backoff, and an empty one is not looked for at all
+# The wait is capped at max_wait seconds in all, since it holds up one of the monitor's fetch workers
+# Returns the file written, or None if the stream was empty or never arrived
+
+def save_stream(store, command_id, instance_id, stream, expected, max_wait=5):
+    from botocore.exceptions import ClientError
+    if not expected:
+        return None
+    os.makedirs(store['output_dir'], exist_ok=True)
+    destination = os.path.join(store['output_dir'], f"{instance_id}.{stream}")
+    deadline = time.monotonic() + max_wait
+    delay = 0.5
+    while True:
+        try:
+            with timer('output download'):
+                copied = copy_stream(store, command_id, instance_id, stream, destination)
+            if copied:
+                return destination
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('NoSuchKey', '404', 'ResourceNotFoundException'):
+                say(f"Could not fetch {stream} of {instance_id} from {store['url']}: {e}", 'red')
+                return None
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        time.sleep(min(delay, remaining))
+        delay *= 2
+    say(f"The {stream} of {instance_id} did not arrive in {store['url']}, only the inline output was kept", 'yellow')
+    return None
+
+# Copies the stream into destination chunk by chunk. Returns False if the store does not have it yet
+
+def copy_stream(store, command_id, instance_id, stream, destination):
+    if store['kind'] == 's3':
+        key = '/'.join(part for part in (store['prefix'], command_id, instance_id, *S3_PLUGIN_PATH, stream) if part)
+        body = store['client'].get_object(Bucket=store['bucket'], Key=key)['Body']
+        with open(destination, 'wb') as file:
+            for chunk in body.iter_chunks(CHUNK_SIZE):
+                file.write(chunk)
+        return True
+
+    if store['kind'] == 'cloudwatch':
+        params = {
+            'logGroupName': store['log_group'],
+            'logStreamName': f"{command_id}/{instance_id}/{LOG_PLUGIN_ID}/{stream}",
+            'startFromHead': True,
+        }
+        with open(destination, 'w') as file:
+            while True:
+                response = store['client'].get_log_events(**params)
+                for event in response['events']:
+                    file.write(event['message'] + '\n')
+                if response.get('nextForwardToken') in (None, params.get('nextToken')):
+                    break  # The same token comes back once the end of the stream is reached
+                params['nextToken'] = response['nextForwardToken']
+        return True
+
+    source = os.path.join(store['path'], command_id, instance_id, *S3_PLUGIN_PATH, stream)
+    if not os.path.exists(source):
+        return False
+    with open(source, 'rb') as reader, open(destination, 'wb') as file:
+        shutil.copyfileobj(reader, file, CHUNK_SIZE)
+    return True
@@ -0,0 +1,43 @@
+#Simple AWS Manager (SAM) Toolbox is a set of lightweight scripts and modules for sysadmins in AWS
+#Copyright (C) 2024 Newton Advisory, LLC
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from collections import namedtuple
+
+# The records the toolbox's stages return and yield
+# They are named tuples, so fields can be read by name (result.status) and record._asdict() gives the report row.
+# account_id and region name the target the instance was found in, and stay None until the record leaves its target
+
+# One instance of the inventory
+InstanceRecord = namedtuple('InstanceRecord', ['instance_id', 'name', 'state', 'tags', 'account_id', 'region'],
+                            defaults=[None, None])
+
+# The outcome of a shell command on one instance (sam-spade). output_file and error_file are set when the full
+# outputs were saved through an output store, output_hash when the outputs are grouped (see sam_toolbox.grouping)
+CommandResult = namedtuple('CommandResult', ['instance_id', 'instance_name', 'invocation_response', 'status', 'response_code',
+                                             'standard_error', 'output_file', 'error_file', 'account_id', 'region', 'output_hash'],
+                           defaults=[None, None, None, None, None])
+
+# The outcome of a start, stop or reboot on one instance (sam-init)
+ActionResult = namedtuple('ActionResult', ['instance_id', 'instance_name', 'previous_state', 'current_state', 'account_id', 'region'],
+                          defaults=[None, None])
+
+# The values collected for one instance (sam-list), {value name: value} in the order they were asked for
+ReportRecord = namedtuple('ReportRecord', ['instance_id', 'values', 'account_id', 'region'], defaults=[None, None])
+
+# Returns the record with the account and region of a target (see sam_toolbox.fanout)
+
+def with_target(record, target):
+    return record._replace(account_id=target['account_id'], region=target['region'])
@@ -0,0 +1,103 @@
+#Simple AWS Manager (SAM) Toolbox is a set of lightweight scripts and modules for sysadmins in AWS
+#Copyright (C) 2024 Newton Advisory, LLC
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from sam_toolbox.clients import get_client
+from sam_toolbox.fanout import target_label, run_across_targets, split_by_target
+from sam_toolbox.inventory import iter_instance_chunks
+from sam_toolbox.records import ReportRecord, with_target
+
+# Instance metadata reports, the stage behind sam-list:
+#   collect_reports             read the chosen values of the selected instances in every target
+#   iter_report                 the same for one session, yielding a ReportRecord per instance
+# Values are named as in VALUE_OPTIONS; dotted names walk into nested values of the instance description
+
+VALUE_OPTIONS = [
+    "InstanceId", "ImageId", "InstanceType", "KeyName", "LaunchTime",
+    "Placement.AvailabilityZone", "Placement.Tenancy", "PrivateDnsName",
+    "PrivateIpAddress", "PublicDnsName", "PublicIpAddress", "State.Name",
+    "SubnetId", "VpcId", "SecurityGroups", "Tags", "Architecture",
+    "RootDeviceType", "RootDeviceName", "BlockDeviceMappings",
+    "IamInstanceProfile.Arn", "VirtualizationType", "CpuOptions",
+    "PlatformDetails"
+]
+
+# Column types of the values that are not text, kept by the typed report formats (see sam_toolbox.writers)
+# CSV writes every value as text; missing values ('N/A') become nulls in the typed formats
+
+VALUE_TYPES = {
+    "LaunchTime": 'timestamp',
+    "CpuOptions": 'json',
+}
+
+MISSING_VALUE = 'N/A'
+
+# Flatteners for list values, joined into one comma separated CSV cell
+# To report a different part of a list value, edit the matching line below
+
+LIST_FLATTENERS = {
+    "SecurityGroups": lambda groups: ','.join([sg['GroupName'] for sg in groups]),
+    "Tags": lambda tags: ','.join([f"{tag['Key']}={tag['Value']}" for tag in tags]),
+    "BlockDeviceMappings": lambda mappings: ','.join([bdm['Ebs']['VolumeId'] for bdm in mappings if 'Ebs' in bdm]),
+    "NetworkInterfaces": lambda interfaces: ','.join([ni['NetworkInterfaceId'] for ni in interfaces]),
+}
+
+# Compiles a value name into a function reading it from an instance description, so each value is parsed once per
+# report rather than once per instance. Dotted names such as Placement.AvailabilityZone walk into nested values
+
+def compile_accessor(value):
+    if value in LIST_FLATTENERS:
+        flatten = LIST_FLATTENERS[value]
+        return lambda instance: flatten(instance.get(value, []))
+
+    path = value.split('.')
+    def accessor(instance):
+        current = instance
+        for key in path:
+            if not isinstance(current, dict) or key not in current:
+                return MISSING_VALUE
+            current = current[key]
+        return current
+    return accessor
+
+# Describes only the selected instances, 200 per paginated call, and reads every selected value with the compiled
+# accessors in a single pass. Each chunk's records are yielded in the order the instances were selected, so only
+# one chunk of descriptions is held at a time
+# Any filters (see sam_toolbox.filters) are applied again here, on the server where possible and on each page as it
+# streams in
+
+def iter_report(instance_id_name_map, value_map, filters=None, predicate=None, session=None):
+    # Initialize a boto3 client
+    ec2 = get_client('ec2', session)
+    accessors = [(value, compile_accessor(value)) for value in value_map]
+
+    for chunk_ids, instances in iter_instance_chunks(ec2, instance_id_name_map, filters, predicate):
+        values_by_id = {instance['InstanceId']: {value: accessor(instance) for value, accessor in accessors} for instance in instances}
+        for instance_id in chunk_ids:
+            if instance_id in values_by_id:
+                yield ReportRecord(instance_id, values_by_id[instance_id])
+
+# Collects the report from every target at the same time
+# Returns a ReportRecord carrying its account and region for every instance found, target by target in target order
+
+def collect_reports(targets, instance_id_name_map, instance_targets, value_map, filters=None, predicate=None, target_workers=8):
+    target_maps = split_by_target(instance_id_name_map, instance_targets, targets)
+    target_by_label = {target_label(target): target for target in targets}
+    target_reports = run_across_targets(
+        [target for target in targets if target_label(target) in target_maps],
+        lambda target: list(iter_report(target_maps[target_label(target)], value_map, filters, predicate, target['session'])),
+        target_workers,
+    )
+    return [with_target(report, target_by_label[label]) for label, reports in target_reports.items() for report in reports]
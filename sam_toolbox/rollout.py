@@ -0,0 +1,133 @@
+#Simple AWS Manager (SAM) Toolbox is a set of lightweight scripts and modules for sysadmins in AWS
+#Copyright (C) 2024 Newton Advisory, LLC
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import re
+import argparse
+from collections import deque
+from sam_toolbox.console import say
+
+# Rolling execution limits how much of the fleet a command or action reaches at once
+#   --canary N or N%            run on this many instances first, on their own, before anything else is released
+#   --max-concurrency N or N%   never have more than this many instances in progress (default: the whole fleet)
+#   --max-errors N or N%        halt once more instances than this have failed (default 0 once rolling)
+# Percentages are of the instances selected in each account/region target, which rolls out independently
+# Without any of these options everything is sent at once, as before
+#
+# A rollout is a dict holding the instances still queued, those in flight and the errors counted so far. The scripts
+# ask release() for the instances they may start now and report each one back with finish()
+
+LIMIT_PATTERN = re.compile(r'^(\d+)(%?)$')
+
+def add_rollout_arguments(parser):
+    parser.add_argument('--canary', type=limit_argument, metavar='N[%]',
+                        help="run on this many instances (or percent of them) first and wait for them before the rest")
+    parser.add_argument('--max-concurrency', type=limit_argument, metavar='N[%]',
+                        help="most instances (or percent of them) in progress at the same time")
+    parser.add_argument('--max-errors', type=limit_argument, metavar='N[%]',
+                        help="failed instances (or percent of them) allowed before the rollout halts (default 0 when rolling)")
+
+def limit_argument(text):
+    if not LIMIT_PATTERN.match(str(text).strip()):
+        raise argparse.ArgumentTypeError(f"'{text}' is not a count or a percentage such as 10 or 25%")
+    return str(text).strip()
+
+# Returns the rollout limits chosen on the command line or in a job, or None to send everything at once
+
+def rollout_settings(canary=None, max_concurrency=None, max_errors=None):
+    if canary is None and max_concurrency is None and max_errors is None:
+        return None
+    return {'canary': canary, 'max_concurrency': max_concurrency, 'max_errors': max_errors}
+
+# Turns a count or percentage into a number of instances out of fleet_size
+# Percentages round up so that 10% of 5 instances is still one instance
+
+def resolve_limit(limit, fleet_size, default):
+    if limit is None:
+        return default
+    count, percent = LIMIT_PATTERN.match(str(limit)).groups()
+    if percent:
+        return min(fleet_size, -(-fleet_size * int(count) // 100))
+    return min(fleet_size, int(count))
+
+def new_rollout(instance_ids, settings):
+    fleet_size = len(instance_ids)
+    canary = resolve_limit(settings.get('canary'), fleet_size, 0)
+    return {
+        'queue': deque(instance_ids),
+        'fleet_size': fleet_size,
+        'canary': canary,
+        'canary_left': canary,
+        'window': max(1, resolve_limit(settings.get('max_concurrency'), fleet_size, fleet_size)),
+        'max_errors': resolve_limit(settings.get('max_errors'), fleet_size, 0),
+        'in_flight': set(),
+        'errors': 0,
+        'phase': 'canary' if canary else 'rolling',
+        'halted': False,
+    }
+
+# Returns the instance ids that may start now, up to limit of them, and counts them as in flight
+# The canary wave is released alone, in as many calls as limit requires; the rest waits until every canary instance has
+# finished within the error budget
+
+def release(rollout, limit=None):
+    if rollout['halted'] or not rollout['queue']:
+        return []
+    if rollout['phase'] == 'canary':
+        if rollout['canary_left'] == rollout['canary']:
+            say(f"\nCanary: {rollout['canary']} of {rollout['fleet_size']} instances go first")
+        count = min(rollout['canary_left'], limit or rollout['canary_left'])
+        rollout['canary_left'] -= count
+        if not rollout['canary_left']:
+            rollout['phase'] = 'canary running'
+    elif rollout['phase'] == 'canary running':
+        if rollout['in_flight']:
+            return []
+        rollout['phase'] = 'rolling'
+        say(f"Canary passed, rolling out to the remaining {len(rollout['queue'])} instances ({rollout['window']} at a time)", 'green')
+        count = rollout['window']
+    else:
+        count = rollout['window'] - len(rollout['in_flight'])
+
+    count = min(count, len(rollout['queue']), limit or count)
+    released = [rollout['queue'].popleft() for _ in range(max(count, 0))]
+    rollout['in_flight'].update(released)
+    return released
+
+# Records that an instance finished, halting the rollout once more than max_errors instances have failed
+
+def finish(rollout, instance_id, failed=False):
+    rollout['in_flight'].discard(instance_id)
+    if failed:
+        rollout['errors'] += 1
+        if rollout['errors'] > rollout['max_errors'] and not rollout['halted']:
+            rollout['halted'] = True
+            say(f"Rollout halted: {rollout['errors']} instance(s) failed, more than the {rollout['max_errors']} allowed. "
+                f"{len(rollout['queue'])} instance(s) will not be started", 'red')
+
+# True while instances are queued that may still be released
+
+def has_work(rollout):
+    return bool(rollout['queue']) and not rollout['halted']
+
+# Failures still allowed before the rollout halts, for SSM's own MaxErrors
+
+def remaining_errors(rollout):
+    return max(rollout['max_errors'] - rollout['errors'], 0)
+
+# Instances left unstarted by a halted rollout
+
+def skipped_ids(rollout):
+    return list(rollout['queue']) if rollout['halted'] else []
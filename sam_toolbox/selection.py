@@ -0,0 +1,198 @@
+#Simple AWS Manager (SAM) Toolbox is a set of lightweight scripts and modules for sysadmins in AWS
+#Copyright (C) 2024 Newton Advisory, LLC
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import re
+import argparse
+from fnmatch import fnmatchcase
+
+# Selection expressions pick instances out of a listed inventory, for example
+#   1,4,10-20              reference numbers and ranges from the list
+#   all                    every listed instance (so does the Select All number or *)
+#   i-0abc123def456        an instance id
+#   name=web-*             Name tag, * and ? wildcards, several patterns separated by |
+#   name~^db-\d+$          Name tag matching a regular expression
+#   tag:Env=prod|stage     any other tag; tag:Env alone selects instances that have the tag
+#   state=running          instance state
+# Names containing spaces can be matched with ? wildcards or \s in a regular expression
+# Commas inside brackets, such as in name~^web-\d{1,3}$, belong to the regular expression and do not separate terms
+# Comma separated terms are added together. Space separated conditions within a term must all match, and a
+# condition written with != or starting with ! excludes what it would match:
+#   tag:Env=prod state=running, name=bastion       running prod instances plus the bastion
+#   1-200 !state=stopped                           the first 200 listed instances that are not stopped
+#
+# Conditions are answered from indexes built once per inventory (name, tag and state -> instance ids), so selecting
+# from thousands of instances only looks at the distinct names or tag values, never at every instance per condition
+
+CONDITION_PATTERN = re.compile(r'^(?P<key>name|state|id|tag:[^=!~]+)(?:(?P<op>!=|=|~)(?P<value>.+))?$')
+RANGE_PATTERN = re.compile(r'^(\d+)-(\d+)$')
+ALL_WORDS = ('all', '*')
+
+def add_selection_arguments(parser):
+    parser.add_argument('--select', metavar='EXPR', type=selection_argument,
+                        help="select instances with an expression such as 'tag:Env=prod state=running' instead of prompting")
+
+# Checks --select expressions while the arguments are parsed, before any inventory is downloaded
+
+def selection_argument(text):
+    try:
+        parse_selection(text)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+    return text
+
+# Builds the selection indexes for an ordered inventory of {instance_id: (name, state)} or (name, state, tags)
+# Inventories without tags can still be selected by number, id, name and state
+
+def build_index(inventory):
+    index = {'order': list(inventory), 'position': {}, 'names': {}, 'states': {}, 'tags': {}}
+    for position, (instance_id, details) in enumerate(inventory.items()):
+        index['position'][instance_id] = position
+        index['names'].setdefault(details[0], set()).add(instance_id)
+        index['states'].setdefault(details[1], set()).add(instance_id)
+        tags = details[2] if len(details) > 2 else {}
+        for key, value in tags.items():
+            index['tags'].setdefault(key, {}).setdefault(value, set()).add(instance_id)
+    return index
+
+# Parses a selection expression into a list of terms, each a list of (negate, kind, argument) conditions
+# Raises ValueError describing the first condition that cannot be parsed, so expressions can be checked before any
+# inventory is downloaded
+
+def parse_selection(expression):
+    terms = []
+    for term_text in split_terms(expression):
+        conditions = [parse_condition(word) for word in term_text.split()]
+        if conditions:
+            terms.append(conditions)
+    return terms
+
+# Splits an expression on the commas that are not inside (), [] or {}
+
+def split_terms(expression):
+    term_texts = []
+    depth = 0
+    start = 0
+    for position, character in enumerate(expression):
+        if character in '([{':
+            depth += 1
+        elif character in ')]}' and depth:
+            depth -= 1
+        elif character == ',' and not depth:
+            term_texts.append(expression[start:position])
+            start = position + 1
+    term_texts.append(expression[start:])
+    return term_texts
+
+def parse_condition(word):
+    if word.startswith('!') and len(word) > 1:
+        negate, kind, argument = parse_condition(word[1:])
+        return (not negate, kind, argument)
+    if word.lower() in ALL_WORDS:
+        return (False, 'all', None)
+    if word.isdigit():
+        return (False, 'range', (int(word), int(word)))
+    range_match = RANGE_PATTERN.match(word)
+    if range_match:
+        first, last = int(range_match.group(1)), int(range_match.group(2))
+        if first > last:
+            raise ValueError(f"Invalid range '{word}', the first number must not be greater than the last")
+        return (False, 'range', (first, last))
+    if word.startswith('i-'):
+        return (False, 'id', word)
+
+    match = CONDITION_PATTERN.match(word)
+    if not match:
+        raise ValueError(f"Cannot understand '{word}', expected a number, a range like 1-20, all, an instance id, "
+                         f"or name=, state=, id= or tag:<Key>= conditions")
+    negate = match.group('op') == '!='
+    key, op, value = match.group('key'), match.group('op'), match.group('value')
+    if op is None and not key.startswith('tag:'):
+        raise ValueError(f"'{word}' needs a value, for example {key}=...")
+    if op == '~':
+        try:
+            matcher = ('regex', re.compile(value))
+        except re.error as e:
+            raise ValueError(f"Invalid regular expression in '{word}': {e}")
+    elif op is None:
+        matcher = ('any', None)
+    else:
+        matcher = ('glob', value.split('|'))
+
+    if key.startswith('tag:'):
+        return (negate, 'tag', (key[4:], matcher))
+    return (negate, key, matcher)
+
+# Returns the instance ids selected by a parsed or unparsed expression, in inventory order
+# all_ref is the Select All number shown after the list, accepted anywhere in the expression
+# Raises ValueError for unparsable expressions and reference numbers outside the list
+
+def select(index, expression, all_ref=None):
+    terms = parse_selection(expression) if isinstance(expression, str) else expression
+    selected = set()
+    for conditions in terms:
+        matched = None
+        for negate, kind, argument in conditions:
+            ids = condition_ids(index, kind, argument, all_ref)
+            if negate:
+                ids = set(index['position']) - ids
+            matched = ids if matched is None else matched & ids
+            if not matched:
+                break
+        selected |= matched
+    return sorted(selected, key=index['position'].__getitem__)
+
+def condition_ids(index, kind, argument, all_ref=None):
+    if kind == 'all':
+        return set(index['position'])
+    if kind == 'range':
+        first, last = argument
+        if all_ref is not None and first == last == all_ref:
+            return set(index['position'])
+        if first < 1 or last > len(index['order']):
+            raise ValueError(f"Reference {first if first == last else f'{first}-{last}'} is outside the list (1-{len(index['order'])})")
+        return set(index['order'][first - 1:last])
+    if kind == 'id':
+        if isinstance(argument, str):
+            return {argument} & index['position'].keys()
+        return {instance_id for instance_id in index['position'] if value_matches(instance_id, argument)}
+    if kind == 'name':
+        return match_values(index['names'], argument)
+    if kind == 'state':
+        return match_values(index['states'], argument)
+    tag_key, matcher = argument
+    return match_values(index['tags'].get(tag_key, {}), matcher)
+
+# Unions the id sets of the index entries whose value matches. Plain values are dictionary lookups; wildcard and
+# regular expression matchers scan the distinct values only
+
+def match_values(ids_by_value, matcher):
+    kind, pattern = matcher
+    if kind == 'glob' and not any(char in glob for glob in pattern for char in '*?['):
+        values = [glob for glob in pattern if glob in ids_by_value]
+    else:
+        values = [value for value in ids_by_value if value_matches(value, matcher)]
+    selected = set()
+    for value in values:
+        selected |= ids_by_value[value]
+    return selected
+
+def value_matches(value, matcher):
+    kind, pattern = matcher
+    if kind == 'any':
+        return True
+    if kind == 'regex':
+        return pattern.search(value) is not None
+    return any(fnmatchcase(value, glob) for glob in pattern)
@@ -0,0 +1,43 @@
+#Simple AWS Manager (SAM) Toolbox is a set of lightweight scripts and modules for sysadmins in AWS
+#Copyright (C) 2024 Newton Advisory, LLC
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import time
+import random
+import threading
+
+# Adaptive backoff shared by the workers of a thread pool calling the same API. Each throttle doubles the delay
+# (up to 20 seconds) and each successful call halves it again, so the pool settles just under the account's
+# request rate. Create one with new_throttle() per pool and pass it to every worker
+
+THROTTLING_ERROR_CODES = ('ThrottlingException', 'Throttling', 'TooManyRequestsException', 'RequestLimitExceeded')
+
+def new_throttle():
+    return {'delay': 0.0, 'lock': threading.Lock()}
+
+def is_throttling_error(e):
+    return e.response.get('Error', {}).get('Code') in THROTTLING_ERROR_CODES
+
+def record_throttle(throttle, throttled):
+    with throttle['lock']:
+        if throttled:
+            throttle['delay'] = min(max(throttle['delay'] * 2, 0.5), 20.0)
+        else:
+            throttle['delay'] = throttle['delay'] / 2 if throttle['delay'] > 0.1 else 0.0
+
+def wait_for_throttle(throttle):
+    delay = throttle['delay']
+    if delay:
+        time.sleep(random.uniform(delay / 2, delay))  # Jitter keeps the workers from retrying in lockstep
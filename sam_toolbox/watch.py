@@ -0,0 +1,206 @@
+#Simple AWS Manager (SAM) Toolbox is a set of lightweight scripts and modules for sysadmins in AWS
+#Copyright (C) 2024 Newton Advisory, LLC
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import json
+import time
+import argparse
+from sam_toolbox.clients import get_client
+from sam_toolbox.console import say
+from sam_toolbox.fanout import target_label, run_across_targets
+from sam_toolbox.inventory import iter_instances_by_id, fetch_instance_states, instance_name
+from sam_toolbox.metrics import phase, timer
+from sam_toolbox.report import compile_accessor
+
+# Watch mode for sam-list
+# --watch SECONDS keeps the chosen values of every instance matching the filters in memory, keyed by instance id, and
+# polls for changes instead of downloading the whole report again. Each poll of each account/region target:
+#   describe_instance_status lists the state of every instance, 1000 per call
+#   only instances that are new or changed state are described again, 200 per call
+#   every --watch-full-every polls all instances are described, to catch changes that leave the state alone (tags, IPs)
+# The first poll describes everything and becomes the baseline. After it only the changes are printed, and every
+# event is appended to the change log as one JSON line:
+#   {"event": "present", ...}      an instance of the baseline, with its values
+#   {"event": "new", ...}          an instance launched, or one that started matching the filters, with its values
+#   {"event": "changed", ...}      {value: [old, new]} for every value that changed
+#   {"event": "terminated", ...}   an instance that was terminated, disappeared or no longer matches the filters
+# State.Name is always watched, whether or not it is one of the chosen values
+#
+# A watch is a dict per target holding the watched instances {instance_id: {'name', 'state', 'values'}} and the
+# states of the instances the filters left out, so those are not described again until their state changes
+
+STATE_VALUE = 'State.Name'
+
+def add_watch_arguments(parser):
+    parser.add_argument('--watch', type=interval_argument, metavar='SECONDS',
+                        help="keep watching the instances, polling every SECONDS and reporting only what changed")
+    parser.add_argument('--watch-full-every', type=int, default=10, metavar='N',
+                        help="describe every instance again every N polls, to catch changes that do not change the state (default 10)")
+    parser.add_argument('--watch-log', default='list-changes.jsonl', metavar='FILE',
+                        help="append the changes to FILE as JSON lines (default list-changes.jsonl)")
+
+def interval_argument(text):
+    try:
+        seconds = float(text)
+    except ValueError:
+        seconds = 0
+    if seconds <= 0:
+        raise argparse.ArgumentTypeError(f"'{text}' is not a number of seconds greater than 0")
+    return seconds
+
+def new_watch(value_map, filters=None, predicate=None):
+    values = list(value_map) + ([STATE_VALUE] if STATE_VALUE not in value_map else [])
+    return {
+        'accessors': [(value, compile_accessor(value)) for value in values],
+        'filters': list(filters or []),
+        'predicate': predicate,
+        'instances': {},
+        'ignored': {},
+        'polls': 0,
+    }
+
+# Polls one target and applies the changes to its watch
+# Returns the events, each a dict without its account and region, in the order the instances were described
+# A poll that fails is not counted, so a failed baseline is taken again on the next poll
+
+def poll_watch(watch, ec2, full=False):
+    baseline = watch['polls'] == 0
+    instances, ignored = watch['instances'], watch['ignored']
+    states = fetch_instance_states(ec2)
+
+    if baseline or full:
+        describe_ids = list(states)
+    else:
+        describe_ids = [instance_id for instance_id, state in states.items()
+                        if instance_id in instances and instances[instance_id]['state'] != state
+                        or instance_id in ignored and ignored[instance_id] != state
+                        or instance_id not in instances and instance_id not in ignored]
+
+    events = []
+    described = set()
+    for instance in iter_instances_by_id(ec2, describe_ids, watch['filters'], watch['predicate']):
+        instance_id = instance['InstanceId']
+        described.add(instance_id)
+        values = {value: accessor(instance) for value, accessor in watch['accessors']}
+        state = states.get(instance_id, values[STATE_VALUE])
+        values[STATE_VALUE] = state  # describe_instance_status is the fresher of the two
+        event = apply_instance(watch, instance_id, instance_name(instance), state, values, baseline)
+        if event:
+            events.append(event)
+
+    # Described instances the filters no longer match, and watched instances that have disappeared
+    for instance_id in describe_ids:
+        if instance_id not in described:
+            if instance_id in instances:
+                events.append(instance_event('terminated', instance_id, instances.pop(instance_id)))
+            ignored[instance_id] = states[instance_id]
+    for instance_id in [instance_id for instance_id in instances if instance_id not in states]:
+        details = instances.pop(instance_id)
+        if details['state'] != 'terminated':
+            events.append(instance_event('terminated', instance_id, details))
+    for instance_id in [instance_id for instance_id in ignored if instance_id not in states]:
+        del ignored[instance_id]
+    watch['polls'] += 1
+    return events
+
+# Records an instance's latest values. Returns its event, or None if nothing changed
+
+def apply_instance(watch, instance_id, name, state, values, baseline=False):
+    ignored = watch['ignored']
+    ignored.pop(instance_id, None)
+    previous = watch['instances'].get(instance_id)
+    details = {'name': name, 'state': state, 'values': values}
+    watch['instances'][instance_id] = details
+    if previous is None:
+        return instance_event('present' if baseline else 'new', instance_id, details, values=values)
+
+    changes = {value: [previous['values'].get(value), current] for value, current in values.items()
+               if previous['values'].get(value) != current}
+    if not changes:
+        return None
+    if state == 'terminated':
+        return instance_event('terminated', instance_id, details, changes=changes)
+    return instance_event('changed', instance_id, details, changes=changes)
+
+def instance_event(event, instance_id, details, **fields):
+    return {'event': event, 'instance_id': instance_id, 'instance_name': details['name'], **fields}
+
+# Prints a change event, new instances in green, terminated in red and changes in yellow
+
+def print_event(event, include_target=False):
+    label = f"{event['instance_id']} ({event['instance_name']})"
+    where = f" in {event['account_id']}/{event['region']}" if include_target else ''
+    if event['event'] == 'new':
+        say(f"+ {label}{where}: new, {event['values'].get(STATE_VALUE)}", 'green')
+    elif event['event'] == 'terminated':
+        say(f"- {label}{where}: terminated or no longer matching", 'red')
+    elif event['event'] == 'changed':
+        changes = ', '.join(f"{value} {old} -> {new}" for value, (old, new) in event['changes'].items())
+        say(f"~ {label}{where}: {changes}", 'yellow')
+
+# Polls every target every interval seconds until interrupted with Ctrl-C, printing and logging the changes
+# A target whose poll fails with an AWS error (throttling past the retries, a network outage) is reported and polled
+# again at the next interval, so a long watch survives passing errors
+# polls stops after that many polls, for scripts and tests; by default the watch runs until interrupted
+# Returns the number of change events seen after the baseline
+
+def watch_inventory(targets, value_map, filters=None, predicate=None, interval=60, full_every=10, log_path='list-changes.jsonl',
+                    target_workers=8, polls=None):
+    watches = {target_label(target): new_watch(value_map, filters, predicate) for target in targets}
+    by_label = {target_label(target): target for target in targets}
+    include_targets = len(targets) > 1
+    change_count = 0
+    poll_count = 0
+    announced = False
+
+    def poll(target):
+        from botocore.exceptions import BotoCoreError, ClientError
+        watch = watches[target_label(target)]
+        full = watch['polls'] > 0 and full_every > 0 and watch['polls'] % full_every == 0
+        try:
+            return poll_watch(watch, get_client('ec2', target['session']), full)
+        except (ClientError, BotoCoreError) as e:
+            say(f"Could not poll {target_label(target)}, trying again in {interval:g}s: {e}", 'red')
+            return []
+
+    with open(log_path, 'a') as log:
+        try:
+            while True:
+                started = time.monotonic()
+                with phase('watch'):
+                    target_events = run_across_targets(targets, poll, target_workers)
+                with timer('report writing'):
+                    for label, events in target_events.items():
+                        for event in events:
+                            target = by_label[label]
+                            event = {'at': time.time(), **event, 'account_id': target['account_id'], 'region': target['region']}
+                            log.write(json.dumps(event, default=str) + '\n')
+                            if event['event'] != 'present':
+                                print_event(event, include_targets)
+                                change_count += 1
+                    log.flush()
+
+                poll_count += 1
+                if not announced and any(watch['polls'] for watch in watches.values()):  # Once a baseline is taken
+                    announced = True
+                    watched = sum(len(watch['instances']) for watch in watches.values())
+                    say(f"Watching {watched} instance(s), polling every {interval:g}s. Press Ctrl-C to stop", 'green')
+                if polls is not None and poll_count >= polls:
+                    break
+                time.sleep(max(0, interval - (time.monotonic() - started)))
+        except KeyboardInterrupt:
+            say("\nStopped watching")
+    say(f"{change_count} change(s) logged to {log_path}")
+    return change_count
@@ -0,0 +1,221 @@
+#Simple AWS Manager (SAM) Toolbox is a set of lightweight scripts and modules for sysadmins in AWS
+#Copyright (C) 2024 Newton Advisory, LLC
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import io
+import os
+import csv
+import gzip
+import json
+import argparse
+import datetime
+from sam_toolbox.console import say
+
+# Report writers
+# Every script writes its report row by row through one of these formats, chosen with --format:
+#   csv                    the default, readable by anything
+#   csv.gz, jsonl.gz       gzip compressed, with the standard library
+#   csv.zst, jsonl.zst     zstandard compressed, needs the zstandard package (pip install zstandard)
+#   jsonl                  one JSON object per line, keeping numbers, timestamps and nested values typed
+#   parquet                columnar, needs pyarrow (pip install pyarrow); rows are buffered one row group at a time
+# Columns carry a type ('string', 'int', 'float', 'bool', 'timestamp' or 'json') so typed formats keep it; CSV
+# writes values exactly as before
+#
+# A writer is a dict holding the open file and its format. Write rows with write_row(), make what was written durable
+# with sync_writer() and finish with close_writer()
+
+FORMATS = ('csv', 'csv.gz', 'csv.zst', 'jsonl', 'jsonl.gz', 'jsonl.zst', 'parquet')
+FORMAT_PACKAGES = {'zst': ('zstandard', 'zstandard'), 'parquet': ('pyarrow', 'pyarrow')}  # suffix -> (module, pip name)
+ROW_GROUP_SIZE = 10000  # Parquet rows held in memory before a row group is written
+
+def add_format_arguments(parser):
+    parser.add_argument('--format', type=format_argument, default='csv', metavar='FORMAT',
+                        help=f"report format: {', '.join(FORMATS)} (default csv)")
+
+def format_argument(text):
+    try:
+        check_format(text)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+    return text
+
+# Raises ValueError for unknown formats, or formats whose optional package is not installed
+
+def check_format(output_format):
+    if output_format not in FORMATS:
+        raise ValueError(f"Unknown format '{output_format}', expected one of {', '.join(FORMATS)}")
+    suffix = output_format.rsplit('.', 1)[-1]
+    if suffix in FORMAT_PACKAGES:
+        module, package = FORMAT_PACKAGES[suffix]
+        try:
+            __import__(module)
+        except ImportError:
+            raise ValueError(f"The {output_format} format needs {package} (pip install {package})")
+
+# Swaps a report file's .csv extension for the format's, so spade.csv becomes spade.jsonl.gz
+
+def format_path(path, output_format):
+    if output_format == 'csv' or path.endswith(f".{output_format}"):
+        return path
+    base = path[:-len('.csv')] if path.endswith('.csv') else path
+    return f"{base}.{output_format}"
+
+# Parquet files are only readable once closed, so their rows are not durable until then and they cannot be appended to
+
+def can_append(output_format):
+    return output_format != 'parquet'
+
+# Opens a writer for fieldnames, typed by types ({column: type}, 'string' when missing)
+# null_marker is a placeholder value, such as sam-list's 'N/A', that typed formats write as null instead
+# append adds to an existing file (not for parquet), writing the CSV header only if the file is empty
+
+def open_writer(path, fieldnames, output_format='csv', types=None, null_marker=None, append=False):
+    check_format(output_format)
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    writer = {
+        'path': path,
+        'format': output_format,
+        'fieldnames': list(fieldnames),
+        'types': {name: (types or {}).get(name, 'string') for name in fieldnames},
+        'null_marker': null_marker,
+        'rows': 0,
+    }
+
+    if output_format == 'parquet':
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        writer['schema'] = pa.schema([(name, arrow_type(pa, writer['types'][name])) for name in writer['fieldnames']])
+        writer['file'] = pq.ParquetWriter(path, writer['schema'], compression='zstd')
+        writer['buffer'] = []
+        return writer
+
+    write_header = not (append and os.path.exists(path) and os.path.getsize(path))
+    writer['raw'] = open(path, 'ab' if append else 'wb')
+    if output_format.endswith('.gz'):
+        writer['stream'] = gzip.GzipFile(fileobj=writer['raw'], mode='wb')
+    elif output_format.endswith('.zst'):
+        import zstandard
+        writer['stream'] = zstandard.ZstdCompressor().stream_writer(writer['raw'], closefd=False)
+    else:
+        writer['stream'] = writer['raw']
+    writer['file'] = io.TextIOWrapper(writer['stream'], encoding='utf-8', newline='', write_through=True)
+    if output_format.startswith('csv'):
+        writer['csv'] = csv.DictWriter(writer['file'], fieldnames=writer['fieldnames'], extrasaction='ignore')
+        if write_header:
+            writer['csv'].writeheader()
+    return writer
+
+def write_row(writer, row):
+    writer['rows'] += 1
+    if 'csv' in writer:
+        writer['csv'].writerow(row)
+    elif writer['format'] == 'parquet':
+        writer['buffer'].append({name: typed_value(row.get(name), writer['types'][name], writer['null_marker'], for_parquet=True)
+                                 for name in writer['fieldnames']})
+        if len(writer['buffer']) >= ROW_GROUP_SIZE:
+            flush_row_group(writer)
+    else:
+        record = {name: typed_value(row.get(name), writer['types'][name], writer['null_marker']) for name in writer['fieldnames']}
+        writer['file'].write(json.dumps(record, default=str) + '\n')
+
+# Pushes everything written so far to disk. Returns True if those rows would survive an interruption
+
+def sync_writer(writer):
+    if writer['format'] == 'parquet':
+        return False
+    if writer['stream'] is not writer['raw']:
+        writer['stream'].flush()  # Ends the current compressed block so it can be read back
+    writer['raw'].flush()
+    os.fsync(writer['raw'].fileno())
+    return True
+
+def close_writer(writer):
+    if writer['format'] == 'parquet':
+        flush_row_group(writer)
+        writer['file'].close()
+        return
+    writer['file'].flush()
+    writer['file'].detach()  # The streams below are closed in order instead
+    if writer['stream'] is not writer['raw']:
+        writer['stream'].close()  # Writes the compressed stream's trailer
+    writer['raw'].flush()
+    os.fsync(writer['raw'].fileno())
+    writer['raw'].close()
+
+def flush_row_group(writer):
+    if writer['buffer']:
+        import pyarrow as pa
+        writer['file'].write_table(pa.Table.from_pylist(writer['buffer'], schema=writer['schema']))
+        writer['buffer'] = []
+
+def arrow_type(pa, column_type):
+    return {
+        'int': pa.int64(),
+        'float': pa.float64(),
+        'bool': pa.bool_(),
+        'timestamp': pa.timestamp('us', tz='UTC'),
+    }.get(column_type, pa.string())
+
+# Converts a value for a typed format. Timestamps become ISO 8601 text in JSON Lines and stay datetimes for Parquet,
+# json columns stay nested in JSON Lines and are JSON encoded text in Parquet
+
+def typed_value(value, column_type, null_marker=None, for_parquet=False):
+    if value is None or (null_marker is not None and value == null_marker):
+        return None
+    if column_type == 'int':
+        return int(value)
+    if column_type == 'float':
+        return float(value)
+    if column_type == 'bool':
+        return bool(value)
+    if column_type == 'timestamp':
+        if isinstance(value, str):
+            value = datetime.datetime.fromisoformat(value)
+        return value if for_parquet else value.isoformat()
+    if column_type == 'json':
+        return json.dumps(value, default=str) if for_parquet else value
+    return value if isinstance(value, str) else str(value)
+
+# Returns the values of one column of a report written by a previous run, for example to skip rows already written
+# Reading stops quietly at damage left by an interruption, such as a cut off compressed stream or a Parquet file that
+# was never closed, keeping the values read up to that point
+
+def read_column(path, output_format, column):
+    values = []
+    try:
+        if output_format == 'parquet':
+            import pyarrow.parquet as pq
+            return pq.read_table(path, columns=[column]).column(column).to_pylist()
+        with open(path, 'rb') as raw:
+            if output_format.endswith('.gz'):
+                stream = gzip.GzipFile(fileobj=raw, mode='rb')
+            elif output_format.endswith('.zst'):
+                import zstandard
+                stream = zstandard.ZstdDecompressor().stream_reader(raw, read_across_frames=True)
+            else:
+                stream = raw
+            file = io.TextIOWrapper(stream, encoding='utf-8', newline='')
+            if output_format.startswith('csv'):
+                for row in csv.DictReader(file):
+                    values.append(row.get(column))
+            else:
+                for line in file:
+                    values.append(json.loads(line).get(column))
+    except (OSError, EOFError, ValueError, ImportError):
+        pass
+    except Exception as e:  # pyarrow and zstandard raise their own errors for damaged files
+        say(f"Stopped reading {path} early: {e}", 'yellow')
+    return values
@@ -0,0 +1,81 @@
+#Simple AWS Manager (SAM) Toolbox is a set of lightweight scripts and modules for sysadmins in AWS
+#Copyright (C) 2024 Newton Advisory, LLC
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import sys
+import importlib.util
+import pytest
+
+# Shared fixtures for the tests. AWS is never contacted: stages that call AWS run against the simulated backend in
+# benchmarks/simulator.py, which answers every request of the sessions it is attached to
+#
+# Run the tests from the repository root with:
+#   python -m pytest tests
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, os.path.join(REPO_DIR, 'benchmarks'))
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'simulated')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'simulated')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.pop('AWS_PROFILE', None)
+
+import simulator
+from sam_toolbox import cache, journal
+from sam_toolbox.clients import new_session
+from sam_toolbox.inventory import remember_account
+
+# Keeps the cache, run journals and reports of every test in its own temporary directory
+
+@pytest.fixture(autouse=True)
+def work_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, 'CACHE_DIR', str(tmp_path / 'cache'))
+    monkeypatch.setattr(journal, 'JOURNAL_DIR', str(tmp_path / 'runs'))
+    monkeypatch.setitem(cache.settings, 'enabled', True)
+    monkeypatch.setitem(cache.settings, 'refresh', False)
+    monkeypatch.setitem(cache.settings, 'ttl', cache.DEFAULT_TTL)
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+# Builds simulated fleets: simulated_fleet(size, region, **options) returns (backend, target), the target as
+# build_targets would return it. The options are those of simulator.new_backend. Unless given, there is no latency and
+# commands finish and instances change state at once, so runs take no longer than the monitors' polling
+
+@pytest.fixture
+def simulated_fleet():
+    def build(size=60, region='us-east-1', **options):
+        options = {'latency': 0, 'command_seconds': (0, 0), 'transition_seconds': 0, **options}
+        backend = simulator.new_backend(size, region=region, **options)
+        session = new_session(region_name=region)
+        simulator.attach(backend, session)
+        remember_account(session, simulator.ACCOUNT_ID)
+        return backend, {'session': session, 'account_id': simulator.ACCOUNT_ID, 'region': region}
+    return build
+
+# A simulated fleet of 60 instances with the defaults above
+
+@pytest.fixture
+def fleet(simulated_fleet):
+    return simulated_fleet()
+
+# sam-spade.py loaded as a module, for the stages that live in the script itself
+
+@pytest.fixture
+def spade():
+    spec = importlib.util.spec_from_file_location('sam_spade', os.path.join(REPO_DIR, 'sam-spade.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
@@ -0,0 +1,91 @@
+#Simple AWS Manager (SAM) Toolbox is a set of lightweight scripts and modules for sysadmins in AWS
+#Copyright (C) 2024 Newton Advisory, LLC
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import time
+import simulator
+from sam_toolbox.actions import execute_command, monitor_command_status_and_fetch_output, REBOOT_NOT_VERIFIED
+from sam_toolbox.clients import get_client
+
+STOP = 'aws ec2 stop-instances'
+REBOOT = 'aws ec2 reboot-instances'
+
+def action_map(backend, instance_ids):
+    return {instance_id: (backend['instances'][instance_id]['name'], 'running') for instance_id in instance_ids}
+
+def test_actions_are_sent_in_batches_of_100(simulated_fleet):
+    backend, target = simulated_fleet(250)
+    processed = execute_command(action_map(backend, backend['order']), STOP, target['session'])
+    assert backend['calls']['ec2.StopInstances'] == 3
+    assert list(processed) == backend['order']
+    assert {new_state for _, _, new_state in processed.values()} == {'stopping'}
+    assert {instance['state'] for instance in backend['instances'].values()} == {'stopping'}
+
+# A batch rejected for one missing instance is split until exactly the existing instances have been stopped
+
+def test_rejected_batches_are_split_down_to_the_valid_instances(simulated_fleet):
+    backend, target = simulated_fleet(40)
+    missing = ['i-0000000000000dead', 'i-0000000000000beef']
+    selected = backend['order'][:15] + missing[:1] + backend['order'][15:] + missing[1:]
+    names = {**action_map(backend, backend['order']), **{instance_id: ('gone', 'running') for instance_id in missing}}
+    processed = execute_command({instance_id: names[instance_id] for instance_id in selected}, STOP, target['session'])
+    assert list(processed) == backend['order']
+    assert {instance['state'] for instance in backend['instances'].values()} == {'stopping'}
+
+# An error that is not about one instance fails the batch at once instead of being split down to single instances
+
+def test_other_errors_fail_the_batch_in_one_call(simulated_fleet, monkeypatch):
+    backend, target = simulated_fleet(40)
+    monkeypatch.setitem(simulator.HANDLERS, 'ec2.StopInstances',
+                        lambda backend, params: simulator.xml_error(403, 'UnauthorizedOperation', 'You are not authorized to perform this operation.'))
+    assert execute_command(action_map(backend, backend['order']), STOP, target['session']) == {}
+    assert backend['calls']['ec2.StopInstances'] == 1
+
+def run_action(backend, target, action, **options):
+    processed = execute_command(action_map(backend, backend['order']), action, target['session'])
+    ec2 = get_client('ec2', target['session'])
+    return monitor_command_status_and_fetch_output(ec2, list(processed), action, poll_interval=0.05, monitor_reboot=True, **options)
+
+def test_stopped_instances_are_monitored_until_they_stop(simulated_fleet):
+    backend, target = simulated_fleet(30, transition_seconds=0.2)
+    assert run_action(backend, target, STOP) == {instance_id: 'stopped' for instance_id in backend['order']}
+
+def test_reboots_are_verified_by_the_status_checks_going_down_and_back(simulated_fleet):
+    backend, target = simulated_fleet(30, transition_seconds=0.3)
+    assert run_action(backend, target, REBOOT, reboot_grace=10) == {instance_id: 'status checks ok' for instance_id in backend['order']}
+
+# Status checks that never leave ok cannot show the reboot happened, so the result says it is not verified
+
+def test_reboots_the_checks_never_show_are_not_verified(simulated_fleet):
+    backend, target = simulated_fleet(30)
+    started = time.monotonic()
+    assert run_action(backend, target, REBOOT, reboot_grace=0.5) == {instance_id: REBOOT_NOT_VERIFIED for instance_id in backend['order']}
+    assert time.monotonic() - started >= 0.5
+
+def test_errors_while_monitoring_keep_the_statuses_collected(simulated_fleet, monkeypatch):
+    backend, target = simulated_fleet(30, transition_seconds=60)
+    calls = []
+    def describe_instances(backend, params):
+        calls.append(params)
+        if len(calls) > 1:
+            return simulator.xml_error(403, 'UnauthorizedOperation', 'You are not authorized to perform this operation.')
+        return simulator.describe_instances(backend, params)
+    processed = execute_command(action_map(backend, backend['order']), STOP, target['session'])
+    stopped = backend['order'][:10]
+    for instance_id in stopped:
+        backend['instances'][instance_id]['settles_at'] = 0
+    monkeypatch.setitem(simulator.HANDLERS, 'ec2.DescribeInstances', describe_instances)
+    statuses = monitor_command_status_and_fetch_output(get_client('ec2', target['session']), list(processed), STOP, poll_interval=0.05)
+    assert statuses == {instance_id: 'stopped' if instance_id in stopped else 'monitoring failed (UnauthorizedOperation)' for instance_id in backend['order']}
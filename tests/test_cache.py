@@ -0,0 +1,77 @@
+#Simple AWS Manager (SAM) Toolbox is a set of lightweight scripts and modules for sysadmins in AWS
+#Copyright (C) 2024 Newton Advisory, LLC
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import time
+import pytest
+import simulator
+from sam_toolbox import cache
+from sam_toolbox.cache import load_cache, store_cache
+from sam_toolbox.inventory import fetch_inventory
+
+# A clock the tests move forward by hand, shared by the cache and the inventory
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [time.time()]
+    monkeypatch.setattr(time, 'time', lambda: now[0])
+    return now
+
+def test_entries_expire_after_the_ttl(clock):
+    store_cache('test', 'key', [1, 2])
+    clock[0] += cache.DEFAULT_TTL - 1
+    data, age = load_cache('test', 'key')
+    assert data == [1, 2] and age == pytest.approx(cache.DEFAULT_TTL - 1)
+    clock[0] += 2
+    assert load_cache('test', 'key') == (None, None)
+
+def test_entries_belong_to_their_key():
+    store_cache('test', 'key', [1])
+    assert load_cache('test', 'other key') == (None, None)
+
+def test_refresh_and_disabled_cache(monkeypatch):
+    store_cache('test', 'key', [1])
+    monkeypatch.setitem(cache.settings, 'refresh', True)
+    assert load_cache('test', 'key') == (None, None)
+    monkeypatch.setitem(cache.settings, 'refresh', False)
+    monkeypatch.setitem(cache.settings, 'enabled', False)
+    assert load_cache('test', 'key') == (None, None)
+
+# Within the TTL only instances that may be changing state are described again, so a stop made outside the toolbox
+# is not seen. Once the TTL has passed since the full download the inventory must be downloaded in full again, however
+# often the cached inventory was read and refreshed in between
+
+def test_inventory_is_downloaded_in_full_after_the_ttl(fleet, clock):
+    backend, target = fleet
+    instance_id = backend['order'][0]
+    assert fetch_inventory(target['session'])[instance_id][1] == 'running'
+
+    simulator.set_state(backend, backend['instances'][instance_id], 'stopped')
+    for _ in range(3):
+        clock[0] += cache.DEFAULT_TTL / 3 - 1
+        assert fetch_inventory(target['session'])[instance_id][1] == 'running'
+    clock[0] += 5
+    assert fetch_inventory(target['session'])[instance_id][1] == 'stopped'
+
+def test_inventory_refreshes_instances_that_were_changing_state(fleet, clock):
+    backend, target = fleet
+    instance_id = backend['order'][1]
+    simulator.set_state(backend, backend['instances'][instance_id], 'stopping')
+    backend['instances'][instance_id]['settles_at'] = float('inf')  # Still stopping when the inventory is downloaded
+    assert fetch_inventory(target['session'])[instance_id][1] == 'stopping'
+
+    backend['instances'][instance_id]['settles_at'] = 0
+    clock[0] += 10
+    assert fetch_inventory(target['session'])[instance_id][1] == 'stopped'
@@ -0,0 +1,42 @@
+#Simple AWS Manager (SAM) Toolbox is a set of lightweight scripts and modules for sysadmins in AWS
+#Copyright (C) 2024 Newton Advisory, LLC
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from concurrent.futures import ThreadPoolExecutor
+from botocore.credentials import Credentials
+from sam_toolbox.clients import get_session, new_session, get_client
+
+def test_each_client_is_built_once_per_session_service_and_region():
+    session = new_session(region_name='eu-west-1')
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        clients = list(executor.map(lambda _: get_client('ec2', session), range(32)))
+    assert all(client is clients[0] for client in clients)
+    assert get_client('ssm', session) is not clients[0]
+    assert get_client('ec2', session, 'us-west-2') is not clients[0]
+    assert get_client('ec2', new_session(region_name='eu-west-1')) is not clients[0]
+
+def test_clients_are_tuned_for_the_worker_pools():
+    config = get_client('ec2', new_session(region_name='eu-west-1')).meta.config
+    assert config.max_pool_connections == 50
+    assert config.retries['mode'] == 'adaptive'
+
+# New sessions reuse the default session's loaded service models and, when given, the credentials passed in
+
+def test_new_sessions_share_the_service_models():
+    loader = get_session()._session.get_component('data_loader')
+    session = new_session(region_name='ap-south-1', credentials=Credentials('AKIDSIMULATED', 'secret'))
+    assert session._session.get_component('data_loader') is loader
+    assert session.region_name == 'ap-south-1'
+    assert session.get_credentials().access_key == 'AKIDSIMULATED'
@@ -0,0 +1,83 @@
+#Simple AWS Manager (SAM) Toolbox is a set of lightweight scripts and modules for sysadmins in AWS
+#Copyright (C) 2024 Newton Advisory, LLC
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import time
+import pytest
+import simulator
+from botocore.stub import Stubber
+from sam_toolbox.clients import get_client
+from sam_toolbox.commands import execute_command, monitor_command_status_and_fetch_output, fetch_invocation_output
+from sam_toolbox.throttle import new_throttle
+
+COMMAND_ID = '00000000-0000-4000-8000-000000000000'
+INSTANCE_ID = 'i-00000000000000001'
+
+def run_command(backend, target, **options):
+    names = {instance_id: instance['name'] for instance_id, instance in backend['instances'].items()}
+    successful_instances, command_ids = execute_command(names, 'uptime', target['session'])
+    ssm = get_client('ssm', target['session'])
+    return list(monitor_command_status_and_fetch_output(ssm, command_ids, successful_instances, min_delay=0.05, **options))
+
+def test_every_instance_is_collected_with_its_status(simulated_fleet):
+    backend, target = simulated_fleet(120, command_seconds=(0, 0.3), failure_rate=0.2)
+    results = run_command(backend, target)
+    assert sorted(result.instance_id for result in results) == sorted(backend['order'])
+    failed = {instance_id for command in backend['commands'].values() for instance_id, (_, failed) in command['invocations'].items() if failed}
+    assert failed and {result.instance_id for result in results if result.status == 'Failed'} == failed
+    assert all(result.invocation_response for result in results if result.status == 'Success')
+
+# An invocation SSM never lists is given up on after registration_timeout, without holding up the others
+
+def test_unlisted_invocations_are_given_up_on(simulated_fleet, monkeypatch):
+    backend, target = simulated_fleet(10)
+    missing = backend['order'][0]
+    def list_command_invocations(backend, params):
+        invocations = backend['commands'][params['CommandId']]['invocations']
+        listed = invocations.pop(missing, None)
+        try:
+            return simulator.list_command_invocations(backend, params)
+        finally:
+            if listed:
+                invocations[missing] = listed
+    monkeypatch.setitem(simulator.HANDLERS, 'ssm.ListCommandInvocations', list_command_invocations)
+    started = time.monotonic()
+    results = run_command(backend, target, registration_timeout=0.5)
+    assert time.monotonic() - started < 5
+    assert sorted(result.instance_id for result in results) == sorted(backend['order'][1:])
+
+@pytest.fixture
+def stubbed_ssm(fleet):
+    ssm = get_client('ssm', fleet[1]['session'])
+    with Stubber(ssm) as stubber:
+        yield ssm, stubber
+
+def test_throttled_output_fetches_are_retried(stubbed_ssm):
+    ssm, stubber = stubbed_ssm
+    for _ in range(2):
+        stubber.add_client_error('get_command_invocation', service_error_code='ThrottlingException')
+    stubber.add_response('get_command_invocation', {'Status': 'Success', 'ResponseCode': 0, 'StandardOutputContent': 'ok\n', 'StandardErrorContent': ''})
+    result = fetch_invocation_output(ssm, COMMAND_ID, INSTANCE_ID, 'web-1', 'Success', throttle=new_throttle())
+    assert (result.status, result.invocation_response, result.response_code) == ('Success', 'ok\n', 0)
+    stubber.assert_no_pending_responses()
+
+# An output that cannot be fetched still leaves the instance's row, with the error in place of the output
+
+def test_failed_output_fetches_keep_the_row(stubbed_ssm):
+    ssm, stubber = stubbed_ssm
+    stubber.add_client_error('get_command_invocation', service_error_code='AccessDeniedException', service_message='not allowed')
+    result = fetch_invocation_output(ssm, COMMAND_ID, INSTANCE_ID, 'web-1', 'Success')
+    assert (result.instance_id, result.instance_name, result.status, result.invocation_response) == (INSTANCE_ID, 'web-1', 'Success', '')
+    assert 'AccessDeniedException' in result.standard_error
@@ -0,0 +1,49 @@
+#Simple AWS Manager (SAM) Toolbox is a set of lightweight scripts and modules for sysadmins in AWS
+#Copyright (C) 2024 Newton Advisory, LLC
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from sam_toolbox.commands import execute_command
+
+def sent_instances(backend):
+    return [instance_id for command in backend['commands'].values() for instance_id in command['invocations']]
+
+def test_commands_are_sent_in_batches_of_50(simulated_fleet):
+    backend, target = simulated_fleet(120)
+    names = {instance_id: instance['name'] for instance_id, instance in backend['instances'].items()}
+    successful_instances, command_ids = execute_command(names, 'uptime', target['session'])
+    assert backend['calls']['ssm.SendCommand'] == 3
+    assert list(successful_instances) == backend['order'] and list(command_ids) == backend['order']
+    assert sorted(sent_instances(backend)) == sorted(backend['order'])
+
+# A batch holding an offline instance is rejected as a whole; it must be split until exactly the online instances
+# have the command, each of them once
+
+def test_rejected_batches_are_split_down_to_the_eligible_instances(simulated_fleet):
+    backend, target = simulated_fleet(100, offline_rate=0.1)
+    online = [instance_id for instance_id in backend['order'] if backend['instances'][instance_id]['online']]
+    assert 0 < len(online) < 100
+    names = {instance_id: instance['name'] for instance_id, instance in backend['instances'].items()}
+    successful_instances, command_ids = execute_command(names, 'uptime', target['session'])
+    assert list(successful_instances) == online
+    assert sorted(sent_instances(backend)) == sorted(online)
+    assert all(command_ids[instance_id] in backend['commands'] for instance_id in online)
+
+def test_throttled_batches_are_retried(simulated_fleet):
+    backend, target = simulated_fleet(200, throttle_rate=2)
+    names = {instance_id: instance['name'] for instance_id, instance in backend['instances'].items()}
+    successful_instances, _ = execute_command(names, 'uptime', target['session'])
+    assert backend['throttles'].get('ssm.SendCommand', 0) > 0
+    assert list(successful_instances) == backend['order']
+    assert sorted(sent_instances(backend)) == sorted(backend['order'])
@@ -0,0 +1,75 @@
+#Simple AWS Manager (SAM) Toolbox is a set of lightweight scripts and modules for sysadmins in AWS
+#Copyright (C) 2024 Newton Advisory, LLC
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import time
+import threading
+import pytest
+from botocore.exceptions import ClientError
+from sam_toolbox.commands import iter_command_results
+from sam_toolbox.fanout import run_across_targets, iter_across_targets, target_label
+
+TARGETS = [{'session': None, 'account_id': '123456789012', 'region': region} for region in ('us-east-1', 'eu-west-1', 'ap-south-1')]
+
+def access_denied():
+    return ClientError({'Error': {'Code': 'AccessDenied', 'Message': 'not allowed'}}, 'DescribeInstances')
+
+# A target failing with an AWS error is left out and the others carry on
+
+def test_aws_errors_skip_only_their_target():
+    def work(target):
+        if target['region'] == 'eu-west-1':
+            raise access_denied()
+        return target['region']
+    assert run_across_targets(TARGETS, work) == {'123456789012/us-east-1': 'us-east-1', '123456789012/ap-south-1': 'ap-south-1'}
+
+    def produce(target):
+        yield target['region']
+        if target['region'] == 'eu-west-1':
+            raise access_denied()
+        yield target['region']
+    assert sorted(item for _, item in iter_across_targets(TARGETS, produce)) == ['ap-south-1', 'ap-south-1', 'eu-west-1', 'us-east-1', 'us-east-1']
+
+def test_other_exceptions_are_raised_in_the_consumer():
+    def produce(target):
+        if target['region'] == 'eu-west-1':
+            raise KeyError('bug')
+        yield from range(3)
+    with pytest.raises(KeyError):
+        list(iter_across_targets(TARGETS, produce))
+
+# Leaving the loop early must not wait for the targets still running: their monitors are stopped at the next poll
+
+def test_stopping_early_does_not_wait_for_the_other_targets(simulated_fleet):
+    backends = {}
+    targets = []
+    for region, command_seconds in (('us-east-1', (0, 0)), ('eu-west-1', (600, 600))):
+        backend, target = simulated_fleet(20, region=region, command_seconds=command_seconds)
+        backends[target_label(target)] = backend
+        targets.append(target)
+    ready_maps = {label: {instance_id: instance['name'] for instance_id, instance in backend['instances'].items()} for label, backend in backends.items()}
+    threads = threading.active_count()
+
+    results = iter_command_results(targets, ready_maps, 'uptime')
+    first = next(results)
+    assert first.region == 'us-east-1'
+    started = time.monotonic()
+    results.close()
+    assert time.monotonic() - started < 1
+
+    deadline = time.monotonic() + 5
+    while threading.active_count() > threads and time.monotonic() < deadline:
+        time.sleep(0.1)
+    assert threading.active_count() <= threads
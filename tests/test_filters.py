@@ -0,0 +1,61 @@
+#Simple AWS Manager (SAM) Toolbox is a set of lightweight scripts and modules for sysadmins in AWS
+#Copyright (C) 2024 Newton Advisory, LLC
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import pytest
+import simulator
+from sam_toolbox.filters import parse_filters
+from sam_toolbox.inventory import fetch_inventory
+
+def test_equality_filters_are_sent_to_ec2():
+    server_filters, predicate = parse_filters(['vpc=vpc-0abc', 'tag:Env = prod, stage', 'name=web-*'])
+    assert server_filters == [
+        {'Name': 'vpc-id', 'Values': ['vpc-0abc']},
+        {'Name': 'tag:Env', 'Values': ['prod', 'stage']},
+        {'Name': 'tag:Name', 'Values': ['web-*']},
+    ]
+    assert predicate is None
+
+def test_exclusions_and_patterns_are_checked_on_each_instance():
+    server_filters, predicate = parse_filters(['tag:Env!=prod,stage', 'az~1a$'])
+    assert server_filters == []
+    instance = {'Placement': {'AvailabilityZone': 'us-east-1a'}, 'Tags': [{'Key': 'Env', 'Value': 'dev'}]}
+    assert predicate(instance)
+    assert not predicate({**instance, 'Tags': [{'Key': 'Env', 'Value': 'prod'}]})
+    assert not predicate({**instance, 'Placement': {'AvailabilityZone': 'us-east-1b'}})
+    assert not predicate({'Tags': [{'Key': 'Env', 'Value': 'dev'}]})
+
+@pytest.mark.parametrize('expression', ['vpc', 'vpc=', 'colour=red', 'name~[web'])
+def test_invalid_filters(expression):
+    with pytest.raises(ValueError):
+        parse_filters([expression])
+
+# Equality filters reach describe_instances, so only the matching instances are downloaded, and the rest are checked
+# on each page as it arrives
+
+def test_filters_are_pushed_down_to_describe_instances(simulated_fleet, monkeypatch):
+    backend, target = simulated_fleet(90)
+    requests = []
+    def describe_instances(backend, params):
+        requests.append(params)
+        return simulator.describe_instances(backend, params)
+    monkeypatch.setitem(simulator.HANDLERS, 'ec2.DescribeInstances', describe_instances)
+
+    filters, predicate = parse_filters(['tag:Env=prod', 'name~^(web|db)-'])
+    inventory = fetch_inventory(target['session'], filters=filters, predicate=predicate)
+    expected = [instance_id for instance_id in backend['order']
+                if backend['instances'][instance_id]['env'] == 'prod' and backend['instances'][instance_id]['name'].startswith(('web-', 'db-'))]
+    assert list(inventory) == expected
+    assert requests and all('tag:Env' in params.values() and 'prod' in params.values() for params in requests)
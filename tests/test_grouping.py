@@ -0,0 +1,78 @@
+#Simple AWS Manager (SAM) Toolbox is a set of lightweight scripts and modules for sysadmins in AWS
+#Copyright (C) 2024 Newton Advisory, LLC
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import pytest
+from sam_toolbox.grouping import (group_results, diff_groups, save_groups, load_groups, load_run_groups, append_group_log, finish_groups,
+                                  group_log_path, groups_path, strip_report_extension)
+from sam_toolbox.records import CommandResult
+
+def result(instance_id, output, status='Success', response_code=0):
+    return CommandResult(instance_id, f"name-{instance_id}", output, status, response_code, '')
+
+def grouped(results):
+    groups = {}
+    hashed = list(group_results(results, groups))
+    return groups, hashed
+
+def test_identical_outputs_share_a_group():
+    groups, hashed = grouped([result('i-1', 'a'), result('i-2', 'b'), result('i-3', 'a'), result('i-4', 'a', 'Failed', 1)])
+    assert sorted(len(group['instances']) for group in groups.values()) == [1, 1, 2]
+    assert hashed[0].output_hash == hashed[2].output_hash != hashed[3].output_hash
+    assert all(result.output_hash in groups for result in hashed)
+
+def test_diff_reports_changed_new_and_missing_instances():
+    previous, _ = grouped([result('i-1', 'a'), result('i-2', 'a'), result('i-3', 'a')])
+    current, _ = grouped([result('i-1', 'a'), result('i-2', 'b'), result('i-4', 'a')])
+    diff = diff_groups(previous, current)
+    assert [entry['instance_id'] for entry in diff['changed']] == ['i-2']
+    assert [entry['instance_id'] for entry in diff['new']] == ['i-4']
+    assert [entry['instance_id'] for entry in diff['missing']] == ['i-3']
+    assert diff_groups(current, current) == {'changed': [], 'new': [], 'missing': []}
+
+def test_groups_file_round_trip():
+    groups, _ = grouped([result('i-1', 'a'), result('i-2', 'b'), result('i-3', 'b')])
+    save_groups(groups, 'spade-groups.json')
+    assert load_groups('spade.csv') == groups
+    with pytest.raises(ValueError):
+        load_groups('other.csv')
+
+# A run killed before closing its report has only the group log; a resumed run rebuilds its groups from it
+
+def test_groups_rebuilt_from_the_log_of_an_interrupted_run():
+    groups, pending = {}, []
+    list(group_results([result('i-1', 'a'), result('i-2', 'b'), result('i-3', 'a')], groups, pending))
+    append_group_log(pending, group_log_path('spade-groups.json'))
+    with open(group_log_path('spade-groups.json'), 'a') as file:
+        file.write('{"output_hash": "cut')
+    assert load_run_groups('spade-groups.json') == groups
+
+    finish_groups(groups, 'spade-groups.json')
+    assert not os.path.exists(group_log_path('spade-groups.json'))
+    assert load_run_groups('spade-groups.json') == groups
+
+@pytest.mark.parametrize('path, expected', [
+    ('spade.csv', 'spade'),
+    ('spade.jsonl.gz', 'spade'),
+    ('reports/spade.parquet', 'reports/spade'),
+    ('kernels.v2.csv', 'kernels.v2'),
+    ('notes.txt', 'notes.txt'),
+])
+def test_strip_report_extension(path, expected):
+    assert strip_report_extension(path) == expected
+
+def test_groups_path():
+    assert groups_path('kernels.v2.csv.zst') == 'kernels.v2-groups.json'
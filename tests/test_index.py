@@ -0,0 +1,89 @@
+#Simple AWS Manager (SAM) Toolbox is a set of lightweight scripts and modules for sysadmins in AWS
+#Copyright (C) 2024 Newton Advisory, LLC
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import time
+import sqlite3
+import pytest
+import simulator
+from sam_toolbox.filters import parse_filters
+from sam_toolbox.index import open_index, index_targets, list_snapshots, query_index, index_changes
+
+# The simulator has no EBS volumes to describe
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    monkeypatch.setitem(simulator.HANDLERS, 'ec2.DescribeVolumes', lambda backend, params: simulator.xml_response('DescribeVolumes', '<volumeSet/>'))
+    db = open_index(str(tmp_path / 'inventory.db'))
+    yield db
+    db.close()
+
+def index(db, target, expressions=None):
+    filters, predicate = parse_filters(expressions)
+    counts = index_targets(db, [target], filters, predicate, expressions=expressions)
+    time.sleep(0.01)  # Keeps the snapshots' times apart
+    return counts
+
+def test_queries_are_answered_from_the_index(db, fleet):
+    backend, target = fleet
+    assert index(db, target) == {('123456789012', 'us-east-1'): 60}
+    calls = simulator.total_calls(backend)
+
+    rows = query_index(db, ['tag:Env=prod', 'name~^web-'])
+    assert [row['instance_id'] for row in rows] == [instance_id for instance_id in backend['order']
+                                                  if backend['instances'][instance_id]['env'] == 'prod' and backend['instances'][instance_id]['name'].startswith('web-')]
+    assert {row['state'] for row in rows} == {'running'} and rows[0]['region'] == 'us-east-1'
+    assert len(query_index(db, ['ssm=Online'])) == 60
+    assert simulator.total_calls(backend) == calls
+
+def test_changes_since_an_earlier_snapshot(db, fleet):
+    backend, target = fleet
+    index(db, target)
+    since = time.time()
+    stopped, gone = backend['order'][:2]
+    simulator.set_state(backend, backend['instances'][stopped], 'stopped')
+    backend['order'].remove(gone)
+    del backend['instances'][gone]
+    index(db, target)
+
+    changes = index_changes(db, since)
+    assert [row['instance_id'] for row in changes['removed']] == [gone]
+    assert changes['added'] == []
+    assert [(row['instance_id'], row['changes']) for row in changes['changed']] == [(stopped, {'state': ['running', 'stopped']})]
+    assert len(query_index(db, as_of=since)) == 60 and len(query_index(db)) == 59
+
+# A filtered snapshot holds only part of the inventory: queries and diffs keep using the full one
+
+def test_filtered_snapshots_are_left_out_of_queries_and_changes(db, fleet):
+    backend, target = fleet
+    index(db, target)
+    since = time.time()
+    assert index(db, target, ['tag:Env=prod']) == {('123456789012', 'us-east-1'): 20}
+
+    assert len(query_index(db)) == 60
+    assert index_changes(db, since) == {'added': [], 'removed': [], 'changed': []}
+    assert [(count, filters) for _, _, _, _, count, filters in list_snapshots(db)] == [(20, ['tag:Env=prod']), (60, None)]
+
+def test_indexes_made_before_filters_were_recorded(tmp_path):
+    path = str(tmp_path / 'old.db')
+    old = sqlite3.connect(path)
+    old.execute("CREATE TABLE snapshots (snapshot_id INTEGER PRIMARY KEY, taken_at REAL, account_id TEXT, region TEXT, "
+                "instance_count INTEGER, complete INTEGER DEFAULT 0)")
+    old.execute("INSERT INTO snapshots VALUES (1, 0, '123456789012', 'us-east-1', 0, 1)")
+    old.commit()
+    old.close()
+    db = open_index(path)
+    assert list_snapshots(db) == [(1, 0, '123456789012', 'us-east-1', 0, None)]
+    db.close()
@@ -0,0 +1,102 @@
+#Simple AWS Manager (SAM) Toolbox is a set of lightweight scripts and modules for sysadmins in AWS
+#Copyright (C) 2024 Newton Advisory, LLC
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import json
+import pytest
+from sam_toolbox.jobs import load_jobs, job_filters, job_rollout, select_job_instances
+
+def write_jobs(tmp_path, document, name='jobs.json'):
+    path = tmp_path / name
+    path.write_text(json.dumps(document) if name.endswith('.json') else document)
+    return str(path)
+
+def test_defaults_are_merged_into_the_jobs_of_the_tool(tmp_path):
+    path = write_jobs(tmp_path, {
+        'defaults': {'regions': 'us-east-1,eu-west-1', 'concurrency': {'target_workers': 4}},
+        'jobs': [
+            {'name': 'kernels', 'tool': 'spade', 'command': 'uname -r', 'concurrency': {'max_workers': 2}},
+            {'name': 'stop-dev', 'tool': 'init', 'action': 'stop'},
+            {'command': 'uptime', 'regions': 'ap-south-1'},
+        ],
+    })
+    jobs, skipped = load_jobs(path, 'spade', {'regions': 'us-west-2', 'account_id': '123456789012'})
+    assert skipped == ['stop-dev']
+    assert [(job['name'], job['regions'], job['concurrency']) for job in jobs] == [
+        ('kernels', 'us-east-1,eu-west-1', {'target_workers': 4, 'max_workers': 2}),
+        ('job 3', 'ap-south-1', {'target_workers': 4}),
+    ]
+    assert all(job['account_id'] == '123456789012' for job in jobs)
+
+def test_yaml_job_files(tmp_path):
+    pytest.importorskip('yaml')
+    path = write_jobs(tmp_path, "jobs:\n  - name: inventory\n    tool: list\n    values: [InstanceId, State.Name]\n", 'jobs.yaml')
+    jobs, _ = load_jobs(path, 'list')
+    assert jobs[0]['values'] == ['InstanceId', 'State.Name']
+
+# Every problem is found when the file is loaded, before any job runs
+
+@pytest.mark.parametrize('job', [
+    {'tool': 'spade'},
+    {'tool': 'spade', 'command': 'uptime', 'colour': 'red'},
+    {'tool': 'init', 'action': 'restart'},
+    {'tool': 'list', 'values': []},
+    {'tool': 'list', 'values': ['InstanceId'], 'rollout': {'canary': 1}},
+    {'tool': 'init', 'action': 'stop', 'rollout': {'max_errors': 'some'}},
+    {'tool': 'spade', 'command': 'uptime', 'targets': {'filters': ['colour=red']}},
+    {'tool': 'spade', 'command': 'uptime', 'targets': {'select': 'name~['}},
+    {'tool': 'spade', 'command': 'uptime', 'concurrency': {'max_workers': 0}},
+    {'tool': 'spade', 'command': 'uptime', 'account_id': '1234'},
+    {'tool': 'init', 'action': 'stop', 'group': True},
+    {'tool': 'spade', 'command': 'uptime', 'format': 'xlsx'},
+])
+def test_invalid_jobs_are_rejected(tmp_path, job):
+    with pytest.raises(ValueError):
+        load_jobs(write_jobs(tmp_path, {'jobs': [job]}), 'spade')
+
+@pytest.mark.parametrize('document', ['{"jobs": []}', '{"jobs": [', '[1]'])
+def test_invalid_job_files_are_rejected(tmp_path, document):
+    with pytest.raises(ValueError):
+        load_jobs(write_jobs(tmp_path, document, 'jobs.txt'), 'spade')
+
+def test_target_selectors_become_filters():
+    filters, predicate = job_filters({'targets': {'tags': {'Env': ['prod', 'stage']}, 'filters': ['vpc=vpc-0abc'], 'instance_ids': ['i-1', 'i-2']}})
+    assert filters == [{'Name': 'vpc-id', 'Values': ['vpc-0abc']}, {'Name': 'tag:Env', 'Values': ['prod', 'stage']},
+                       {'Name': 'instance-id', 'Values': ['i-1', 'i-2']}]
+    assert predicate is None
+
+    many = [f"i-{n:017x}" for n in range(300)]
+    filters, predicate = job_filters({'targets': {'instance_ids': many}})
+    assert filters == [] and predicate({'InstanceId': many[0]}) and not predicate({'InstanceId': 'i-other'})
+
+def test_rollout_settings():
+    assert job_rollout({}) is None
+    assert job_rollout({'rollout': {'canary': 1, 'max_concurrency': '10%', 'max_errors': 2}}) is not None
+
+# Jobs with the same accounts, regions and selectors share one inventory download
+
+def test_jobs_share_their_inventory(fleet):
+    backend, target = fleet
+    memo = {}
+    job = {'concurrency': {}, 'targets': {'tags': {'Env': 'prod'}, 'select': 'name=web-*'}}
+    selected, instance_targets = select_job_instances(job, [target], memo)
+    expected = [instance_id for instance_id in backend['order']
+                if backend['instances'][instance_id]['env'] == 'prod' and backend['instances'][instance_id]['name'].startswith('web-')]
+    assert list(selected) == expected and all(instance_targets[instance_id] is target for instance_id in selected)
+    calls = backend['calls']['ec2.DescribeInstances']
+
+    selected, _ = select_job_instances({**job, 'targets': {'tags': {'Env': 'prod'}, 'select': 'name=db-*'}}, [target], memo)
+    assert selected and all(name.startswith('db-') for name, _ in selected.values())
+    assert backend['calls']['ec2.DescribeInstances'] == calls
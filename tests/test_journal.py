@@ -0,0 +1,80 @@
+#Simple AWS Manager (SAM) Toolbox is a set of lightweight scripts and modules for sysadmins in AWS
+#Copyright (C) 2024 Newton Advisory, LLC
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import csv
+import pytest
+from sam_toolbox.commands import filter_ready_targets
+from sam_toolbox.journal import start_journal, record, close_journal, load_journal, last_run_id, journal_path
+
+def test_journal_replays_into_the_run_state():
+    journal = start_journal('uptime', 'spade.csv', False)
+    record(journal, 'selected', target='123456789012/us-east-1', instances={'i-1': 'web', 'i-2': 'db', 'i-3': 'cache'})
+    record(journal, 'sent', command_id='c-1', instance_ids=['i-1', 'i-2'])
+    record(journal, 'status', instance_id='i-1', status='Success')
+    record(journal, 'written', instance_ids=['i-1'])
+    close_journal(journal)
+    with open(journal_path(journal['run_id']), 'a') as file:
+        file.write('{"event": "sent", "comm')  # Cut short by a disconnect
+
+    assert last_run_id() == journal['run_id']
+    state = load_journal(journal['run_id'])
+    assert state['run']['command'] == 'uptime'
+    assert state['names'] == {'i-1': 'web', 'i-2': 'db', 'i-3': 'cache'}
+    assert state['targets']['i-3'] == '123456789012/us-east-1'
+    assert state['sent'] == {'i-1': 'c-1', 'i-2': 'c-1'}
+    assert state['statuses'] == {'i-1': 'Success'}
+    assert state['written'] == {'i-1'}
+    assert not state['finished']
+
+def test_missing_journal():
+    with pytest.raises(ValueError, match='No journal found'):
+        load_journal('nope')
+    assert last_run_id() is None
+
+class Disconnected(Exception):
+    pass
+
+# A run cut off after some results were written is resumed from its journal: the command is not sent again, and the
+# missing results are appended so the report ends up with every instance exactly once
+
+def test_interrupted_run_is_resumed(fleet, spade, monkeypatch):
+    backend, target = fleet
+    names = {instance['id']: instance['name'] for instance in backend['instances'].values()}
+    ready_maps = filter_ready_targets([target], names, {})
+    iter_command_results = spade.iter_command_results
+
+    def interrupted(*args, **kwargs):
+        for count, result in enumerate(iter_command_results(*args, **kwargs)):
+            if count == 20:
+                raise Disconnected()
+            yield result
+    monkeypatch.setattr(spade, 'iter_command_results', interrupted)
+    with pytest.raises(Disconnected):
+        spade.run_command_across_targets([target], ready_maps, 'uname -r', 'spade.csv', group=True)
+    sends = backend['calls']['ssm.SendCommand']
+    with open('spade.csv') as file:
+        assert len(list(csv.DictReader(file))) == 20
+
+    monkeypatch.setattr(spade, 'build_targets', lambda *args, **kwargs: [target])
+    spade.resume_run(last_run_id())
+    assert backend['calls']['ssm.SendCommand'] == sends
+    with open('spade.csv') as file:
+        instance_ids = [row['instance_id'] for row in csv.DictReader(file)]
+    assert sorted(instance_ids) == sorted(ready_maps[f"{target['account_id']}/{target['region']}"]) and len(instance_ids) == 60
+    assert load_journal(last_run_id())['finished']
+
+    groups = spade.load_groups('spade.csv')
+    assert sorted(instance['instance_id'] for group in groups.values() for instance in group['instances']) == sorted(instance_ids)
@@ -0,0 +1,71 @@
+#Simple AWS Manager (SAM) Toolbox is a set of lightweight scripts and modules for sysadmins in AWS
+#Copyright (C) 2024 Newton Advisory, LLC
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import json
+import argparse
+import pytest
+from sam_toolbox import metrics
+from sam_toolbox.commands import execute_command
+from sam_toolbox.inventory import fetch_inventory
+from sam_toolbox.metrics import configure_metrics, metrics_snapshot, report_metrics, phase, timer
+
+# Turns metrics on for one test, without the summary printed at exit
+
+@pytest.fixture
+def enabled_metrics(monkeypatch):
+    monkeypatch.setattr(metrics, '_metrics', None)
+    monkeypatch.setattr(metrics.atexit, 'register', lambda *args: None)
+    configure_metrics(argparse.Namespace(metrics=''), 'test')
+
+def test_nothing_is_collected_without_metrics(fleet, monkeypatch):
+    monkeypatch.setattr(metrics, '_metrics', None)
+    with phase('inventory'), timer('work'):
+        fetch_inventory(fleet[1]['session'])
+    assert not metrics.metrics_enabled()
+
+def test_api_calls_are_counted_per_operation_and_phase(enabled_metrics, simulated_fleet):
+    backend, target = simulated_fleet(2500)
+    with phase('inventory'):
+        fetch_inventory(target['session'])
+    with timer('work'):
+        pass
+    snapshot = metrics_snapshot()
+    operation = snapshot['operations']['ec2.DescribeInstances']
+    assert operation['calls'] == backend['calls']['ec2.DescribeInstances'] == 3
+    assert operation['errors'] == 0 and operation['max_ms'] >= operation['avg_ms']
+    assert snapshot['phases']['inventory']['api_calls'] == sum(entry['calls'] for entry in snapshot['operations'].values())
+    assert snapshot['phases']['inventory']['runs'] == 1
+    assert snapshot['timers']['work']['count'] == 1
+
+def test_throttles_and_retries_are_counted(enabled_metrics, simulated_fleet):
+    backend, target = simulated_fleet(200, throttle_rate=2)
+    names = {instance_id: instance['name'] for instance_id, instance in backend['instances'].items()}
+    with phase('dispatch'):
+        execute_command(names, 'uptime', target['session'])
+    snapshot = metrics_snapshot()
+    throttles = backend['throttles']['ssm.SendCommand']
+    assert throttles > 0
+    assert snapshot['operations']['ssm.SendCommand']['throttles'] == throttles
+    assert snapshot['phases']['dispatch']['throttles'] == throttles
+
+def test_metrics_are_saved_as_json(enabled_metrics, tmp_path, capsys):
+    with phase('selection'):
+        pass
+    path = tmp_path / 'metrics' / 'run.json'
+    report_metrics(str(path))
+    saved = json.loads(path.read_text())
+    assert saved['tool'] == 'test' and 'selection' in saved['phases']
+    assert 'Run metrics' in capsys.readouterr().out
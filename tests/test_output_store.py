@@ -0,0 +1,80 @@
+#Simple AWS Manager (SAM) Toolbox is a set of lightweight scripts and modules for sysadmins in AWS
+#Copyright (C) 2024 Newton Advisory, LLC
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import time
+import pytest
+from botocore.stub import Stubber
+from sam_toolbox.output_store import parse_output_store, open_output_store, send_command_params, save_stream, S3_PLUGIN_PATH
+
+COMMAND_ID = '00000000-0000-4000-8000-000000000000'
+INSTANCE_ID = 'i-00000000000000001'
+
+def test_store_urls():
+    assert send_command_params(open_output_store('s3://bucket/spade/', 'out')) == {'OutputS3BucketName': 'bucket', 'OutputS3KeyPrefix': 'spade'}
+    assert send_command_params(open_output_store('s3://bucket', 'out')) == {'OutputS3BucketName': 'bucket'}
+    assert send_command_params(open_output_store('cloudwatch://spade-logs', 'out')) == {
+        'CloudWatchOutputConfig': {'CloudWatchLogGroupName': 'spade-logs', 'CloudWatchOutputEnabled': True}}
+    assert send_command_params(open_output_store('file:///tmp/outputs', 'out')) == {}
+    assert send_command_params(None) == {}
+
+@pytest.mark.parametrize('url', ['s3://', 'cloudwatch://', 'file://', 'http://example.com', 'bucket'])
+def test_invalid_store_urls(url):
+    with pytest.raises(ValueError):
+        parse_output_store(url)
+
+@pytest.fixture
+def file_store(tmp_path):
+    store = open_output_store(f"file://{tmp_path / 'store'}", str(tmp_path / 'out'))
+    def upload(stream, content):
+        directory = os.path.join(store['path'], COMMAND_ID, INSTANCE_ID, *S3_PLUGIN_PATH)
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, stream), 'w') as file:
+            file.write(content)
+    return store, upload
+
+def test_streams_are_copied_from_the_store(file_store):
+    store, upload = file_store
+    upload('stdout', 'x' * 100000)
+    path = save_stream(store, COMMAND_ID, INSTANCE_ID, 'stdout', 'x' * 24000)
+    assert path == os.path.join(store['output_dir'], f"{INSTANCE_ID}.stdout")
+    assert open(path).read() == 'x' * 100000
+
+def test_empty_streams_are_not_looked_for(file_store):
+    store, _ = file_store
+    started = time.monotonic()
+    assert save_stream(store, COMMAND_ID, INSTANCE_ID, 'stderr', '') is None
+    assert time.monotonic() - started < 0.1
+
+# A stream the store never receives is given up on after max_wait, keeping the inline output
+
+def test_missing_streams_are_waited_for_at_most_max_wait(file_store):
+    store, _ = file_store
+    started = time.monotonic()
+    assert save_stream(store, COMMAND_ID, INSTANCE_ID, 'stdout', 'inline', max_wait=0.6) is None
+    assert 0.6 <= time.monotonic() - started < 1
+
+def test_cloudwatch_streams_are_written_page_by_page(fleet, tmp_path):
+    store = open_output_store('cloudwatch://spade-logs', str(tmp_path / 'out'), fleet[1]['session'])
+    stream_name = f"{COMMAND_ID}/{INSTANCE_ID}/aws-runShellScript/stdout"
+    with Stubber(store['client']) as stubber:
+        stubber.add_client_error('get_log_events', service_error_code='ResourceNotFoundException')
+        for token, messages, next_token in ((None, ['one', 'two'], 'f/1'), ('f/1', ['three'], 'f/2'), ('f/2', [], 'f/2')):
+            expected = {'logGroupName': 'spade-logs', 'logStreamName': stream_name, 'startFromHead': True, **({'nextToken': token} if token else {})}
+            stubber.add_response('get_log_events', {'events': [{'message': message} for message in messages], 'nextForwardToken': next_token}, expected)
+        path = save_stream(store, COMMAND_ID, INSTANCE_ID, 'stdout', 'one')
+        stubber.assert_no_pending_responses()
+    assert open(path).read() == 'one\ntwo\nthree\n'
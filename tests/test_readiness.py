@@ -0,0 +1,54 @@
+#Simple AWS Manager (SAM) Toolbox is a set of lightweight scripts and modules for sysadmins in AWS
+#Copyright (C) 2024 Newton Advisory, LLC
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import simulator
+from sam_toolbox.commands import filter_ssm_ready_instances
+
+def names_of(backend, instance_ids):
+    return {instance_id: backend['instances'][instance_id]['name'] for instance_id in instance_ids}
+
+def online_of(backend, instance_ids):
+    return [instance_id for instance_id in instance_ids if backend['instances'][instance_id]['online']]
+
+# A handful of instances costs one lookup by ID, and offline instances are left out
+
+def test_small_selections_are_looked_up_by_id(simulated_fleet):
+    backend, target = simulated_fleet(300, offline_rate=0.3)
+    selected = backend['order'][:20]
+    ready = filter_ssm_ready_instances(names_of(backend, selected), target['session'])
+    assert list(ready) == online_of(backend, selected) and len(ready) < 20
+    assert backend['calls']['ssm.DescribeInstanceInformation'] == 1
+
+def test_large_selections_scan_once_and_are_cached(simulated_fleet):
+    backend, target = simulated_fleet(300, offline_rate=0.3)
+    selected = backend['order'][:250]
+    ready = filter_ssm_ready_instances(names_of(backend, selected), target['session'])
+    assert list(ready) == online_of(backend, selected)
+    scans = backend['calls']['ssm.DescribeInstanceInformation']
+    assert scans == -(-len(online_of(backend, backend['order'])) // 50)  # One call per page of the managed instances
+
+    assert filter_ssm_ready_instances(names_of(backend, selected), target['session']) == ready
+    assert backend['calls']['ssm.DescribeInstanceInformation'] == scans
+
+def test_rejected_id_lookups_fall_back_to_a_scan(simulated_fleet, monkeypatch):
+    backend, target = simulated_fleet(30, offline_rate=0.3)
+    def describe_instance_information(backend, params):
+        if params.get('InstanceInformationFilterList'):
+            return simulator.json_error(400, 'InvalidInstanceId', 'Invalid instance id')
+        return simulator.describe_instance_information(backend, params)
+    monkeypatch.setitem(simulator.HANDLERS, 'ssm.DescribeInstanceInformation', describe_instance_information)
+    ready = filter_ssm_ready_instances(names_of(backend, backend['order']), target['session'])
+    assert list(ready) == online_of(backend, backend['order'])
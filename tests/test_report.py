@@ -0,0 +1,45 @@
+#Simple AWS Manager (SAM) Toolbox is a set of lightweight scripts and modules for sysadmins in AWS
+#Copyright (C) 2024 Newton Advisory, LLC
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from sam_toolbox.report import iter_report, compile_accessor, MISSING_VALUE
+
+# Only the selected instances are described, 200 per call, and their records come back in the order selected
+
+def test_only_the_selected_instances_are_reported(simulated_fleet):
+    backend, target = simulated_fleet(1000)
+    selected = backend['order'][700:450:-1]
+    names = {instance_id: backend['instances'][instance_id]['name'] for instance_id in selected}
+    records = list(iter_report(names, ['InstanceId', 'State.Name'], session=target['session']))
+    assert [record.instance_id for record in records] == selected
+    assert all(record.values == {'InstanceId': record.instance_id, 'State.Name': 'running'} for record in records)
+    assert backend['calls']['ec2.DescribeInstances'] == 2
+
+def test_dotted_and_list_values(simulated_fleet):
+    backend, target = simulated_fleet(3)
+    instance_id = backend['order'][2]
+    values = ['Placement.AvailabilityZone', 'Tags', 'SecurityGroups', 'IamInstanceProfile.Arn', 'CpuOptions']
+    record, = iter_report({instance_id: 'web'}, values, session=target['session'])
+    assert record.values == {
+        'Placement.AvailabilityZone': 'us-east-1a',
+        'Tags': f"Name={backend['instances'][instance_id]['name']},Env=dev",
+        'SecurityGroups': 'default',
+        'IamInstanceProfile.Arn': MISSING_VALUE,
+        'CpuOptions': {'CoreCount': 1, 'ThreadsPerCore': 2},
+    }
+
+def test_dotted_paths_stop_at_values_that_are_not_mappings():
+    assert compile_accessor('State.Name.Length')({'State': {'Name': 'running'}}) == MISSING_VALUE
+    assert compile_accessor('State')({'State': {'Name': 'running'}}) == {'Name': 'running'}
@@ -0,0 +1,115 @@
+#Simple AWS Manager (SAM) Toolbox is a set of lightweight scripts and modules for sysadmins in AWS
+#Copyright (C) 2024 Newton Advisory, LLC
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import functools
+import pytest
+import simulator
+from sam_toolbox import actions
+from sam_toolbox.rollout import new_rollout, release, finish, has_work, skipped_ids, remaining_errors, resolve_limit, rollout_settings
+
+INSTANCE_IDS = [f"i-{n:03d}" for n in range(300)]
+
+def release_all(rollout, limit=None):
+    released = []
+    while True:
+        batch = release(rollout, limit)
+        if not batch:
+            return released
+        released.append(batch)
+
+@pytest.mark.parametrize('limit, fleet_size, expected', [
+    (None, 10, 7),
+    ('3', 10, 3),
+    ('30', 10, 10),
+    ('10%', 5, 1),
+    ('25%', 10, 3),
+    ('100%', 10, 10),
+])
+def test_resolve_limit(limit, fleet_size, expected):
+    assert resolve_limit(limit, fleet_size, 7) == expected
+
+def test_no_settings_means_no_rollout():
+    assert rollout_settings() is None
+
+def test_canary_larger_than_the_release_limit_is_released_in_full():
+    rollout = new_rollout(INSTANCE_IDS, rollout_settings(canary='120', max_concurrency='40'))
+    batches = release_all(rollout, limit=50)
+    assert [len(batch) for batch in batches] == [50, 50, 20]
+    assert rollout['phase'] == 'canary running'
+
+    # Nothing else goes out until the whole canary has finished
+    for instance_id in [instance_id for batch in batches for instance_id in batch][:-1]:
+        finish(rollout, instance_id)
+    assert release(rollout, limit=50) == []
+    finish(rollout, batches[-1][-1])
+    assert len(release(rollout, limit=50)) == 40
+    assert rollout['phase'] == 'rolling'
+
+def test_window_is_refilled_as_instances_finish():
+    rollout = new_rollout(INSTANCE_IDS[:10], rollout_settings(max_concurrency='4'))
+    first = release(rollout)
+    assert len(first) == 4 and release(rollout) == []
+    finish(rollout, first[0])
+    finish(rollout, first[1])
+    assert len(release(rollout)) == 2
+
+def test_rollout_halts_past_the_error_budget():
+    rollout = new_rollout(INSTANCE_IDS[:10], rollout_settings(canary='2', max_errors='1'))
+    canary = release(rollout)
+    finish(rollout, canary[0], failed=True)
+    assert remaining_errors(rollout) == 0 and has_work(rollout)
+    finish(rollout, canary[1], failed=True)
+    assert not has_work(rollout)
+    assert release(rollout) == []
+    assert skipped_ids(rollout) == INSTANCE_IDS[2:10]
+
+# Rolling reboots on the simulated backend. The monitor polls every 50ms and gives up on reboots the status checks do
+# not show after half a second
+
+REBOOT = 'aws ec2 reboot-instances'
+
+@pytest.fixture
+def fast_monitor(monkeypatch):
+    monitor = functools.partial(actions.monitor_command_status_and_fetch_output, poll_interval=0.05, reboot_grace=0.5)
+    monkeypatch.setattr(actions, 'monitor_command_status_and_fetch_output', monitor)
+
+def reboot_fleet(backend, target, timeout=5):
+    names = {instance_id: (instance['name'], 'running') for instance_id, instance in backend['instances'].items()}
+    return actions.rolling_action(names, REBOOT, rollout_settings('1', '4', '0'), target['session'], timeout=timeout)
+
+def test_rolling_reboot(simulated_fleet, fast_monitor):
+    backend, target = simulated_fleet(9, transition_seconds=0.2)
+    assert reboot_fleet(backend, target) == {instance_id: 'status checks ok' for instance_id in backend['order']}
+    assert backend['calls']['ec2.RebootInstances'] == 3
+
+# A canary that does not come back, or whose reboot the status checks never show, spends the error budget and the
+# rest of the fleet is left alone
+
+@pytest.mark.parametrize('checks_ok_after, canary_status', [
+    (float('inf'), 'timed out (running, system initializing, instance initializing)'),
+    (0, actions.REBOOT_NOT_VERIFIED),
+])
+def test_failed_canary_reboot_halts_the_rollout(simulated_fleet, fast_monitor, monkeypatch, checks_ok_after, canary_status):
+    backend, target = simulated_fleet(9, transition_seconds=0.2)
+    def reboot_instances(backend, params):
+        result = simulator.reboot_instances(backend, params)
+        backend['instances'][backend['order'][0]]['checks_ok_at'] = checks_ok_after
+        return result
+    monkeypatch.setitem(simulator.HANDLERS, 'ec2.RebootInstances', reboot_instances)
+    statuses = reboot_fleet(backend, target, timeout=1)
+    assert statuses == {instance_id: canary_status if instance_id == backend['order'][0] else 'not attempted (rollout halted)'
+                        for instance_id in backend['order']}
+    assert backend['calls']['ec2.RebootInstances'] == 1
@@ -0,0 +1,69 @@
+#Simple AWS Manager (SAM) Toolbox is a set of lightweight scripts and modules for sysadmins in AWS
+#Copyright (C) 2024 Newton Advisory, LLC
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import pytest
+from sam_toolbox.selection import build_index, parse_selection, select
+
+INVENTORY = {
+    'i-001': ('web-01', 'running', {'Env': 'prod'}),
+    'i-002': ('web-02', 'stopped', {'Env': 'prod'}),
+    'i-003': ('db-01', 'running', {'Env': 'stage'}),
+    'i-004': ('db-02', 'running', {}),
+    'i-005': ('bastion', 'running', {'Env': 'dev', 'Owner': 'ops team'}),
+}
+
+@pytest.mark.parametrize('expression, expected', [
+    ('1,3-4', ['i-001', 'i-003', 'i-004']),
+    ('all', list(INVENTORY)),
+    ('*', list(INVENTORY)),
+    ('i-004', ['i-004']),
+    ('name=web-*', ['i-001', 'i-002']),
+    ('name=db-01|bastion', ['i-003', 'i-005']),
+    (r'name~^db-\d+$', ['i-003', 'i-004']),
+    (r'name~^web-\d{1,2}$, name=bastion', ['i-001', 'i-002', 'i-005']),
+    (r'name~^(web|db)-0[1,2]$ state=stopped, 5', ['i-002', 'i-005']),
+    ('tag:Env=prod|stage', ['i-001', 'i-002', 'i-003']),
+    ('tag:Owner', ['i-005']),
+    ('tag:Owner=ops?team', ['i-005']),
+    ('state=running', ['i-001', 'i-003', 'i-004', 'i-005']),
+    ('tag:Env=prod state=running, name=bastion', ['i-001', 'i-005']),
+    ('1-5 !state=stopped', ['i-001', 'i-003', 'i-004', 'i-005']),
+    ('tag:Env!=prod', ['i-003', 'i-004', 'i-005']),
+    ('!tag:Env', ['i-004']),
+    ('name=nothing', []),
+])
+def test_select(expression, expected):
+    assert select(build_index(INVENTORY), expression) == expected
+
+def test_select_keeps_inventory_order():
+    assert select(build_index(INVENTORY), '5,1,name=db-01') == ['i-001', 'i-003', 'i-005']
+
+def test_select_all_reference_number():
+    assert select(build_index(INVENTORY), '6', all_ref=6) == list(INVENTORY)
+
+def test_select_without_tags():
+    inventory = {instance_id: details[:2] for instance_id, details in INVENTORY.items()}
+    assert select(build_index(inventory), 'state=stopped') == ['i-002']
+    assert select(build_index(inventory), 'tag:Env=prod') == []
+
+@pytest.mark.parametrize('expression', ['5-2', 'name', 'size=large', r'name~(', 'color=blue'])
+def test_parse_errors(expression):
+    with pytest.raises(ValueError):
+        parse_selection(expression)
+
+def test_reference_outside_the_list():
+    with pytest.raises(ValueError, match='outside the list'):
+        select(build_index(INVENTORY), '4-9')
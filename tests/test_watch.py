@@ -0,0 +1,102 @@
+#Simple AWS Manager (SAM) Toolbox is a set of lightweight scripts and modules for sysadmins in AWS
+#Copyright (C) 2024 Newton Advisory, LLC
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import json
+import simulator
+from sam_toolbox.clients import get_client
+from sam_toolbox.watch import new_watch, poll_watch, watch_inventory
+
+VALUES = ['InstanceId', 'Tags']
+
+def test_the_baseline_reports_every_instance_once(fleet):
+    backend, target = fleet
+    watch = new_watch(VALUES)
+    ec2 = get_client('ec2', target['session'])
+    events = poll_watch(watch, ec2)
+    assert sorted(event['instance_id'] for event in events) == sorted(backend['order'])
+    assert {event['event'] for event in events} == {'present'}
+    assert events[0]['values']['State.Name'] == 'running'
+
+    described = backend['calls']['ec2.DescribeInstances']
+    assert poll_watch(watch, ec2) == []
+    assert backend['calls']['ec2.DescribeInstances'] == described
+
+# After the baseline a poll describes only the instances whose state changed and reports only what changed
+
+def test_polls_report_only_the_changes(fleet):
+    backend, target = fleet
+    watch = new_watch(VALUES)
+    ec2 = get_client('ec2', target['session'])
+    poll_watch(watch, ec2)
+    stopped, gone = backend['order'][3], backend['order'][4]
+    simulator.set_state(backend, backend['instances'][stopped], 'stopped')
+    gone_name = backend['instances'][gone]['name']
+    backend['order'].remove(gone)
+    del backend['instances'][gone]
+
+    described = backend['calls']['ec2.DescribeInstances']
+    events = poll_watch(watch, ec2)
+    assert events == [
+        {'event': 'changed', 'instance_id': stopped, 'instance_name': backend['instances'][stopped]['name'], 'changes': {'State.Name': ['running', 'stopped']}},
+        {'event': 'terminated', 'instance_id': gone, 'instance_name': gone_name},
+    ]
+    assert backend['calls']['ec2.DescribeInstances'] == described + 1
+
+def test_full_polls_catch_changes_that_keep_the_state(fleet):
+    backend, target = fleet
+    watch = new_watch(VALUES)
+    ec2 = get_client('ec2', target['session'])
+    poll_watch(watch, ec2)
+    instance = backend['instances'][backend['order'][0]]
+    instance['name'], instance['xml'] = 'renamed', None
+    assert poll_watch(watch, ec2) == []
+    event, = poll_watch(watch, ec2, full=True)
+    assert (event['event'], event['instance_name'], list(event['changes'])) == ('changed', 'renamed', ['Tags'])
+
+def test_filters_limit_what_is_watched(fleet):
+    backend, target = fleet
+    watch = new_watch(VALUES, [{'Name': 'tag:Env', 'Values': ['prod']}])
+    ec2 = get_client('ec2', target['session'])
+    events = poll_watch(watch, ec2)
+    assert sorted(event['instance_id'] for event in events) == sorted(instance_id for instance_id in backend['order'] if backend['instances'][instance_id]['env'] == 'prod')
+
+    # An instance that starts matching is new; one that stops matching is reported as gone
+    joined, left = backend['order'][1], backend['order'][0]
+    backend['instances'][joined]['env'] = 'prod'
+    backend['instances'][left]['env'] = 'dev'
+    for instance_id in (joined, left):
+        simulator.set_state(backend, backend['instances'][instance_id], 'stopped')
+    assert [(event['event'], event['instance_id']) for event in poll_watch(watch, ec2)] == [('new', joined), ('terminated', left)]
+
+# A failed poll is reported and retried at the next interval instead of ending the watch
+
+def test_the_watch_keeps_going_through_errors(fleet, monkeypatch, tmp_path):
+    backend, target = fleet
+    calls = []
+    def describe_instance_status(backend, params):
+        calls.append(params)
+        if len(calls) == 2:
+            return simulator.xml_error(403, 'UnauthorizedOperation', 'You are not authorized to perform this operation.')
+        if len(calls) == 3:
+            simulator.set_state(backend, backend['instances'][backend['order'][0]], 'stopped')
+        return simulator.describe_instance_status(backend, params)
+    monkeypatch.setitem(simulator.HANDLERS, 'ec2.DescribeInstanceStatus', describe_instance_status)
+
+    log_path = tmp_path / 'changes.jsonl'
+    assert watch_inventory([target], VALUES, interval=0.01, log_path=str(log_path), polls=3) == 1
+    events = [json.loads(line) for line in log_path.read_text().splitlines()]
+    assert [event['event'] for event in events] == ['present'] * 60 + ['changed']
+    assert events[-1]['changes'] == {'State.Name': ['running', 'stopped']} and events[-1]['region'] == 'us-east-1'
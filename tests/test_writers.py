@@ -0,0 +1,80 @@
+#Simple AWS Manager (SAM) Toolbox is a set of lightweight scripts and modules for sysadmins in AWS
+#Copyright (C) 2024 Newton Advisory, LLC
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import json
+import gzip
+import pytest
+from sam_toolbox.writers import open_writer, write_row, sync_writer, close_writer, read_column, can_append, format_path, check_format
+
+FIELDS = ['instance_id', 'status', 'response_code']
+TYPES = {'response_code': 'int'}
+TEXT_FORMATS = ['csv', 'csv.gz', 'jsonl', 'jsonl.gz']
+
+def write_rows(path, output_format, rows, append=False):
+    writer = open_writer(path, FIELDS, output_format, TYPES, append=append)
+    for row in rows:
+        write_row(writer, row)
+    close_writer(writer)
+
+def rows(first, count):
+    return [{'instance_id': f"i-{n:03d}", 'status': 'Success', 'response_code': n % 2} for n in range(first, first + count)]
+
+@pytest.mark.parametrize('output_format', TEXT_FORMATS)
+def test_appended_rows_read_back(output_format):
+    path = format_path('spade.csv', output_format)
+    write_rows(path, output_format, rows(0, 3))
+    assert can_append(output_format)
+    write_rows(path, output_format, rows(3, 2), append=True)
+    assert read_column(path, output_format, 'instance_id') == [f"i-{n:03d}" for n in range(5)]
+
+def test_csv_header_written_once():
+    write_rows('spade.csv', 'csv', rows(0, 2))
+    write_rows('spade.csv', 'csv', rows(2, 2), append=True)
+    with open('spade.csv') as file:
+        assert sum(line.startswith('instance_id,') for line in file) == 1
+
+def test_jsonl_keeps_types():
+    write_rows('spade.jsonl', 'jsonl', [{'instance_id': 'i-001', 'status': 'Failed', 'response_code': '2'}])
+    with open('spade.jsonl') as file:
+        assert json.loads(file.readline()) == {'instance_id': 'i-001', 'status': 'Failed', 'response_code': 2}
+
+# A synced gzip report that was never closed, as an interrupted run leaves it, still reads back up to the last sync
+
+def test_unclosed_gzip_reads_back_to_the_last_sync():
+    writer = open_writer('spade.csv.gz', FIELDS, 'csv.gz', TYPES)
+    for row in rows(0, 4):
+        write_row(writer, row)
+    assert sync_writer(writer)
+    write_row(writer, rows(4, 1)[0])
+    writer['raw'].flush()
+    assert read_column('spade.csv.gz', 'csv.gz', 'instance_id') == [f"i-{n:03d}" for n in range(4)]
+    writer['raw'].close()
+
+def test_damaged_report_reads_what_it_can():
+    write_rows('spade.jsonl.gz', 'jsonl.gz', rows(0, 2))
+    with open('spade.jsonl.gz', 'ab') as file:
+        file.write(gzip.compress(b'{"instance_id": "i-002"}\n')[:-12])  # A second gzip member, cut off
+    assert read_column('spade.jsonl.gz', 'jsonl.gz', 'instance_id') == ['i-000', 'i-001']
+    assert read_column('missing.csv', 'csv', 'instance_id') == []
+
+def test_format_path():
+    assert format_path('spade.csv', 'jsonl.gz') == 'spade.jsonl.gz'
+    assert format_path('reports/spade.csv', 'csv') == 'reports/spade.csv'
+    assert format_path('spade.parquet', 'parquet') == 'spade.parquet'
+
+def test_unknown_format():
+    with pytest.raises(ValueError, match='Unknown format'):
+        check_format('xml')